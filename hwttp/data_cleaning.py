@@ -1,438 +1,2920 @@
-from lxml import etree
-import pandas as pd
-from tqdm import tqdm
-import json
-import gzip
-import shutil
-import os
-import tarfile
-import sqlite3
-
-
-def unzip_file(gz_path, xml_path):
-    '''
-    gz_path file unzip to xml_path using copyfile
-    '''
-    with gzip.open(gz_path, 'rb') as f_in:
-        with open(xml_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-
-def ensure_directory_exists(path):
-    '''
-    make sure there is a folder exists, if not create one
-    '''
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-
-def extract_tar_gz(tar_gz_path, extract_path):
-    '''
-    Extract a .tar.gz file to a specified directory
-    '''
-    with tarfile.open(tar_gz_path, 'r:gz') as tar:
-        tar.extractall(path=extract_path)
-
-def decompress_procedure_datefolder(date_list: list[str],
-                                    input_zip_dir: str,
-                                    output_dir: str) -> None:
-    '''
-    提供vd, etag info 資料解壓縮使用的流程
-    因為上述兩種在資料下載時都是依據日期資料夾分拆擺放
-    '''
-    for date in tqdm(date_list):
-        input_dir = f'{input_zip_dir}/{date}'
-        output_dir = f'{output_dir}/{date}'
-        for file_name in os.listdir(input_dir):
-            if file_name.endswith('.gz'):
-                gz_file_path = os.path.join(input_dir, file_name)
-                xml_file_name = file_name.replace('.gz', '')
-                xml_file_path = os.path.join(output_dir, xml_file_name)
-                try:
-                    ensure_directory_exists(output_dir)
-                    unzip_file(gz_file_path, xml_file_path)
-                except:
-                    print(f"Unzipped {gz_file_path} to {xml_file_path} ran into error!!!")
-
-
-
-def decompress_vd_data(date_list: list[str],
-                       input_zip_dir: str='../data/raw/VD',
-                       output_dir: str='../data/raw/unzip_VD') -> None:
-    '''
-    依據輸入的日期清單，將原始儲存的VD.xml.gz解壓縮到指定的資料夾下，結構上還是會依據日期再分子資料夾
-    '''
-    # 這邊先以每天的VD相關資料解壓縮進行處理
-    decompress_procedure_datefolder(date_list,
-                                    input_zip_dir,
-                                    output_dir)
-
-def decompress_etag_info_data(date_list: list[str],
-                              input_zip_dir: str='../data/raw/ETag',
-                              output_dir: str='../data/raw/unzip_ETag') -> None:
-    '''
-    依據輸入的日期清單，將原始儲存的.xml.gz解壓縮到指定的資料夾下，結構上還是會依據日期再分子資料夾
-    '''
-    # 這邊先以每天的VD相關資料解壓縮進行處理
-    decompress_procedure_datefolder(date_list,
-                                    input_zip_dir,
-                                    output_dir)
-
-def decompress_procedure_direct(date_list: list[str],
-                                input_zip_dir: str,
-                                output_dir: str) -> None:
-    '''
-    提供etag gantry vol, speed, travel time 資料解壓縮使用的流程
-    因為上述3種在資料下載時是沒有分資料夾的
-    '''
-    for date in tqdm(date_list):
-        for file_name in os.listdir(input_zip_dir):
-            if file_name.endswith(f'{date}.tar.gz'):
-                gz_file_path = os.path.join(input_zip_dir, file_name)
-                try:
-                    ensure_directory_exists(output_dir)
-                    extract_tar_gz(gz_file_path, output_dir)
-                except:
-                    print(f"Unzipped {gz_file_path} to {output_dir} ran into error!!!")
-
-def decompress_etag_vol_data(date_list: list[str],
-                             input_zip_dir: str='../data/raw/ETag_gantry_vol',
-                             output_dir: str='../data/raw/unzip_etag_gantry_vol') -> None:
-    '''
-    依據輸入的日期清單，將原始儲存的M03A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
-    '''
-    decompress_procedure_direct(date_list, 
-                                input_zip_dir, 
-                                output_dir)
-    
-def decompress_etag_speed_data(date_list: list[str],
-                               input_zip_dir: str='../data/raw/ETag_intergantry_speed',
-                               output_dir: str='../data/raw/unzip_etag_intergantry_speed') -> None:
-    '''
-    依據輸入的日期清單，將原始儲存的M05A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
-    '''
-    decompress_procedure_direct(date_list, 
-                                input_zip_dir, 
-                                output_dir)
-
-
-def decompress_etag_intergantry_traveltime_data(date_list: list[str],
-                                                input_zip_dir: str='../data/raw/ETag_intergantry_traveltime',
-                                                output_dir: str='../data/raw/unzip_etag_intergantry_traveltime') -> None:
-    '''
-    依據輸入的日期清單，將原始儲存的M04A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
-    '''
-    decompress_procedure_direct(date_list, 
-                                input_zip_dir, 
-                                output_dir)
- 
-# 資料庫互動用的工具
-class DatabaseManager:
-    def __init__(self, db_path: str, table_name: str) -> None:
-        """
-        Initializes the DatabaseManager with a specified database path and table name.
-
-        Parameters:
-        - db_path: Path to the SQLite database file.
-        - table_name: The name of the table to manage.
-        """
-        self.db_path = db_path
-        self.table_name = table_name
-
-    def initialize_table(self, columns_in_order: str) -> None:
-        """
-        Initializes a new table in the SQLite database.
-
-        Parameters:
-        - columns_in_order: String representing the columns definition 
-                            (e.g., "id INTEGER PRIMARY KEY, name TEXT").
-        """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        
-        cur.execute(f'''CREATE TABLE IF NOT EXISTS {self.table_name}({columns_in_order})''')
-        con.commit()
-        con.close()
-
-    def delete_table_data(self) -> None:
-        """
-        Deletes all data from the table.
-        """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-        cur.execute(f'''DELETE FROM {self.table_name}''')
-        con.commit()
-        con.close()
-
-    def append_data(self, df: pd.DataFrame) -> None:
-        """
-        Appends a DataFrame to the table in the SQLite database.
-
-        Parameters
-        ----------
-        df: A pandas DataFrame containing the data to append.
-        """
-        con = sqlite3.connect(self.db_path)
-        df.to_sql(self.table_name, con, index=False, if_exists='append')
-        con.close()
-
-    def update_data(self, 
-                    df: pd.DataFrame, 
-                    key_columns: list) -> None:
-        """
-        Updates the table with new data. If a record with matching key_columns exists,
-        it updates the row; otherwise, it inserts the row as new data.
-
-        Parameters:
-        - df: A pandas DataFrame containing the data to update.
-        - key_columns: List of column names that form the unique key for identifying records.
-        """
-        con = sqlite3.connect(self.db_path)
-        cur = con.cursor()
-
-        for _, row in df.iterrows():
-            # Convert unsupported types (e.g., datetime) to string
-            row = row.apply(lambda x: str(x) if isinstance(x, pd.Timestamp) else x)
-            
-            # Build the WHERE clause based on the key columns
-            where_clause = ' AND '.join([f"{col} = ?" for col in key_columns])
-            key_values = [row[col] for col in key_columns]
-            
-            # Check if a record exists with the specified key columns
-            cur.execute(f"SELECT 1 FROM {self.table_name} WHERE {where_clause}", key_values)
-            exists = cur.fetchone()
-            
-            if exists:
-                # If record exists, update the row
-                update_clause = ', '.join([f"{col} = ?" for col in df.columns if col not in key_columns])
-                update_values = [row[col] for col in df.columns if col not in key_columns]
-                cur.execute(f"UPDATE {self.table_name} SET {update_clause} WHERE {where_clause}", update_values + key_values)
-            else:
-                # If record doesn't exist, insert the row
-                placeholders = ', '.join(['?' for _ in df.columns])
-                cur.execute(f"INSERT INTO {self.table_name} ({', '.join(df.columns)}) VALUES ({placeholders})", row.values)
-        
-        con.commit()
-        con.close()
-
-   
-def strip_ns_prefix(tree):
-    for elem in tree.getiterator():
-        if not hasattr(elem.tag, 'find'):
-            continue
-        i = elem.tag.find('}')
-        if i >= 0:
-            elem.tag = elem.tag[i+1:]
-
-def xml_to_dict(element):
-    if len(element) == 0:  # if element is a leaf node
-        return element.text
-    result = {}
-    for child in element:
-        child_result = xml_to_dict(child)
-        if child.tag not in result:
-            result[child.tag] = child_result
-        else:
-            if not isinstance(result[child.tag], list):
-                result[child.tag] = [result[child.tag]]
-            result[child.tag].append(child_result)
-    return result
-
-def convert_xml_to_dict(xml_file_path):
-    # 解析XML文件
-    parser = etree.XMLParser(remove_blank_text=True)
-    tree = etree.parse(xml_file_path, parser)
-    root = tree.getroot()
-
-    # 移除命名空間
-    strip_ns_prefix(tree)
-    
-    # Convert the XML to a dictionary
-    data_dict = {root.tag: xml_to_dict(root)}
-    return data_dict
-
-
-# 這段會因每種檔案不同要改寫
-def vd_static_dict_to_df(vd_static_dict):
-    # extract shared columns
-    shared_cols = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion']
-    shared_info = {key: vd_static_dict['VDList'][key] for key in shared_cols}
-    
-    # dict to df, append shared columns
-    df = pd.json_normalize(vd_static_dict['VDList']['VDs']['VD'])
-    for key in shared_info.keys():
-        df[key] = shared_info[key]
-    
-    df.rename(columns={'DetectionLinks.DetectionLink.LinkID': 'LinkID',
-                   'DetectionLinks.DetectionLink.Bearing': 'Bearing',
-                   'DetectionLinks.DetectionLink.RoadDirection': 'RoadDirection',
-                   'DetectionLinks.DetectionLink.LaneNum': 'Lane',
-                   'DetectionLinks.DetectionLink.ActualLaneNum': 'ActualLaneNum', 
-                   'RoadSection.Start': 'Start',
-                   'RoadSection.End': 'End'
-                  }, inplace=True)
-
-    df['UpdateTime'] = pd.to_datetime(df['UpdateTime'])
-    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'SubAuthorityCode', 
-         'BiDirectional', 'LinkID', 'Bearing', 'RoadDirection', 'Lane',
-         'ActualLaneNum', 'VDType', 'LocationType', 'DetectionType', 'PositionLon',
-         'PositionLat', 'RoadID', 'RoadName', 'RoadClass', 'Start', 
-         'End', 'LocationMile']]
-    return df
-
-# 這段會因每種檔案不同要改寫
-def vd_dynamic_dict_to_df(vd_dynamic_dict):
-    # extract shared columns
-    shared_cols = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion']
-    shared_info = {key: vd_dynamic_dict['VDLiveList'][key] for key in shared_cols}
-    
-    # dict to df, append shared columns
-
-    # 這邊結構很醜，沒有chatgpt幫忙要花很長時間去解
-    df = pd.json_normalize(
-        vd_dynamic_dict['VDLiveList']['VDLives']['VDLive'],
-        record_path=['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Vehicles', 'Vehicle'],
-        meta=[
-            'VDID', 'Status', 'DataCollectTime',
-            ['LinkFlows', 'LinkFlow', 'LinkID'],
-            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'LaneID'],
-            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'LaneType'],
-            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Speed'],
-            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Occupancy']
-        ],
-        meta_prefix='meta_',
-        record_prefix='vehicle_'
-    )
-    
-    # Rename columns for better readability
-    df.columns = df.columns.str.replace('meta_LinkFlows.LinkFlow.Lanes.Lane.', 'lane_')
-    df.columns = df.columns.str.replace('meta_LinkFlows.LinkFlow.', 'link_')
-    df.columns = df.columns.str.replace('meta_', '')
-    
-    df.rename(columns = {'vehicle_VehicleType': 'VehicleType', 
-                         'vehicle_Volume': 'Volume', 
-                         'vehicle_Speed': 'Speed2',
-                         'link_LinkID': 'LinkID', 
-                         'lane_LaneID': 'LaneID',
-                         'lane_LaneType': 'LaneType', 
-                         'lane_Speed': 'Speed', 
-                         'lane_Occupancy': 'Occupancy'}, inplace=True)
-        
-    for key in shared_info.keys():
-        df[key] = shared_info[key]
-
-    df['UpdateTime'] = pd.to_datetime(df['UpdateTime'])
-    df['DataCollectTime'] = pd.to_datetime(df['DataCollectTime'])
-    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'LinkID', 
-         'LaneID', 'LaneType', 'Speed', 'Occupancy', 'VehicleType',
-         'Volume', 'Speed2', 'Status', 'DataCollectTime']]
-    return df
-
-# 這段會因每種檔案不同要改寫
-def etag_static_dict_to_df(etag_static_dict):
-    # Flatten the nested structure
-    df = pd.json_normalize(
-        etag_static_dict['ETagList']['ETags']['ETag'],
-        sep='_'
-    )
-    
-    # Add metadata fields to the DataFrame
-    df['UpdateTime'] = etag_static_dict['ETagList']['UpdateTime']
-    df['UpdateInterval'] = etag_static_dict['ETagList']['UpdateInterval']
-    df['AuthorityCode'] = etag_static_dict['ETagList']['AuthorityCode']
-    df['LinkVersion'] = etag_static_dict['ETagList']['LinkVersion']
-    
-    df.rename(columns={'RoadSection_Start': 'Start',
-                       'RoadSection_End': 'End'}, inplace=True)
-    
-    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion',
-             'ETagGantryID', 'LinkID', 'LocationType', 'PositionLon', 'PositionLat',
-             'RoadID', 'RoadName', 'RoadClass', 'RoadDirection', 'Start', 
-             'End', 'LocationMile']]
-    return df
-
-# 這段會因每種檔案不同要改寫
-def etagpair_dict_to_df(etagpair_dict):
-    # Flatten the nested structure
-    df = pd.json_normalize(
-        etagpair_dict['ETagPairList']['ETagPairs']['ETagPair'],
-        sep='_'
-    )
-    
-    # Add metadata fields to the DataFrame
-    df['UpdateTime'] = etagpair_dict['ETagPairList']['UpdateTime']
-    df['UpdateInterval'] = etagpair_dict['ETagPairList']['UpdateInterval']
-    df['AuthorityCode'] = etagpair_dict['ETagPairList']['AuthorityCode']
-    df['LinkVersion'] = etagpair_dict['ETagPairList']['LinkVersion']
-    
-    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagGantryID', 
-             'EndETagGantryID', 'Description', 'Distance', 'StartLinkID', 'EndLinkID', 
-             'Geometry']]
-    return df
-
-# 這段會因每種檔案不同要改寫
-def etagpairlive_dict_to_df(etagpair_dict):
-    # Flatten the nested structure
-    df = pd.json_normalize(
-        etagpair_dict['ETagPairLiveList']['ETagPairLives']['ETagPairLive'],
-        record_path=['Flows', 'Flow'],
-        meta=[
-            'ETagPairID', 'StartETagStatus', 'EndETagStatus', 'StartTime', 'EndTime', 'DataCollectTime'
-        ],
-        meta_prefix='meta_',
-        record_prefix='flow_'
-    )
-    
-    # Add metadata fields from the root level to the DataFrame
-    df['UpdateTime'] = etagpair_dict['ETagPairLiveList']['UpdateTime']
-    df['UpdateInterval'] = etagpair_dict['ETagPairLiveList']['UpdateInterval']
-    df['AuthorityCode'] = etagpair_dict['ETagPairLiveList']['AuthorityCode']
-   
-    df.rename(columns={'flow_VehicleType':'VehicleType',
-                       'flow_TravelTime':'TravelTime',
-                       'flow_StandardDeviation':'StandardDeviation',
-                       'flow_SpaceMeanSpeed':'SpaceMeanSpeed',
-                       'flow_VehicleCount':'VehicleCount', 
-                       'meta_ETagPairID':'ETagPairID',
-                       'meta_StartETagStatus':'StartETagStatus',
-                       'meta_EndETagStatus':'EndETagStatus', 
-                       'meta_StartTime':'StartTime',
-                       'meta_EndTime':'EndTime', 
-                       'meta_DataCollectTime':'DataCollectTime'}, inplace=True)
-    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagStatus', 
-             'EndETagStatus', 'VehicleType', 'TravelTime', 'StandardDeviation', 'SpaceMeanSpeed', 
-             'VehicleCount', 'StartTime', 'EndTime', 'DataCollectTime']]
-    time_cols = ['UpdateTime', 'StartTime', 'EndTime', 'DataCollectTime']
-    for col in time_cols:
-        df[col]=pd.to_datetime(df[col])
-    return df
-
-def generate_daterange_combinations(start_year: int, 
-                                    start_month: int, 
-                                    end_year: int, 
-                                    end_month: int) -> list[list[str]]:
-    '''
-    根據輸入的起訖年、月來組成一個list of list，list中會以年月為基本單位去包裝每個月的頭尾，方便後續使用
-
-    Parameters
-    ----------
-    start_year: int
-    start_month: int
-    end_year: int
-    end_month: int
-    
-    Return
-    ------
-    list: 
-    '''
-    date_combinations = []
-    start_date = pd.Timestamp(start_year, start_month, 1)
-    end_date = pd.Timestamp(end_year, end_month, 1) + pd.offsets.MonthEnd(1)
-    
-    current_date = start_date
-    while current_date <= end_date:
-        start_of_month = current_date.strftime('%Y%m%d')
-        end_of_month = (current_date + pd.offsets.MonthEnd(1)).strftime('%Y%m%d')
-        date_combinations.append([start_of_month, end_of_month])
-        current_date += pd.offsets.MonthBegin(1)
-        
-    return date_combinations
\ No newline at end of file
+from lxml import etree
+import pandas as pd
+from tqdm import tqdm
+import json
+import gzip
+import io
+import shutil
+import os
+import re
+import tarfile
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from . import data_scraper as ds
+
+
+def unzip_file(gz_path, xml_path):
+    '''
+    gz_path file unzip to xml_path using copyfile
+    '''
+    with gzip.open(gz_path, 'rb') as f_in:
+        with open(xml_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+def ensure_directory_exists(path):
+    '''
+    make sure there is a folder exists, if not create one
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+def extract_tar_gz(tar_gz_path, extract_path):
+    '''
+    Extract a .tar.gz file to a specified directory
+    '''
+    with tarfile.open(tar_gz_path, 'r:gz') as tar:
+        tar.extractall(path=extract_path)
+
+def gzip_isize(gz_path: str) -> int:
+    '''
+    讀取 gzip 檔尾的 ISIZE 欄位，即解壓後的大小 (mod 2**32)，不需要真的解壓
+    '''
+    with open(gz_path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), 'little')
+
+def is_unzip_up_to_date(gz_path: str, xml_path: str) -> bool:
+    '''
+    解壓後的檔案已存在、比 .gz 新，且大小與 gzip ISIZE 相符時視為不需重做
+    '''
+    if not os.path.exists(xml_path):
+        return False
+    if os.path.getmtime(xml_path) < os.path.getmtime(gz_path):
+        return False
+    return os.path.getsize(xml_path) % 2**32 == gzip_isize(gz_path)
+
+def _unzip_task(task: tuple) -> tuple:
+    '''
+    process pool 的 worker，解壓單一 .gz，先寫到暫存檔再 rename，中斷時不會留下不完整的輸出
+    回傳 (date, status, bytes_in, bytes_out, elapsed_sec, error)，status 為 'done', 'skipped', 'failed'
+    '''
+    date, gz_file_path, xml_file_path, force = task
+    start = time.time()
+    try:
+        bytes_in = os.path.getsize(gz_file_path)
+        if not force and is_unzip_up_to_date(gz_file_path, xml_file_path):
+            return date, 'skipped', bytes_in, os.path.getsize(xml_file_path), time.time() - start, None
+        ensure_directory_exists(os.path.dirname(xml_file_path))
+        tmp_path = f'{xml_file_path}.{os.getpid()}.tmp'
+        try:
+            unzip_file(gz_file_path, tmp_path)
+            os.replace(tmp_path, xml_file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return date, 'done', bytes_in, os.path.getsize(xml_file_path), time.time() - start, None
+    except Exception as e:
+        return date, 'failed', 0, 0, time.time() - start, f'{gz_file_path}: {e!r}'
+
+def decompress_procedure_datefolder(date_list: list[str],
+                                    input_zip_dir: str,
+                                    output_dir: str,
+                                    max_workers: int=None,
+                                    force: bool=False) -> pd.DataFrame:
+    '''
+    提供vd, etag info 資料解壓縮使用的流程
+    因為上述兩種在資料下載時都是依據日期資料夾分拆擺放
+    所有日期的檔案一起丟進 process pool 平行解壓，已經解壓且未變動的檔案會跳過，重複執行幾乎沒有成本
+
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    input_zip_dir: str
+        原始 .xml.gz 的上層路徑，例如 '../data/raw/VD'
+    output_dir: str
+        解壓後的上層路徑，會再依日期分子資料夾
+    max_workers: int
+        解壓用的 process 數，預設為 cpu 數
+    force: bool
+        True 時不檢查是否已解壓，全部重做
+
+    Return
+    ------
+    pd.DataFrame: 每個日期的 files, skipped, failed, bytes_in, bytes_out, elapsed_sec (各檔案處理時間加總)
+    '''
+    tasks = []
+    for date in date_list:
+        input_dir = f'{input_zip_dir}/{date}'
+        if not os.path.isdir(input_dir):
+            print(f'{input_dir} 不存在，先跳過')
+            continue
+        date_output_dir = f'{output_dir}/{date}'
+        for file_name in sorted(os.listdir(input_dir)):
+            if file_name.endswith('.gz'):
+                tasks.append((date, 
+                              os.path.join(input_dir, file_name), 
+                              os.path.join(date_output_dir, file_name.replace('.gz', '')), 
+                              force))
+
+    columns = ['files', 'skipped', 'failed', 'bytes_in', 'bytes_out', 'elapsed_sec']
+    report = {date: dict.fromkeys(columns, 0) for date in sorted({task[0] for task in tasks})}
+    errors = []
+    start = time.time()
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(_unzip_task, tasks, chunksize=max(1, len(tasks) // (max_workers * 16)))
+        for date, status, bytes_in, bytes_out, elapsed, error in tqdm(results, total=len(tasks)):
+            row = report[date]
+            row['files'] += 1
+            row['skipped'] += status == 'skipped'
+            row['failed'] += status == 'failed'
+            row['bytes_in'] += bytes_in
+            row['bytes_out'] += bytes_out
+            row['elapsed_sec'] += elapsed
+            if error is not None:
+                errors.append(error)
+    for error in errors:
+        print(f'Unzipped {error} ran into error!!!')
+
+    report = pd.DataFrame.from_dict(report, orient='index', columns=columns).rename_axis('date').reset_index()
+    report['elapsed_sec'] = report['elapsed_sec'].round(3)
+    print(f"Decompressed {int(report['files'].sum() - report['skipped'].sum() - report['failed'].sum())} files, "
+          f"skipped {int(report['skipped'].sum())}, failed {int(report['failed'].sum())}, "
+          f"{report['bytes_in'].sum() / 2**20:.1f} MB -> {report['bytes_out'].sum() / 2**20:.1f} MB "
+          f"in {time.time() - start:.1f} s")
+    return report
+
+
+def decompress_vd_data(date_list: list[str],
+                       input_zip_dir: str='../data/raw/VD',
+                       output_dir: str='../data/raw/unzip_VD',
+                       max_workers: int=None,
+                       force: bool=False) -> pd.DataFrame:
+    '''
+    依據輸入的日期清單，將原始儲存的VD.xml.gz解壓縮到指定的資料夾下，結構上還是會依據日期再分子資料夾
+    已解壓且未變動的檔案會跳過，回傳每個日期的解壓統計，參數說明見 decompress_procedure_datefolder
+    '''
+    # 這邊先以每天的VD相關資料解壓縮進行處理
+    return decompress_procedure_datefolder(date_list,
+                                           input_zip_dir,
+                                           output_dir,
+                                           max_workers=max_workers,
+                                           force=force)
+
+def decompress_etag_info_data(date_list: list[str],
+                              input_zip_dir: str='../data/raw/ETag',
+                              output_dir: str='../data/raw/unzip_ETag',
+                              max_workers: int=None,
+                              force: bool=False) -> pd.DataFrame:
+    '''
+    依據輸入的日期清單，將原始儲存的.xml.gz解壓縮到指定的資料夾下，結構上還是會依據日期再分子資料夾
+    已解壓且未變動的檔案會跳過，回傳每個日期的解壓統計，參數說明見 decompress_procedure_datefolder
+    '''
+    # 這邊先以每天的VD相關資料解壓縮進行處理
+    return decompress_procedure_datefolder(date_list,
+                                           input_zip_dir,
+                                           output_dir,
+                                           max_workers=max_workers,
+                                           force=force)
+
+def decompress_procedure_direct(date_list: list[str],
+                                input_zip_dir: str,
+                                output_dir: str) -> None:
+    '''
+    提供etag gantry vol, speed, travel time 資料解壓縮使用的流程
+    因為上述3種在資料下載時是沒有分資料夾的
+    每天會解出 288 個小 csv，只需要寫入資料庫時請改用 ingest_tdcs_archives 直接讀 tar.gz，這裡保留給需要檢視原始 csv 的除錯用途
+    '''
+    for date in tqdm(date_list):
+        for file_name in os.listdir(input_zip_dir):
+            if file_name.endswith(f'{date}.tar.gz'):
+                gz_file_path = os.path.join(input_zip_dir, file_name)
+                try:
+                    ensure_directory_exists(output_dir)
+                    extract_tar_gz(gz_file_path, output_dir)
+                except:
+                    print(f"Unzipped {gz_file_path} to {output_dir} ran into error!!!")
+
+def decompress_etag_vol_data(date_list: list[str],
+                             input_zip_dir: str='../data/raw/ETag_gantry_vol',
+                             output_dir: str='../data/raw/unzip_etag_gantry_vol') -> None:
+    '''
+    依據輸入的日期清單，將原始儲存的M03A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
+    寫入資料庫不需要先解壓，請用 ingest_tdcs_archives，解壓只在需要檢視原始 csv 時使用
+    '''
+    decompress_procedure_direct(date_list, 
+                                input_zip_dir, 
+                                output_dir)
+    
+def decompress_etag_speed_data(date_list: list[str],
+                               input_zip_dir: str='../data/raw/ETag_intergantry_speed',
+                               output_dir: str='../data/raw/unzip_etag_intergantry_speed') -> None:
+    '''
+    依據輸入的日期清單，將原始儲存的M05A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
+    寫入資料庫不需要先解壓，請用 ingest_tdcs_archives，解壓只在需要檢視原始 csv 時使用
+    '''
+    decompress_procedure_direct(date_list, 
+                                input_zip_dir, 
+                                output_dir)
+
+
+def decompress_etag_intergantry_traveltime_data(date_list: list[str],
+                                                input_zip_dir: str='../data/raw/ETag_intergantry_traveltime',
+                                                output_dir: str='../data/raw/unzip_etag_intergantry_traveltime') -> None:
+    '''
+    依據輸入的日期清單，將原始儲存的M04A_YYYYMMDD.tar解壓縮到指定的資料夾下，壓縮檔中已經包含了日期與小時的分層子資料夾結構
+    寫入資料庫不需要先解壓，請用 ingest_tdcs_archives，解壓只在需要檢視原始 csv 時使用
+    '''
+    decompress_procedure_direct(date_list, 
+                                input_zip_dir, 
+                                output_dir)
+ 
+# 資料庫互動用的工具
+# 每個連線開啟時只套用 DEFAULT_PRAGMAS，都是連線本身的設定，不會改變資料庫檔案；cache_size 為負數時單位是 KiB
+DEFAULT_PRAGMAS = {'cache_size': -65536,
+                   'temp_store': 'MEMORY'}
+# 第一次寫入 (initialize_table, append_data, bulk_load, update_data...) 前才套用，讀取用的連線不受影響
+WRITE_PRAGMAS = {'cache_size': -262144}
+# wal=True 時寫入前另外套用：WAL 讓讀取與寫入可以同時進行，synchronous=NORMAL 在 WAL 下只在 checkpoint 時 fsync
+# journal_mode 會寫進資料庫檔案，之後所有連線都會使用 WAL，所以需要明確指定
+WAL_PRAGMAS = {'journal_mode': 'WAL',
+               'synchronous': 'NORMAL'}
+
+class DatabaseManager:
+    def __init__(self, 
+                 db_path: str, 
+                 table_name: str,
+                 pragmas: dict=None,
+                 schema: str=None,
+                 wal: bool=False) -> None:
+        """
+        Initializes the DatabaseManager with a specified database path and table name.
+        The sqlite3 connection is opened on first use and reused by every method until close();
+        the manager can also be used as a context manager. The connection belongs to the thread
+        that first uses it, so give each thread its own manager.
+
+        Parameters:
+        - db_path: Path to the SQLite database file.
+        - table_name: The name of the table to manage.
+        - pragmas: PRAGMA settings merged over DEFAULT_PRAGMAS (on open) and WRITE_PRAGMAS / WAL_PRAGMAS
+                   (before the first write), e.g. {'mmap_size': 2**28}; a value of None skips that pragma.
+        - schema: Key of TABLE_SCHEMAS (e.g. 'M04A', 'VD_DYNAMIC'). When given, initialize_table() creates
+                  typed columns and indexes, and time columns are written as integer epoch seconds.
+        - wal: Switch the database file to WAL journaling (with synchronous=NORMAL) before the first write,
+               so readers are not blocked by a long bulk load. Read-only use never changes the journal mode.
+        """
+        self.db_path = db_path
+        self.table_name = table_name
+        self.schema = schema
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.write_pragmas = {**WRITE_PRAGMAS, **(WAL_PRAGMAS if wal else {}), **(pragmas or {})}
+        self._con = None
+        self._write_ready = False
+        self._insert_sql = {}
+        self._rollup_range = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        The long-lived connection, opened lazily with the read pragmas.
+        """
+        if self._con is None:
+            self._con = sqlite3.connect(self.db_path)
+            self._write_ready = False
+            self._apply_pragmas(self.pragmas)
+        return self._con
+
+    def _apply_pragmas(self, pragmas: dict) -> None:
+        for key, value in pragmas.items():
+            if value is not None:
+                self._con.execute(f'PRAGMA {key} = {value}')
+
+    def _writer(self) -> sqlite3.Connection:
+        """
+        The connection, with the write pragmas applied before its first write.
+        """
+        con = self.connection
+        if not self._write_ready:
+            # journal_mode 不能在 transaction 中切換，所以在第一次寫入前設定
+            self._apply_pragmas(self.write_pragmas)
+            self._write_ready = True
+        return con
+
+    def close(self) -> None:
+        """
+        Commits pending work and closes the connection; it is reopened on the next call.
+        M04A rollups covering the rows written through this manager are refreshed afterwards.
+        """
+        if self._con is not None:
+            self._con.commit()
+            self._con.close()
+            self._con = None
+        self.refresh_rollups()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            if self._con is not None:
+                self._con.rollback()
+            self._rollup_range = None
+        self.close()
+
+    def _track_rollup(self, df: pd.DataFrame) -> None:
+        """
+        For M04A tables, records the TimeStamp range of df in the rollup pending table inside the current
+        transaction (so it is committed together with the rows) and widens the range refresh_rollups() recomputes.
+        """
+        pending = rollup_pending_frame(df, self.schema)
+        if pending is None:
+            return
+        con = self._writer()
+        table_name = rollup_pending_table_name('sqlite')
+        con.execute(f"CREATE TABLE IF NOT EXISTS {table_name}({schema_columns_sql('M04A_ROLLUP_PENDING')})")
+        con.execute(f'INSERT INTO {table_name} (Start, End) VALUES (?, ?)',
+                    tuple(int(value) for value in encode_timestamp(pending.iloc[0])))
+        self._rollup_range = merge_time_range(self._rollup_range, pending.iloc[0])
+
+    def refresh_rollups(self) -> dict:
+        """
+        Recomputes the M04A rollup buckets touched by the rows written (and committed) through this manager.
+        Called after each bulk-load commit and on close(); returns update_traveltime_rollups' counts.
+        """
+        if self._rollup_range is None:
+            return {}
+        (start, end), self._rollup_range = self._rollup_range, None
+        return update_traveltime_rollups(self.db_path, start, end, backend='sqlite')
+
+    def table_exists(self) -> bool:
+        """
+        Whether the managed table exists in the database.
+        """
+        row = self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", 
+                                      (self.table_name,)).fetchone()
+        return row is not None
+
+    def initialize_table(self, columns_in_order: str=None) -> None:
+        """
+        Initializes a new table in the SQLite database.
+
+        Parameters:
+        - columns_in_order: String representing the columns definition 
+                            (e.g., "id INTEGER PRIMARY KEY, name TEXT").
+                            Defaults to the typed columns of the schema, whose indexes are created too.
+        """
+        if columns_in_order is None:
+            columns_in_order = schema_columns_sql(self.schema)
+        with self._writer() as con:
+            con.execute(f'''CREATE TABLE IF NOT EXISTS {self.table_name}({columns_in_order})''')
+        if self.schema is not None:
+            self.create_indexes()
+
+    def create_indexes(self) -> list:
+        """
+        Creates (if missing) the secondary indexes defined in the schema.
+
+        Returns:
+        - The index names.
+        """
+        index_names = []
+        if self.schema is None:
+            return index_names
+        with self._writer() as con:
+            for columns in TABLE_SCHEMAS[self.schema]['indexes']:
+                index_name = f"ix_{self.table_name}_{'_'.join(columns)}"
+                con.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {self.table_name} ({', '.join(columns)})")
+                index_names.append(index_name)
+        return index_names
+
+    def prepare_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Encodes the schema's time columns as integer epoch seconds; returns df unchanged without a schema.
+        """
+        if self.schema is None:
+            return df
+        time_columns = [col for col in TABLE_SCHEMAS[self.schema]['time_columns'] if col in df.columns]
+        if not time_columns:
+            return df
+        df = df.copy()
+        for col in time_columns:
+            df[col] = encode_timestamp(df[col])
+        return df
+
+    def delete_table_data(self) -> None:
+        """
+        Deletes all data from the table.
+        """
+        with self._writer() as con:
+            con.execute(f'''DELETE FROM {self.table_name}''')
+
+    def append_data(self, df: pd.DataFrame) -> None:
+        """
+        Appends a DataFrame to the table in the SQLite database.
+
+        Parameters
+        ----------
+        df: A pandas DataFrame containing the data to append.
+        """
+        if self.schema is not None and not self.table_exists():
+            self.initialize_table()
+        # to_sql 會 commit，pending 紀錄與資料一起寫入
+        self._track_rollup(df)
+        self.prepare_df(df).to_sql(self.table_name, self._writer(), index=False, if_exists='append')
+
+    def bulk_load(self, 
+                  commit_rows: int=500_000, 
+                  commit_seconds: float=30.0) -> 'BulkLoadSession':
+        """
+        Opens a bulk-load session: DataFrames passed to session.add() are inserted into the table
+        right away but only committed every commit_rows rows or commit_seconds seconds (and on exit),
+        so many small frames share one transaction instead of one fsync each.
+
+        Parameters:
+        - commit_rows: Commit after this many rows have been added since the last commit.
+        - commit_seconds: Commit when this many seconds have passed since the last commit.
+
+        Example:
+            with DatabaseManager(db_path, 'ETAG_M04A_202401') as tb, tb.bulk_load() as session:
+                for df in frames:
+                    session.add(df)
+        """
+        return BulkLoadSession(self, commit_rows, commit_seconds)
+
+    def _insert_batch(self, df: pd.DataFrame) -> None:
+        """
+        Inserts df without committing (used by BulkLoadSession); creates the table on first use.
+        """
+        con = self._writer()
+        prepared = self.prepare_df(df)
+        columns = tuple(prepared.columns)
+        if columns not in self._insert_sql:
+            if self.schema is not None:
+                self.initialize_table()
+            elif not self.table_exists():
+                prepared.head(0).to_sql(self.table_name, con, index=False)
+            self._insert_sql[columns] = (f"INSERT INTO {self.table_name} ({', '.join(columns)}) "
+                                         f"VALUES ({', '.join(['?'] * len(columns))})")
+        # 建 table 會 commit，pending 紀錄在這之後才寫入，與資料同一個 transaction
+        self._track_rollup(df)
+        con.executemany(self._insert_sql[columns], df_to_sql_rows(prepared))
+
+    def _log_sources(self, entries: list) -> None:
+        '''
+        把 (date, file_name, rows) 寫入同一個資料庫的 INGEST_LOG，不 commit，與資料在同一個 transaction
+        '''
+        con = self._writer()
+        con.execute(f"CREATE TABLE IF NOT EXISTS {INGEST_LOG_TABLE}({schema_columns_sql('INGEST_LOG')})")
+        for columns in TABLE_SCHEMAS['INGEST_LOG']['indexes']:
+            con.execute(f"CREATE INDEX IF NOT EXISTS ix_{INGEST_LOG_TABLE}_{'_'.join(columns)} "
+                        f"ON {INGEST_LOG_TABLE} ({', '.join(columns)})")
+        log_df = ingest_log_frame(self.table_name, entries)
+        log_df['IngestedAt'] = encode_timestamp(log_df['IngestedAt'])
+        con.executemany(f"INSERT INTO {INGEST_LOG_TABLE} ({', '.join(log_df.columns)}) "
+                        f"VALUES ({', '.join(['?'] * len(log_df.columns))})", df_to_sql_rows(log_df))
+
+    def _commit_batch(self) -> None:
+        self.connection.commit()
+        self.refresh_rollups()
+
+    def _rollback_batch(self) -> None:
+        self.connection.rollback()
+
+    def _select(self, columns: list, start, end, filters: dict, time_column: str) -> tuple:
+        """
+        Builds the SELECT for read_data / iter_data, returns (sql, params, columns, decode),
+        decode being a function that turns fetched rows into a DataFrame.
+        """
+        declared = {row[1]: row[2] for row in self.connection.execute(f'PRAGMA table_info({self.table_name})')}
+        columns = list(columns or declared.keys())
+        time_column = time_column or schema_time_column(self.schema)
+        typed_time = {col for col, col_type in declared.items() if col_type == 'INTEGER' 
+                      and self.schema is not None and col in TABLE_SCHEMAS[self.schema]['time_columns']}
+        where, params = [], []
+        for op, bound in [('>=', start), ('<', end)]:
+            if bound is not None:
+                value = pd.Series([pd.Timestamp(bound)])
+                where.append(f'{time_column} {op} ?')
+                params.append(int(encode_timestamp(value).iloc[0]) if time_column in typed_time 
+                              else datetime_to_sql_text(value).iloc[0])
+        for col, values in (filters or {}).items():
+            values = list(values)
+            where.append(f"{col} IN ({', '.join(['?'] * len(values))})")
+            params.extend(values)
+        sql = f"SELECT {', '.join(columns)} FROM {self.table_name}"
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        def decode(rows):
+            df = pd.DataFrame.from_records(rows, columns=columns)
+            for col in df.columns:
+                if col in typed_time:
+                    df[col] = decode_timestamp(df[col])
+                elif col == time_column and self.schema is not None:
+                    df[col] = pd.to_datetime(df[col], format='ISO8601')
+            return df
+        return sql, params, columns, decode
+
+    def read_data(self, 
+                  columns: list=None, 
+                  start: str=None, 
+                  end: str=None, 
+                  filters: dict=None, 
+                  time_column: str=None,
+                  compact: bool=False) -> pd.DataFrame:
+        """
+        Reads the table with the time range, IN filters and column projection pushed into SQL.
+        Integer time columns of typed tables are decoded back to datetime.
+
+        Parameters:
+        - columns: Columns to read, all by default.
+        - start: Inclusive lower bound of time_column, e.g. '2023-01-01 06:00'.
+        - end: Exclusive upper bound of time_column.
+        - filters: {column: list of allowed values}, e.g. {'GantryFrom': ['05F0438N']}.
+        - time_column: Column used by start/end, defaults to the schema's main time column or 'TimeStamp'.
+        - compact: Apply compact_dtypes (categorical ids, small ints) to the result.
+        """
+        sql, params, columns, decode = self._select(columns, start, end, filters, time_column)
+        df = decode(self.connection.execute(sql, params).fetchall())
+        return compact_dtypes(df, self.schema) if compact else df
+
+    def iter_data(self, 
+                  chunksize: int=1_000_000,
+                  columns: list=None, 
+                  start: str=None, 
+                  end: str=None, 
+                  filters: dict=None, 
+                  time_column: str=None,
+                  compact: bool=True):
+        """
+        Same as read_data but yields DataFrames of at most chunksize rows, so peak memory is bounded
+        by the chunk size; chunks are dtype-compacted by default.
+        """
+        sql, params, columns, decode = self._select(columns, start, end, filters, time_column)
+        cursor = self.connection.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            df = decode(rows)
+            yield compact_dtypes(df, self.schema) if compact else df
+
+    def ensure_unique_index(self, 
+                            key_columns: list, 
+                            dedupe: bool=False) -> str:
+        """
+        Creates (if missing) a unique index over key_columns, which the bulk upsert relies on.
+
+        Parameters:
+        - key_columns: List of column names that form the unique key.
+        - dedupe: If True, duplicated keys already in the table are removed first 
+                  (the most recently inserted row is kept); otherwise an IntegrityError is raised.
+
+        Returns:
+        - The index name.
+        """
+        index_name = f"ux_{self.table_name}_{'_'.join(key_columns)}"
+        con = self._writer()
+        try:
+            with con:
+                if dedupe:
+                    con.execute(f"""DELETE FROM {self.table_name} WHERE rowid NOT IN 
+                                    (SELECT MAX(rowid) FROM {self.table_name} GROUP BY {', '.join(key_columns)})""")
+                con.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {self.table_name} ({', '.join(key_columns)})")
+        except sqlite3.IntegrityError as e:
+            raise sqlite3.IntegrityError(f'{self.table_name} has duplicated {key_columns}, '
+                                         f'call ensure_unique_index(..., dedupe=True) to remove them first') from e
+        return index_name
+
+    def update_data(self, 
+                    df: pd.DataFrame, 
+                    key_columns: list,
+                    dedupe: bool=False) -> dict:
+        """
+        Updates the table with new data. If a record with matching key_columns exists,
+        it updates the row; otherwise, it inserts the row as new data.
+
+        The rows are loaded into a temporary staging table with executemany and merged with a single
+        INSERT ... ON CONFLICT(key_columns) DO UPDATE inside one transaction, so millions of rows
+        per call are fine. A unique index over key_columns is created if it does not exist yet;
+        from then on append_data rejects rows whose key already exists in the table.
+
+        Parameters:
+        - df: A pandas DataFrame containing the data to update.
+        - key_columns: List of column names that form the unique key for identifying records.
+        - dedupe: Passed to ensure_unique_index for tables that already hold duplicated keys.
+
+        Returns:
+        - dict with the number of rows 'inserted' and 'updated'.
+        """
+        # 同一批資料中 key 重複時以最後一筆為準 (與逐筆 update 的結果相同)
+        df = df.drop_duplicates(subset=key_columns, keep='last')
+        if df.empty:
+            return {'inserted': 0, 'updated': 0}
+        self.ensure_unique_index(key_columns, dedupe=dedupe)
+        self._track_rollup(df)
+        df = self.prepare_df(df)
+
+        columns = ', '.join(df.columns)
+        key_clause = ', '.join(key_columns)
+        join_clause = ' AND '.join([f't.{col} IS s.{col}' for col in key_columns])
+        update_columns = [col for col in df.columns if col not in key_columns]
+        if update_columns:
+            conflict_clause = f"DO UPDATE SET {', '.join([f'{col} = excluded.{col}' for col in update_columns])}"
+        else:
+            conflict_clause = 'DO NOTHING'
+
+        with self._writer() as con:
+            con.execute('DROP TABLE IF EXISTS temp.upsert_staging')
+            con.execute(f'CREATE TEMP TABLE upsert_staging AS SELECT {columns} FROM {self.table_name} WHERE 0')
+            con.executemany(f"INSERT INTO temp.upsert_staging ({columns}) VALUES ({', '.join(['?'] * len(df.columns))})", 
+                            df_to_sql_rows(df))
+            updated = con.execute(f"""SELECT COUNT(*) FROM temp.upsert_staging s WHERE EXISTS 
+                                      (SELECT 1 FROM {self.table_name} t WHERE {join_clause})""").fetchone()[0]
+            # WHERE true 是 SQLite 在 INSERT ... SELECT 接 ON CONFLICT 時避免語法歧義的寫法
+            con.execute(f"""INSERT INTO {self.table_name} ({columns}) 
+                            SELECT {columns} FROM temp.upsert_staging WHERE true 
+                            ON CONFLICT({key_clause}) {conflict_clause}""")
+            con.execute('DROP TABLE temp.upsert_staging')
+        return {'inserted': len(df) - updated, 'updated': updated}
+
+
+def datetime_to_sql_text(series: pd.Series) -> pd.Series:
+    '''
+    時間欄位整欄轉成與 to_sql 相同的字串格式，'YYYY-MM-DD HH:MM:SS[.ffffff][+HH:MM]'
+    '''
+    fmt = '%Y-%m-%d %H:%M:%S'
+    if (series.dt.microsecond.fillna(0) != 0).any():
+        fmt += '.%f'
+    if series.dt.tz is not None:
+        text = series.dt.strftime(fmt + '%z')
+        text = text.str[:-2] + ':' + text.str[-2:]
+    else:
+        text = series.dt.strftime(fmt)
+    return text
+
+def df_to_sql_rows(df: pd.DataFrame):
+    '''
+    df 轉成 executemany 可用的 tuple iterator，逐欄轉成 python 物件 (不逐格判斷)，
+    時間欄位格式同 to_sql，缺值轉成 None
+    '''
+    columns = []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            series = datetime_to_sql_text(series)
+        has_na = series.isna().any()
+        values = series.tolist()
+        if has_na:
+            values = [None if pd.isna(v) else v for v in values]
+        columns.append(values)
+    return zip(*columns)
+
+class BulkLoadSession:
+    '''
+    bulk_load() 回傳的寫入 session，多個 df 共用一個 transaction (parquet 則是同一批檔案)，
+    每 commit_rows 筆或 commit_seconds 秒才 commit 一次，離開 with 時一定會 commit
+    實際寫入交給 manager 的 _insert_batch / _log_sources / _commit_batch / _rollback_batch，DatabaseManager 與 ParquetStoreManager 共用
+    '''
+    def __init__(self, 
+                 db_manager, 
+                 commit_rows: int=500_000, 
+                 commit_seconds: float=30.0) -> None:
+        self.db_manager = db_manager
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.rows = 0
+        self.commits = 0
+        self._pending_rows = 0
+        self._pending_sources = []
+        self._last_commit = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self._pending_sources = []
+            self.db_manager._rollback_batch()
+            return
+        self.commit()
+
+    def add(self, 
+            df: pd.DataFrame, 
+            source: tuple=None) -> None:
+        '''
+        寫入一個 df，table 不存在時依 schema 或 df 的欄位建立
+        source 為 (date, file_name) 時，在同一次 commit 把這個原始檔記錄到 INGEST_LOG (空的 df 也會記錄)
+        '''
+        if source is not None:
+            self._pending_sources.append((*source, len(df)))
+        if df.empty:
+            return
+        self.db_manager._insert_batch(df)
+        self.rows += len(df)
+        self._pending_rows += len(df)
+        if (self._pending_rows >= self.commit_rows 
+            or time.time() - self._last_commit >= self.commit_seconds):
+            self.commit()
+
+    def commit(self) -> None:
+        if self._pending_sources:
+            self.db_manager._log_sources(self._pending_sources)
+            self._pending_sources = []
+            self.db_manager._commit_batch()
+            self.commits += 1
+        elif self._pending_rows:
+            self.db_manager._commit_batch()
+            self.commits += 1
+        self._pending_rows = 0
+        self._last_commit = time.time()
+
+
+# ---------------------------------------------------------------------------
+# 各資料集的 table schema
+# 時間欄位一律存成整數：台灣當地時間 (Asia/Taipei) 的牆上時間距 1970-01-01 00:00 的秒數，
+# TDCS (無時區) 與 VD/ETag (+08:00) 的時間因此可以直接比較，也能用 BETWEEN 走索引
+# indexes 依 notebook 中實際的查詢條件設計，例如 GantryFrom in (...)、VDID == ...
+# ---------------------------------------------------------------------------
+TIME_ZONE = 'Asia/Taipei'
+
+_TDCS_PAIR_INDEXES = [('GantryFrom', 'GantryTo', 'TimeStamp'), ('TimeStamp',)]
+TABLE_SCHEMAS = {
+    'M03A': {'columns': [('TimeStamp', 'INTEGER'), ('GantryID', 'TEXT'), ('Direction', 'TEXT'),
+                         ('VehicleType', 'INTEGER'), ('Volume', 'INTEGER')],
+             'time_columns': ['TimeStamp'],
+             'indexes': [('GantryID', 'TimeStamp'), ('TimeStamp',)]},
+    'M04A': {'columns': [('TimeStamp', 'INTEGER'), ('GantryFrom', 'TEXT'), ('GantryTo', 'TEXT'),
+                         ('VehicleType', 'INTEGER'), ('TravelTime', 'INTEGER'), ('Traffic', 'INTEGER')],
+             'time_columns': ['TimeStamp'],
+             'indexes': _TDCS_PAIR_INDEXES},
+    'M05A': {'columns': [('TimeStamp', 'INTEGER'), ('GantryFrom', 'TEXT'), ('GantryTo', 'TEXT'),
+                         ('VehicleType', 'INTEGER'), ('Speed', 'INTEGER'), ('Volume', 'INTEGER')],
+             'time_columns': ['TimeStamp'],
+             'indexes': _TDCS_PAIR_INDEXES},
+    'VD_STATIC': {'columns': [('UpdateTime', 'INTEGER'), ('UpdateInterval', 'INTEGER'), ('AuthorityCode', 'TEXT'),
+                              ('VDID', 'TEXT'), ('SubAuthorityCode', 'TEXT'), ('BiDirectional', 'INTEGER'),
+                              ('LinkID', 'TEXT'), ('Bearing', 'TEXT'), ('RoadDirection', 'TEXT'), ('Lane', 'INTEGER'),
+                              ('ActualLaneNum', 'INTEGER'), ('VDType', 'INTEGER'), ('LocationType', 'INTEGER'),
+                              ('DetectionType', 'INTEGER'), ('PositionLon', 'REAL'), ('PositionLat', 'REAL'),
+                              ('RoadID', 'TEXT'), ('RoadName', 'TEXT'), ('RoadClass', 'INTEGER'), ('Start', 'TEXT'),
+                              ('End', 'TEXT'), ('LocationMile', 'TEXT')],
+                  'time_columns': ['UpdateTime'],
+                  'indexes': [('VDID', 'UpdateTime'), ('RoadName',)]},
+    'VD_DYNAMIC': {'columns': [('UpdateTime', 'INTEGER'), ('UpdateInterval', 'INTEGER'), ('AuthorityCode', 'TEXT'),
+                               ('VDID', 'TEXT'), ('LinkID', 'TEXT'), ('LaneID', 'INTEGER'), ('LaneType', 'INTEGER'),
+                               ('Speed', 'REAL'), ('Occupancy', 'REAL'), ('VehicleType', 'TEXT'), ('Volume', 'INTEGER'),
+                               ('Speed2', 'REAL'), ('Status', 'INTEGER'), ('DataCollectTime', 'INTEGER')],
+                   'time_columns': ['UpdateTime', 'DataCollectTime'],
+                   'indexes': [('VDID', 'DataCollectTime'), ('DataCollectTime',)]},
+    'ETAG_STATIC': {'columns': [('UpdateTime', 'INTEGER'), ('UpdateInterval', 'INTEGER'), ('AuthorityCode', 'TEXT'),
+                                ('LinkVersion', 'TEXT'), ('ETagGantryID', 'TEXT'), ('LinkID', 'TEXT'),
+                                ('LocationType', 'INTEGER'), ('PositionLon', 'REAL'), ('PositionLat', 'REAL'),
+                                ('RoadID', 'TEXT'), ('RoadName', 'TEXT'), ('RoadClass', 'INTEGER'),
+                                ('RoadDirection', 'TEXT'), ('Start', 'TEXT'), ('End', 'TEXT'), ('LocationMile', 'TEXT')],
+                    'time_columns': ['UpdateTime'],
+                    'indexes': [('ETagGantryID', 'UpdateTime'), ('RoadID', 'RoadDirection')]},
+    'ETAG_PAIR': {'columns': [('UpdateTime', 'INTEGER'), ('UpdateInterval', 'INTEGER'), ('AuthorityCode', 'TEXT'),
+                              ('ETagPairID', 'TEXT'), ('StartETagGantryID', 'TEXT'), ('EndETagGantryID', 'TEXT'),
+                              ('Description', 'TEXT'), ('Distance', 'REAL'), ('StartLinkID', 'TEXT'),
+                              ('EndLinkID', 'TEXT'), ('Geometry', 'TEXT')],
+                  'time_columns': ['UpdateTime'],
+                  'indexes': [('ETagPairID', 'UpdateTime'), ('StartETagGantryID',), ('EndETagGantryID',)]},
+    'ETAG_PAIR_LIVE': {'columns': [('UpdateTime', 'INTEGER'), ('UpdateInterval', 'INTEGER'), ('AuthorityCode', 'TEXT'),
+                                   ('ETagPairID', 'TEXT'), ('StartETagStatus', 'INTEGER'), ('EndETagStatus', 'INTEGER'),
+                                   ('VehicleType', 'INTEGER'), ('TravelTime', 'INTEGER'), ('StandardDeviation', 'REAL'),
+                                   ('SpaceMeanSpeed', 'INTEGER'), ('VehicleCount', 'INTEGER'), ('StartTime', 'INTEGER'),
+                                   ('EndTime', 'INTEGER'), ('DataCollectTime', 'INTEGER')],
+                       'time_columns': ['UpdateTime', 'StartTime', 'EndTime', 'DataCollectTime'],
+                       'indexes': [('ETagPairID', 'StartTime'), ('StartTime',)]},
+    # M04A 依門架對彙總的旅行時間 (ETAG_M04A_ROLLUP_15MIN 等)，(GantryFrom, GantryTo, TimeStamp) 的唯一索引由 update_data 建立
+    'M04A_ROLLUP': {'columns': [('TimeStamp', 'INTEGER'), ('GantryFrom', 'TEXT'), ('GantryTo', 'TEXT'),
+                                ('WeightedAvgTravelTime', 'REAL'), ('TotalTraffic', 'INTEGER')],
+                    'time_columns': ['TimeStamp'],
+                    'indexes': [('TimeStamp',)]},
+    # 已寫入 M04A 但彙總表還沒重算的時間範圍 [Start, End)，update_traveltime_rollups 重算後刪除
+    'M04A_ROLLUP_PENDING': {'columns': [('Start', 'INTEGER'), ('End', 'INTEGER')],
+                            'time_columns': ['Start', 'End'],
+                            'indexes': []},
+    # 已寫入的 VD/ETag 原始檔紀錄，由 BulkLoadSession.add(df, source=...) 寫入，供 find_missing_xml_files 比對
+    'INGEST_LOG': {'columns': [('IngestedAt', 'INTEGER'), ('TableName', 'TEXT'), ('Date', 'TEXT'),
+                               ('FileName', 'TEXT'), ('Rows', 'INTEGER')],
+                   'time_columns': ['IngestedAt'],
+                   'indexes': [('TableName', 'Date')]},
+}
+INGEST_LOG_TABLE = 'INGEST_LOG'
+
+def ingest_log_frame(table_name: str, entries: list) -> pd.DataFrame:
+    '''
+    (date, file_name, rows) 的清單轉成 INGEST_LOG 的 df，IngestedAt 為目前的台灣時間
+    '''
+    return pd.DataFrame({'IngestedAt': pd.Timestamp(ds.taipei_now()).floor('s'),
+                         'TableName': table_name,
+                         'Date': [entry[0] for entry in entries],
+                         'FileName': [entry[1] for entry in entries],
+                         'Rows': [entry[2] for entry in entries]},
+                        columns=['IngestedAt', 'TableName', 'Date', 'FileName', 'Rows'])
+
+def schema_for_table(table_name: str) -> str:
+    '''
+    由 table 名稱找對應的 schema，例如 'ETAG_M04A_202401' -> 'M04A'，找不到回傳 None
+    '''
+    if table_name in TABLE_SCHEMAS:
+        return table_name
+    if re.fullmatch(r'(ETAG_)?M04A_ROLLUP_\d+MIN', table_name):
+        return 'M04A_ROLLUP'
+    if re.fullmatch(r'(ETAG_)?M04A_ROLLUP_PENDING', table_name):
+        return 'M04A_ROLLUP_PENDING'
+    match = re.fullmatch(r'ETAG_(M0[345]A)_\d{6}', table_name)
+    return match.group(1) if match else None
+
+def schema_columns_sql(schema: str) -> str:
+    '''
+    schema 轉成 initialize_table 使用的欄位定義，例如 'TimeStamp INTEGER, GantryID TEXT, ...'
+    '''
+    return ', '.join([f'{col} {col_type}' for col, col_type in TABLE_SCHEMAS[schema]['columns']])
+
+def schema_time_column(schema: str=None) -> str:
+    '''
+    schema 中用來篩選時間區間與分區的主要時間欄位 (time_columns 的最後一個)，沒有 schema 時為 'TimeStamp'
+    '''
+    if schema is None:
+        return 'TimeStamp'
+    return TABLE_SCHEMAS[schema]['time_columns'][-1]
+
+def encode_timestamp(series: pd.Series) -> pd.Series:
+    '''
+    時間欄位 (datetime 或字串) 整欄轉成台灣時間的 epoch 秒數 (Int64)，缺值為 <NA>
+    '''
+    if not pd.api.types.is_datetime64_any_dtype(series):
+        series = pd.to_datetime(series, format='ISO8601')
+    if series.dt.tz is not None:
+        series = series.dt.tz_convert(TIME_ZONE).dt.tz_localize(None)
+    return ((series - pd.Timestamp('1970-01-01')) // pd.Timedelta(seconds=1)).astype('Int64')
+
+def decode_timestamp(series: pd.Series, tz_aware: bool=False) -> pd.Series:
+    '''
+    encode_timestamp 的反向，epoch 秒數轉回台灣時間的 datetime，tz_aware=True 時帶 +08:00 時區
+    '''
+    series = pd.to_datetime(series, unit='s').astype('datetime64[ns]')
+    return series.dt.tz_localize(TIME_ZONE) if tz_aware else series
+
+def decode_time_columns(df: pd.DataFrame, schema: str, tz_aware: bool=False) -> pd.DataFrame:
+    '''
+    從 typed table 讀出的 df，把 schema 中的時間欄位轉回 datetime
+    '''
+    for col in TABLE_SCHEMAS[schema]['time_columns']:
+        if col in df.columns and pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = decode_timestamp(df[col], tz_aware)
+    return df
+
+# 讀取時轉成 category 的代碼欄位 (重複值多、基數低)
+CATEGORY_COLUMNS = ['GantryFrom', 'GantryTo', 'GantryID', 'Direction', 'VDID', 'LinkID', 'ETagPairID', 
+                    'ETagGantryID', 'StartETagGantryID', 'EndETagGantryID', 'AuthorityCode', 'RoadDirection']
+
+def compact_dtypes(df: pd.DataFrame, 
+                   schema: str=None, 
+                   categorical: bool=True) -> pd.DataFrame:
+    '''
+    依 schema 縮小欄位型態：代碼欄位轉 category，TDCS 數值欄位用 TDCS_DTYPES 的小整數，
+    其他 INTEGER 欄位轉 Int32 (可有缺值)、REAL 轉 float32，時間欄位維持 datetime
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        要轉換的 df，會直接修改並回傳
+    schema: str
+        TABLE_SCHEMAS 中的 key，None 時只處理代碼欄位
+    categorical: bool
+        代碼欄位是否轉成 category
+    '''
+    dtypes = {}
+    if schema in TDCS_DTYPES:
+        dtypes.update({col: dtype for col, dtype in TDCS_DTYPES[schema].items() if dtype is not str})
+    elif schema is not None:
+        time_columns = TABLE_SCHEMAS[schema]['time_columns']
+        for col, col_type in TABLE_SCHEMAS[schema]['columns']:
+            if col in time_columns:
+                continue
+            if col_type == 'INTEGER':
+                dtypes[col] = 'Int32'
+            elif col_type == 'REAL':
+                dtypes[col] = 'float32'
+    for col, dtype in dtypes.items():
+        if col in df.columns and df[col].dtype != dtype:
+            values = df[col]
+            if values.dtype == object:
+                values = pd.to_numeric(values, errors='coerce')
+            df[col] = values.astype(dtype)
+    if categorical:
+        for col in CATEGORY_COLUMNS:
+            if col in df.columns and df[col].dtype == object:
+                df[col] = df[col].astype('category')
+    return df
+
+def iter_csv_chunks(csv_path: str, 
+                    schema: str='M04A', 
+                    chunksize: int=1_000_000, 
+                    categorical: bool=True):
+    '''
+    分段讀取有 header 的 csv (例如 hw5_m04a.csv)，每段 chunksize 筆
+    讀取時就指定數值型態、時間欄位以固定格式轉換，再依 schema 縮小型態
+
+    Parameters
+    ----------
+    csv_path: str
+        csv 路徑
+    schema: str
+        TABLE_SCHEMAS 中的 key，決定時間欄位與型態
+    chunksize: int
+        每段筆數
+    categorical: bool
+        代碼欄位是否轉成 category
+    '''
+    time_columns = TABLE_SCHEMAS[schema]['time_columns']
+    dtype = {col: str for col in CATEGORY_COLUMNS}
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=dtype):
+        for col in time_columns:
+            if col in chunk.columns:
+                chunk[col] = pd.to_datetime(chunk[col], format='ISO8601')
+        yield compact_dtypes(chunk, schema, categorical)
+
+def concat_chunks(chunks) -> pd.DataFrame:
+    '''
+    把 iter_* 產生的 chunk 合併，各 chunk 的 category 欄位先聯集類別，合併後仍維持 category
+    '''
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals([chunk[col] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def _sql_encode_time(col: str) -> str:
+    '''
+    migration 用，在 SQL 中把舊 table 的時間字串轉成 epoch 秒數
+    只取前 19 個字元 'YYYY-MM-DD HH:MM:SS'，舊資料中的 +08:00 為台灣時間，去掉時區後即為牆上時間
+    '''
+    return (f"CASE WHEN typeof({col}) IN ('integer', 'real') OR {col} IS NULL THEN {col} "
+            f"ELSE CAST(strftime('%s', substr({col}, 1, 19)) AS INTEGER) END")
+
+def migrate_table(db_path: str, 
+                  table_name: str, 
+                  schema: str=None) -> str:
+    '''
+    把舊的無型態 table 轉成 TABLE_SCHEMAS 定義的型態與整數時間，並建立索引
+    整個搬移在 SQLite 內以單一 INSERT ... SELECT 完成，不經過 pandas
+
+    Parameters
+    ----------
+    db_path: str
+        資料庫路徑
+    table_name: str
+        要轉換的 table，例如 'ETAG_M04A_202401'
+    schema: str
+        TABLE_SCHEMAS 中的 key，預設由 table 名稱判斷
+
+    Return
+    ------
+    str: 'migrated', 'already typed' 或 'missing'
+    '''
+    schema = schema or schema_for_table(table_name)
+    with DatabaseManager(db_path, table_name, schema=schema) as tb:
+        con = tb._writer()
+        declared = {row[1]: row[2] for row in con.execute(f'PRAGMA table_info({table_name})')}
+        if not declared:
+            return 'missing'
+        if all(declared.get(col) == col_type for col, col_type in TABLE_SCHEMAS[schema]['columns']):
+            tb.create_indexes()
+            return 'already typed'
+
+        legacy_name = f'{table_name}__untyped'
+        time_columns = TABLE_SCHEMAS[schema]['time_columns']
+        columns = [col for col, _ in TABLE_SCHEMAS[schema]['columns'] if col in declared]
+        select_clause = ', '.join([_sql_encode_time(col) if col in time_columns else col for col in columns])
+        with con:
+            con.execute(f'ALTER TABLE {table_name} RENAME TO {legacy_name}')
+            con.execute(f'CREATE TABLE {table_name}({schema_columns_sql(schema)})')
+            # 欄位的 type affinity 會把 '85' 之類的數字字串自動轉成數值
+            con.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) SELECT {select_clause} FROM {legacy_name}")
+            con.execute(f'DROP TABLE {legacy_name}')
+        tb.create_indexes()
+    return 'migrated'
+
+def migrate_database(db_path: str, 
+                     tables: list[str]=None, 
+                     vacuum: bool=False) -> dict:
+    '''
+    把資料庫中所有對應得到 schema 的舊 table 轉成 typed table，已轉換過的只會補建索引
+
+    Parameters
+    ----------
+    db_path: str
+        資料庫路徑，例如 '../data/hwdb.db'
+    tables: list[str]
+        只轉換這些 table，預設為全部
+    vacuum: bool
+        完成後是否 VACUUM 釋放舊 table 的空間
+
+    Return
+    ------
+    dict: {table_name: status}
+    '''
+    con = sqlite3.connect(db_path)
+    try:
+        all_tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+    finally:
+        con.close()
+    tables = [t for t in (tables or all_tables) if schema_for_table(t) is not None]
+    result = {}
+    for table_name in tqdm(tables):
+        try:
+            result[table_name] = migrate_table(db_path, table_name)
+        except sqlite3.Error as e:
+            print(f'{table_name} 轉換失敗: {e!r}')
+            result[table_name] = 'failed'
+    if vacuum:
+        con = sqlite3.connect(db_path)
+        con.execute('VACUUM')
+        con.close()
+    return result
+
+
+# ---------------------------------------------------------------------------
+# 跨月份 ETAG_M0xA_YYYYMM table 的查詢
+# ---------------------------------------------------------------------------
+def list_tdcs_tables(db_path: str, dataset: str) -> dict:
+    '''
+    列出資料庫中某資料集的月份 table，{'202401': 'ETAG_M04A_202401', ...} 依月份排序
+    '''
+    con = sqlite3.connect(db_path)
+    try:
+        names = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    finally:
+        con.close()
+    pattern = re.compile(rf'ETAG_{dataset}_(\d{{6}})')
+    tables = {}
+    for name in names:
+        match = pattern.fullmatch(name)
+        if match:
+            tables[match.group(1)] = name
+    return dict(sorted(tables.items()))
+
+def query_tdcs_dataset(db_path: str,
+                       dataset: str,
+                       start: str=None,
+                       end: str=None,
+                       gantry_from: list[str]=None,
+                       gantry_to: list[str]=None,
+                       gantry_id: list[str]=None,
+                       vehicle_types: list[int]=None,
+                       columns: list[str]=None,
+                       max_workers: int=4) -> pd.DataFrame:
+    '''
+    把 ETAG_M0xA_YYYYMM 月份 table 當成一個資料集查詢，取代逐月開連線、逐次 pd.concat 的寫法
+    只查詢時間區間涵蓋到的月份，時間、門架、車種條件與欄位都在 SQL 中處理，各月份平行讀取後只 concat 一次
+
+    Parameters
+    ----------
+    db_path: str
+        資料庫路徑，例如 '../data/hwdb.db'
+    dataset: str
+        'M03A', 'M04A' 或 'M05A'
+    start: str
+        起始時間 (含)，例如 '2023-01-01' 或 '2023-01-01 06:00'，預設不限
+    end: str
+        結束時間 (不含)，預設不限
+    gantry_from: list[str]
+        M04A/M05A 的 GantryFrom 條件
+    gantry_to: list[str]
+        M04A/M05A 的 GantryTo 條件
+    gantry_id: list[str]
+        M03A 的 GantryID 條件
+    vehicle_types: list[int]
+        車種條件，例如 [31, 32]
+    columns: list[str]
+        要取出的欄位，預設為全部
+    max_workers: int
+        平行讀取的 thread 數
+
+    Return
+    ------
+    pd.DataFrame: TimeStamp 為 datetime，其餘欄位型態依 TDCS_DTYPES
+    '''
+    columns = list(columns or TDCS_COLUMNS[dataset])
+    filters = {col: list(values) for col, values in [('GantryFrom', gantry_from), 
+                                                     ('GantryTo', gantry_to), 
+                                                     ('GantryID', gantry_id), 
+                                                     ('VehicleType', vehicle_types)] if values is not None}
+    # 依時間區間篩選月份 table
+    start_month = pd.Timestamp(start).strftime('%Y%m') if start is not None else None
+    end_month = (pd.Timestamp(end) - pd.Timedelta(seconds=1)).strftime('%Y%m') if end is not None else None
+    tables = [table_name for year_month, table_name in list_tdcs_tables(db_path, dataset).items()
+              if (start_month is None or year_month >= start_month) 
+              and (end_month is None or year_month <= end_month)]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+
+    def read_table(table_name):
+        with DatabaseManager(db_path, table_name, schema=dataset) as tb:
+            return tb.read_data(columns, start, end, filters)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(read_table, tables))
+    df = pd.concat(frames, ignore_index=True)
+    dtypes = {col: dtype for col, dtype in TDCS_DTYPES[dataset].items() if col in df.columns}
+    if len(df):
+        df = df.astype(dtypes)
+    return df
+
+def iter_tdcs_dataset(db_path: str,
+                      dataset: str,
+                      start: str=None,
+                      end: str=None,
+                      filters: dict=None,
+                      columns: list[str]=None,
+                      chunksize: int=1_000_000,
+                      categorical: bool=True):
+    '''
+    依月份順序逐段讀取 ETAG_M0xA_YYYYMM table，每段最多 chunksize 筆且已縮小型態 (見 compact_dtypes)
+    用於整個資料集放不進記憶體時的逐段彙總，例如 hwtoolkit.traveltime_aggregation_chunked
+
+    Parameters
+    ----------
+    db_path: str
+        資料庫路徑
+    dataset: str
+        'M03A', 'M04A' 或 'M05A'
+    start: str
+        起始時間 (含)
+    end: str
+        結束時間 (不含)
+    filters: dict
+        {欄位: 允許值 list}，例如 {'VehicleType': [31]}
+    columns: list[str]
+        要取出的欄位，預設為全部
+    chunksize: int
+        每段筆數
+    categorical: bool
+        代碼欄位是否轉成 category
+    '''
+    columns = list(columns or TDCS_COLUMNS[dataset])
+    start_month = pd.Timestamp(start).strftime('%Y%m') if start is not None else None
+    end_month = (pd.Timestamp(end) - pd.Timedelta(seconds=1)).strftime('%Y%m') if end is not None else None
+    for year_month, table_name in sorted(list_tdcs_tables(db_path, dataset).items()):
+        if (start_month is not None and year_month < start_month) or (end_month is not None and year_month > end_month):
+            continue
+        with DatabaseManager(db_path, table_name, schema=dataset) as tb:
+            for chunk in tb.iter_data(chunksize, columns, start, end, filters, compact=False):
+                yield compact_dtypes(chunk, dataset, categorical)
+
+
+# ---------------------------------------------------------------------------
+# Parquet 分區儲存
+# 與 DatabaseManager 相同的讀寫介面，依 root_dir/table_name/year_month=YYYYMM[/GantryFrom=...]/*.parquet 分區，
+# 讀取時分區與 row group 統計值 (min/max) 會用來略過不需要的檔案，欄位只讀需要的部分，檔案以 mmap 讀取
+# 時間欄位存成台灣時間的 timestamp (不帶時區)，與 typed table 的整數時間一致
+# ---------------------------------------------------------------------------
+class ParquetStoreManager:
+    def __init__(self, 
+                 root_dir: str, 
+                 table_name: str, 
+                 schema: str=None,
+                 partition_cols: list=None,
+                 row_group_rows: int=256_000) -> None:
+        """
+        Initializes a partitioned parquet table with the same write/read API as DatabaseManager.
+
+        Parameters:
+        - root_dir: Root folder of the store, e.g. '../data/store'.
+        - table_name: The name of the table, i.e. the sub folder (one logical table per dataset, e.g. 'M04A').
+        - schema: Key of TABLE_SCHEMAS; its main time column decides the year_month partition.
+        - partition_cols: Extra partition columns after year_month, e.g. ['GantryFrom'].
+        - row_group_rows: Maximum rows per row group; smaller groups give finer min/max pruning.
+        """
+        self.root_dir = root_dir
+        self.table_name = table_name
+        self.schema = schema
+        self.table_dir = os.path.join(root_dir, table_name)
+        self.time_column = schema_time_column(schema)
+        self.partition_cols = ['year_month'] + list(partition_cols or [])
+        self.row_group_rows = row_group_rows
+        self._buffer = []
+        self._log_buffer = []
+        self._rollup_range = None
+
+    def close(self) -> None:
+        self._commit_batch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self._rollback_batch()
+            self._rollup_range = None
+        self.close()
+
+    def _track_rollup(self, df: pd.DataFrame) -> None:
+        """
+        Same as DatabaseManager._track_rollup; the pending range is written before the data files,
+        so an interrupted write leaves the rollups marked stale rather than silently outdated.
+        """
+        pending = rollup_pending_frame(df, self.schema)
+        if pending is None:
+            return
+        ParquetStoreManager(self.root_dir, rollup_pending_table_name('parquet'), 
+                            schema='M04A_ROLLUP_PENDING').append_data(pending)
+        self._rollup_range = merge_time_range(self._rollup_range, pending.iloc[0])
+
+    def refresh_rollups(self) -> dict:
+        """
+        Same as DatabaseManager.refresh_rollups, called by every commit (and so by close()).
+        """
+        if self._rollup_range is None:
+            return {}
+        (start, end), self._rollup_range = self._rollup_range, None
+        return update_traveltime_rollups(self.root_dir, start, end, backend='parquet')
+
+    def table_exists(self) -> bool:
+        return os.path.isdir(self.table_dir) and any(
+            file_name.endswith('.parquet') for _, _, file_names in os.walk(self.table_dir) for file_name in file_names)
+
+    def initialize_table(self, columns_in_order: str=None) -> None:
+        """
+        Creates the table folder; columns come from the written DataFrames.
+        """
+        ensure_directory_exists(self.table_dir)
+
+    def create_indexes(self) -> list:
+        """
+        No-op, parquet relies on partitions and row-group statistics instead of indexes.
+        """
+        return []
+
+    def delete_table_data(self) -> None:
+        if os.path.isdir(self.table_dir):
+            shutil.rmtree(self.table_dir)
+
+    def prepare_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Normalizes time columns to Taiwan wall-clock datetimes, applies TDCS dtypes,
+        adds the year_month partition column and sorts rows so row-group statistics are tight.
+        """
+        df = df.copy()
+        time_columns = TABLE_SCHEMAS[self.schema]['time_columns'] if self.schema is not None else [self.time_column]
+        for col in time_columns:
+            if col in df.columns:
+                df[col] = decode_timestamp(encode_timestamp(df[col]))
+        if self.schema in TDCS_DTYPES:
+            df = df.astype({col: dtype for col, dtype in TDCS_DTYPES[self.schema].items() if col in df.columns})
+        df['year_month'] = df[self.time_column].dt.strftime('%Y%m')
+        return df.sort_values(self.partition_cols[1:] + [self.time_column], kind='stable', ignore_index=True)
+
+    def _partition_dir(self, values: tuple) -> str:
+        return os.path.join(self.table_dir, *[f'{col}={value}' for col, value in zip(self.partition_cols, values)])
+
+    def _write_prepared(self, df: pd.DataFrame) -> None:
+        """
+        Writes one new parquet file per partition, existing files are left untouched.
+        """
+        token = f'{time.time_ns()}-{os.getpid()}'
+        for values, part in df.groupby(self.partition_cols, sort=False):
+            values = values if isinstance(values, tuple) else (values,)
+            part_dir = self._partition_dir(values)
+            ensure_directory_exists(part_dir)
+            table = pa.Table.from_pandas(part.drop(columns=self.partition_cols), preserve_index=False)
+            tmp_path = os.path.join(part_dir, f'.part-{token}.parquet.tmp')
+            pq.write_table(table, tmp_path, row_group_size=self.row_group_rows)
+            os.replace(tmp_path, os.path.join(part_dir, f'part-{token}.parquet'))
+
+    def append_data(self, df: pd.DataFrame) -> None:
+        """
+        Appends a DataFrame as new parquet files in the matching partitions.
+        """
+        if not df.empty:
+            self._track_rollup(df)
+            self._write_prepared(self.prepare_df(df))
+
+    def bulk_load(self, 
+                  commit_rows: int=2_000_000, 
+                  commit_seconds: float=60.0) -> BulkLoadSession:
+        """
+        Same as DatabaseManager.bulk_load; frames are buffered in memory and written as one set
+        of files per commit, so many small inputs do not turn into many small parquet files.
+        """
+        return BulkLoadSession(self, commit_rows, commit_seconds)
+
+    def _insert_batch(self, df: pd.DataFrame) -> None:
+        self._buffer.append(df)
+
+    def _log_sources(self, entries: list) -> None:
+        self._log_buffer.extend(entries)
+
+    def _commit_batch(self) -> None:
+        if self._buffer:
+            buffer, self._buffer = self._buffer, []
+            self.append_data(pd.concat(buffer, ignore_index=True))
+        if self._log_buffer:
+            # 資料檔寫完後才寫 INGEST_LOG，中斷時最多是有資料沒有紀錄，不會有紀錄沒有資料
+            entries, self._log_buffer = self._log_buffer, []
+            ParquetStoreManager(self.root_dir, INGEST_LOG_TABLE, schema='INGEST_LOG').append_data(
+                ingest_log_frame(self.table_name, entries))
+        self.refresh_rollups()
+
+    def _rollback_batch(self) -> None:
+        self._buffer = []
+        self._log_buffer = []
+
+    def update_data(self, 
+                    df: pd.DataFrame, 
+                    key_columns: list,
+                    dedupe: bool=False) -> dict:
+        """
+        Upserts df: every partition touched by df is rewritten with the new rows replacing
+        existing rows of the same key_columns.
+
+        Returns:
+        - dict with the number of rows 'inserted' and 'updated'.
+        """
+        df = df.drop_duplicates(subset=key_columns, keep='last')
+        if not df.empty:
+            self._track_rollup(df)
+        df = self.prepare_df(df)
+        counts = {'inserted': 0, 'updated': 0}
+        for values, part in df.groupby(self.partition_cols, sort=False):
+            values = values if isinstance(values, tuple) else (values,)
+            part_dir = self._partition_dir(values)
+            old_files = sorted(os.path.join(part_dir, f) for f in os.listdir(part_dir) if f.endswith('.parquet')) \
+                        if os.path.isdir(part_dir) else []
+            part = part.drop(columns=self.partition_cols)
+            # 同一分區內分區欄位的值都相同，只需比對其餘的 key
+            file_keys = [col for col in key_columns if col not in self.partition_cols]
+            n_new, n_updated = len(part), 0
+            if old_files:
+                old = pq.read_table(old_files, memory_map=True).to_pandas()
+                if not dedupe and old.duplicated(subset=file_keys).any():
+                    raise ValueError(f'{part_dir} has duplicated {key_columns}, pass dedupe=True to remove them')
+                n_updated = len(part.merge(old[file_keys].drop_duplicates(), on=file_keys, how='inner'))
+                part = pd.concat([old, part], ignore_index=True).drop_duplicates(subset=file_keys, keep='last')
+            counts['updated'] += n_updated
+            counts['inserted'] += n_new - n_updated
+            for col, value in zip(self.partition_cols, values):
+                part[col] = value
+            self._write_prepared(part.sort_values(self.partition_cols[1:] + [self.time_column], ignore_index=True))
+            for path in old_files:
+                os.remove(path)
+        return counts
+
+    def _scanner_args(self, columns: list, start, end, filters: dict, time_column: str) -> tuple:
+        """
+        Builds (dataset, columns, filter expression) for read_data / iter_data.
+        """
+        time_column = time_column or self.time_column
+        partitioning = pads.partitioning(pa.schema([(col, pa.string()) for col in self.partition_cols]), flavor='hive')
+        dataset = pads.dataset(self.table_dir, format='parquet', partitioning=partitioning,
+                               filesystem=pafs.LocalFileSystem(use_mmap=True))
+        expression = None
+        def add(condition):
+            nonlocal expression
+            expression = condition if expression is None else expression & condition
+        if start is not None:
+            add(pads.field(time_column) >= pa.scalar(pd.Timestamp(start), type=pa.timestamp('ns')))
+            if time_column == self.time_column:
+                add(pads.field('year_month') >= pd.Timestamp(start).strftime('%Y%m'))
+        if end is not None:
+            add(pads.field(time_column) < pa.scalar(pd.Timestamp(end), type=pa.timestamp('ns')))
+            if time_column == self.time_column:
+                add(pads.field('year_month') <= (pd.Timestamp(end) - pd.Timedelta(seconds=1)).strftime('%Y%m'))
+        for col, values in (filters or {}).items():
+            add(pads.field(col).isin(list(values)))
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name != 'year_month']
+        return dataset, list(columns), expression
+
+    def _empty(self, columns: list, time_column: str) -> pd.DataFrame:
+        df = pd.DataFrame(columns=columns)
+        if (time_column or self.time_column) in df.columns:
+            df[time_column or self.time_column] = df[time_column or self.time_column].astype('datetime64[ns]')
+        return df
+
+    def read_data(self, 
+                  columns: list=None, 
+                  start: str=None, 
+                  end: str=None, 
+                  filters: dict=None, 
+                  time_column: str=None,
+                  compact: bool=False) -> pd.DataFrame:
+        """
+        Reads the table with partition pruning, row-group min/max pruning and column projection.
+        Same parameters as DatabaseManager.read_data.
+        """
+        if not self.table_exists():
+            return self._empty(columns, time_column)
+        dataset, columns, expression = self._scanner_args(columns, start, end, filters, time_column)
+        df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+        return compact_dtypes(df, self.schema) if compact else df
+
+    def iter_data(self, 
+                  chunksize: int=1_000_000,
+                  columns: list=None, 
+                  start: str=None, 
+                  end: str=None, 
+                  filters: dict=None, 
+                  time_column: str=None,
+                  compact: bool=True):
+        """
+        Same as DatabaseManager.iter_data; record batches are regrouped into chunks of exactly
+        chunksize rows (except the last one).
+        """
+        if not self.table_exists():
+            return
+        dataset, columns, expression = self._scanner_args(columns, start, end, filters, time_column)
+        pending, n_pending = [], 0
+        for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunksize):
+            pending.append(batch)
+            n_pending += batch.num_rows
+            while n_pending >= chunksize:
+                table = pa.Table.from_batches(pending)
+                df = table.slice(0, chunksize).to_pandas()
+                rest = table.slice(chunksize)
+                pending, n_pending = rest.to_batches(), rest.num_rows
+                yield compact_dtypes(df, self.schema) if compact else df
+        if n_pending:
+            df = pa.Table.from_batches(pending).to_pandas()
+            yield compact_dtypes(df, self.schema) if compact else df
+
+def open_table(backend: str, 
+               location: str, 
+               table_name: str, 
+               schema: str=None, 
+               **kwargs):
+    '''
+    依 backend 建立 DatabaseManager 或 ParquetStoreManager，兩者的讀寫介面相同
+
+    Parameters
+    ----------
+    backend: str
+        'sqlite' 或 'parquet'
+    location: str
+        sqlite 為資料庫路徑，parquet 為 store 的根目錄
+    table_name: str
+        table 名稱
+    schema: str
+        TABLE_SCHEMAS 中的 key
+    '''
+    if backend == 'sqlite':
+        return DatabaseManager(location, table_name, schema=schema, **kwargs)
+    if backend == 'parquet':
+        return ParquetStoreManager(location, table_name, schema=schema, **kwargs)
+    raise ValueError(f'unknown backend: {backend}')
+
+def tdcs_table_name(backend: str, dataset: str, year_month: str) -> str:
+    '''
+    TDCS 資料在各 backend 的 table 名稱，sqlite 依月份分 table (ETAG_M04A_202401)，parquet 為單一分區 table (M04A)
+    '''
+    return f'ETAG_{dataset}_{year_month}' if backend == 'sqlite' else dataset
+
+
+# ---------------------------------------------------------------------------
+# M04A 旅行時間彙總表 (rollup)
+# 每個解析度 (5/15/60 分鐘) 一張 table，存各門架對每個時間區間的 WeightedAvgTravelTime 與 TotalTraffic
+# 新的 M04A 資料寫入後只重算受影響的時間區間並 upsert，查詢某些門架對一整年的序列只需讀索引
+# ---------------------------------------------------------------------------
+ROLLUP_RESOLUTIONS = (5, 15, 60)
+ROLLUP_KEYS = ['GantryFrom', 'GantryTo', 'TimeStamp']
+
+def rollup_table_name(backend: str, minutes: int) -> str:
+    '''
+    彙總表名稱，sqlite 為 'ETAG_M04A_ROLLUP_15MIN'，parquet 為 'M04A_ROLLUP_15MIN'
+    '''
+    return f'ETAG_M04A_ROLLUP_{minutes}MIN' if backend == 'sqlite' else f'M04A_ROLLUP_{minutes}MIN'
+
+def rollup_pending_table_name(backend: str) -> str:
+    '''
+    記錄尚未重算彙總的 M04A 時間範圍的 table，sqlite 為 'ETAG_M04A_ROLLUP_PENDING'，parquet 為 'M04A_ROLLUP_PENDING'
+    '''
+    return 'ETAG_M04A_ROLLUP_PENDING' if backend == 'sqlite' else 'M04A_ROLLUP_PENDING'
+
+def rollup_pending_frame(df: pd.DataFrame, schema: str) -> pd.DataFrame:
+    '''
+    要寫入 M04A 的 df 所涵蓋的 [Start, End) (End 為最後一個 TimeStamp 加 5 分鐘)，不是 M04A 或沒有資料時回傳 None
+    '''
+    if schema != 'M04A' or df.empty:
+        return None
+    timestamps = decode_timestamp(encode_timestamp(df['TimeStamp']))
+    return pd.DataFrame({'Start': [timestamps.min()], 'End': [timestamps.max() + pd.Timedelta(minutes=5)]})
+
+def merge_time_range(time_range: tuple, row: pd.Series) -> tuple:
+    '''
+    把 row 的 [Start, End) 併入 time_range (None 代表還沒有範圍)
+    '''
+    if time_range is None:
+        return row['Start'], row['End']
+    return min(time_range[0], row['Start']), max(time_range[1], row['End'])
+
+def stale_rollup_ranges(location: str, backend: str='sqlite') -> pd.DataFrame:
+    '''
+    已寫入 M04A 但彙總表還沒重算的時間範圍，columns = Start, End
+    寫入 M04A 的 manager 在 commit / close 時會自動重算，留下紀錄代表寫入中斷或 manager 沒有被 close
+    '''
+    with open_table(backend, location, rollup_pending_table_name(backend), schema='M04A_ROLLUP_PENDING') as tb:
+        if not tb.table_exists():
+            return pd.DataFrame({'Start': pd.Series(dtype='datetime64[ns]'), 'End': pd.Series(dtype='datetime64[ns]')})
+        return tb.read_data(columns=['Start', 'End'])
+
+def _clear_rollup_pending(location: str, start, end, backend: str) -> None:
+    '''
+    刪除被 [start, end) 完整涵蓋的 pending 範圍 (start/end 為 None 代表不限)
+    '''
+    pending = stale_rollup_ranges(location, backend)
+    if pending.empty:
+        return
+    covered = pd.Series(True, index=pending.index)
+    if start is not None:
+        covered &= pending['Start'] >= start
+    if end is not None:
+        covered &= pending['End'] <= end
+    if not covered.any():
+        return
+    with open_table(backend, location, rollup_pending_table_name(backend), schema='M04A_ROLLUP_PENDING') as tb:
+        tb.delete_table_data()
+        if not covered.all():
+            tb.append_data(pending[~covered])
+
+def traveltime_sums(m04a_df: pd.DataFrame, minutes: int=5, by_vehicle_type: bool=False) -> pd.DataFrame:
+    '''
+    M04A 彙總的第一步：依 (TimeStamp, GantryFrom, GantryTo[, VehicleType]) 加總
+    TravelTime*Traffic、TravelTime^2*Traffic 與 Traffic，TimeStamp 先對齊到 minutes 分鐘
+    這些加總可以再相加，所以分段計算後合併的結果與一次計算相同
+    '''
+    traffic = m04a_df['Traffic'].astype('float64')
+    travel_time = m04a_df['TravelTime'].astype('float64')
+    sums = pd.DataFrame({'TimeStamp': m04a_df['TimeStamp'].dt.floor(f'{minutes}min'),
+                         # 各段的 category 類別可能不同，統一轉成字串
+                         'GantryFrom': m04a_df['GantryFrom'].astype(str),
+                         'GantryTo': m04a_df['GantryTo'].astype(str),
+                         'weighted': travel_time * traffic,
+                         'weighted_sq': travel_time * travel_time * traffic,
+                         'traffic': traffic})
+    keys = ['TimeStamp', 'GantryFrom', 'GantryTo']
+    if by_vehicle_type:
+        sums['VehicleType'] = m04a_df['VehicleType'].astype('int64')
+        keys.append('VehicleType')
+    return sums.groupby(keys)[['weighted', 'weighted_sq', 'traffic']].sum()
+
+def traveltime_from_sums(sums: pd.DataFrame, by_vehicle_type: bool=False, dispersion: bool=False) -> pd.DataFrame:
+    '''
+    M04A 彙總的第二步：由 traveltime_sums 的加總算出加權平均、總流量等欄位
+    aggregate_m04a (rollup table) 與 hwtoolkit.traveltime_aggregation 都以此計算 WeightedAvgTravelTime
+    '''
+    # Traffic=0時代表對應車種沒有資料，TravelTime就會=0，這邊代表他並不是真的TravelTime超快
+    # 所以加權的分母為 0 時平均值記為 0，而不是 0/0
+    def weighted_mean(num, den):
+        has_traffic = den > 0
+        return (num / den.where(has_traffic)).where(has_traffic, 0.0)
+
+    keys = ['TimeStamp', 'GantryFrom', 'GantryTo']
+    totals = sums.groupby(level=keys).sum() if by_vehicle_type else sums
+    agg_df = pd.DataFrame({'WeightedAvgTravelTime': weighted_mean(totals['weighted'], totals['traffic']),
+                           'TotalTraffic': totals['traffic']})
+    if dispersion:
+        # 以流量加權的 TravelTime 標準差 (涵蓋所有車種與區間內的 5 分鐘時段)
+        variance = weighted_mean(totals['weighted_sq'], totals['traffic']) - agg_df['WeightedAvgTravelTime']**2
+        agg_df['TravelTimeStd'] = variance.clip(lower=0) ** 0.5
+    if by_vehicle_type:
+        total_traffic = totals['traffic'].reindex(sums.index.droplevel('VehicleType')).to_numpy()
+        per_type = pd.DataFrame({'TravelTime': weighted_mean(sums['weighted'], sums['traffic']),
+                                 'Traffic': sums['traffic'],
+                                 'TrafficShare': weighted_mean(sums['traffic'], pd.Series(total_traffic, index=sums.index))})
+        # 寬表：TravelTime_31, Traffic_31, TrafficShare_31, ...，沒有該車種資料的時段為 0
+        per_type = per_type.unstack('VehicleType', fill_value=0.0)
+        per_type.columns = [f'{name}_{vehicle_type}' for name, vehicle_type in per_type.columns]
+        agg_df = agg_df.join(per_type)
+    agg_df = agg_df.reset_index()
+    # columns modification
+    agg_df['gf_gt'] = agg_df['GantryFrom']+'-'+agg_df['GantryTo']
+    return agg_df
+
+def aggregate_m04a(m04a_df: pd.DataFrame, minutes: int=5) -> pd.DataFrame:
+    '''
+    把 M04A 依門架對與 minutes 分鐘的時間區間彙總 (不分車種)
+    WeightedAvgTravelTime 為以 Traffic 加權的平均 TravelTime，區間內 Traffic 加總為 0 時 (沒有資料) 記為 0
+
+    Return
+    ------
+    pd.DataFrame: TimeStamp (區間起點), GantryFrom, GantryTo, WeightedAvgTravelTime, TotalTraffic
+    '''
+    df = traveltime_from_sums(traveltime_sums(m04a_df, minutes))
+    df['TotalTraffic'] = df['TotalTraffic'].astype('int64')
+    return df[['TimeStamp', 'GantryFrom', 'GantryTo', 'WeightedAvgTravelTime', 'TotalTraffic']]
+
+def _m04a_months(location: str, backend: str) -> list[str]:
+    '''
+    已有 M04A 資料的月份 (YYYYMM)，由小到大
+    '''
+    if backend == 'sqlite':
+        return sorted(list_tdcs_tables(location, 'M04A'))
+    table_dir = os.path.join(location, 'M04A')
+    if not os.path.isdir(table_dir):
+        return []
+    return sorted(name.split('=', 1)[1] for name in os.listdir(table_dir) if name.startswith('year_month='))
+
+def _read_m04a(location: str, start, end, backend: str) -> pd.DataFrame:
+    columns = ['TimeStamp', 'GantryFrom', 'GantryTo', 'TravelTime', 'Traffic']
+    if backend == 'sqlite':
+        return query_tdcs_dataset(location, 'M04A', start=start, end=end, columns=columns)
+    with ParquetStoreManager(location, 'M04A', schema='M04A') as store:
+        return store.read_data(columns=columns, start=start, end=end)
+
+def update_traveltime_rollups(location: str,
+                              start: str=None,
+                              end: str=None,
+                              resolutions: tuple=ROLLUP_RESOLUTIONS,
+                              backend: str='sqlite') -> dict:
+    '''
+    由 M04A 重算 [start, end) 涵蓋到的時間區間並 upsert 到各解析度的彙總表
+    start/end 會對齊到最大的解析度，受影響的區間整段重算，所以重複執行或補入遲到的資料結果都正確
+    一次讀取一天的 M04A，同一個月份的彙總結果合併後才寫入
+
+    Parameters
+    ----------
+    location: str
+        sqlite 為資料庫路徑，parquet 為 store 根目錄
+    start: str
+        起始時間 (含)，None 時從最早有 M04A 資料的月份開始 (全部重建)
+    end: str
+        結束時間 (不含)，None 時到最晚有 M04A 資料的月份結束
+    resolutions: tuple
+        要維護的解析度 (分鐘)，需能整除 1440
+    backend: str
+        'sqlite' 或 'parquet'
+
+    Return
+    ------
+    dict: {minutes: 寫入 (新增 + 更新) 的筆數}
+    '''
+    months = _m04a_months(location, backend)
+    written = {minutes: 0 for minutes in resolutions}
+    if not months:
+        return written
+    full_rebuild = start is None and end is None
+    step = f'{max(resolutions)}min'
+    start = pd.Timestamp(start).floor(step) if start is not None else pd.Timestamp(f'{months[0]}01')
+    end = pd.Timestamp(end).ceil(step) if end is not None else pd.Timestamp(f'{months[-1]}01') + pd.offsets.MonthBegin()
+    bounds = [start] + [day for day in pd.date_range(start.normalize(), end, freq='D') if start < day < end] + [end]
+
+    pending = {minutes: [] for minutes in resolutions}
+    def flush():
+        for minutes, frames in pending.items():
+            if frames:
+                with open_table(backend, location, rollup_table_name(backend, minutes), schema='M04A_ROLLUP') as tb:
+                    tb.initialize_table()
+                    counts = tb.update_data(pd.concat(frames, ignore_index=True), ROLLUP_KEYS)
+                written[minutes] += counts['inserted'] + counts['updated']
+                frames.clear()
+
+    for window_start, window_end in tqdm(list(zip(bounds[:-1], bounds[1:])), desc='M04A rollup'):
+        if window_start.strftime('%Y%m') not in months:
+            continue
+        m04a_df = _read_m04a(location, window_start, window_end, backend)
+        for minutes in resolutions:
+            if len(m04a_df):
+                pending[minutes].append(aggregate_m04a(m04a_df, minutes))
+        if window_end.strftime('%Y%m') != window_start.strftime('%Y%m'):
+            flush()
+    flush()
+    if tuple(resolutions) == ROLLUP_RESOLUTIONS:
+        _clear_rollup_pending(location, None if full_rebuild else start, None if full_rebuild else end, backend)
+    return written
+
+def read_traveltime_rollup(location: str,
+                           minutes: int=15,
+                           start: str=None,
+                           end: str=None,
+                           pairs: list=None,
+                           backend: str='sqlite') -> pd.DataFrame:
+    '''
+    讀取彙總表，格式同 hwtoolkit.traveltime_aggregation 的輸出 (含 gf_gt)
+
+    Parameters
+    ----------
+    location: str
+        sqlite 為資料庫路徑，parquet 為 store 根目錄
+    minutes: int
+        解析度 (分鐘)，需為 update_traveltime_rollups 維護的其中之一
+    start: str
+        起始時間 (含)
+    end: str
+        結束時間 (不含)
+    pairs: list
+        門架對，元素為 (GantryFrom, GantryTo) 或 'GantryFrom-GantryTo'，預設為全部
+    backend: str
+        'sqlite' 或 'parquet'
+    '''
+    # 查詢範圍內有寫入 M04A 後還沒重算的區間時不回傳過時的結果
+    pending = stale_rollup_ranges(location, backend)
+    if start is not None:
+        pending = pending[pending['End'] > pd.Timestamp(start)]
+    if end is not None:
+        pending = pending[pending['Start'] < pd.Timestamp(end)]
+    if len(pending):
+        raise RuntimeError(f"rollups are stale for {len(pending)} M04A ranges from {pending['Start'].min()} "
+                           f"to {pending['End'].max()}, run update_traveltime_rollups first")
+    filters = None
+    if pairs is not None:
+        pairs = [tuple(pair.split('-')) if isinstance(pair, str) else tuple(pair) for pair in pairs]
+        filters = {'GantryFrom': sorted({gf for gf, _ in pairs}), 'GantryTo': sorted({gt for _, gt in pairs})}
+    columns = [col for col, _ in TABLE_SCHEMAS['M04A_ROLLUP']['columns']]
+    with open_table(backend, location, rollup_table_name(backend, minutes), schema='M04A_ROLLUP') as tb:
+        df = tb.read_data(columns=columns, start=start, end=end, filters=filters) if tb.table_exists() \
+             else pd.DataFrame(columns=columns).astype({'TimeStamp': 'datetime64[ns]'})
+    df['gf_gt'] = df['GantryFrom'].astype(str)+'-'+df['GantryTo'].astype(str)
+    if pairs is not None:
+        df = df[df['gf_gt'].isin([f'{gf}-{gt}' for gf, gt in pairs])]
+    return df.sort_values(['TimeStamp', 'GantryFrom', 'GantryTo'], ignore_index=True)
+
+
+def strip_ns_prefix(tree):
+    for elem in tree.getiterator():
+        if not hasattr(elem.tag, 'find'):
+            continue
+        i = elem.tag.find('}')
+        if i >= 0:
+            elem.tag = elem.tag[i+1:]
+
+def xml_to_dict(element):
+    if len(element) == 0:  # if element is a leaf node
+        return element.text
+    result = {}
+    for child in element:
+        child_result = xml_to_dict(child)
+        if child.tag not in result:
+            result[child.tag] = child_result
+        else:
+            if not isinstance(result[child.tag], list):
+                result[child.tag] = [result[child.tag]]
+            result[child.tag].append(child_result)
+    return result
+
+def read_xml_bytes(source, debug_xml_path: str=None) -> bytes:
+    '''
+    讀取 xml 內容成 bytes，source 可以是 .xml / .xml.gz 的路徑，或是 http 下載下來的原始 bytes
+    gzip 格式會在記憶體中直接解壓，不會產生解壓後的中間檔
+    debug_xml_path 有指定時才會把解壓後的 xml 另外寫到磁碟上，方便除錯
+    '''
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    # 以 gzip magic number 判斷，http 若已依 Content-Encoding 解壓也能正確處理
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    if debug_xml_path is not None:
+        ensure_directory_exists(os.path.dirname(debug_xml_path) or '.')
+        with open(debug_xml_path, 'wb') as f:
+            f.write(data)
+    return data
+
+def convert_xml_to_dict(xml_file_path, debug_xml_path: str=None):
+    '''
+    xml 轉換成 dict，xml_file_path 可以是 .xml、.xml.gz 的路徑或原始 bytes
+    '''
+    # 解析XML文件
+    parser = etree.XMLParser(remove_blank_text=True)
+    if isinstance(xml_file_path, (bytes, bytearray)) or str(xml_file_path).endswith('.gz'):
+        root = etree.fromstring(read_xml_bytes(xml_file_path, debug_xml_path), parser)
+        tree = root.getroottree()
+    else:
+        tree = etree.parse(xml_file_path, parser)
+        root = tree.getroot()
+
+    # 移除命名空間
+    strip_ns_prefix(tree)
+    
+    # Convert the XML to a dictionary
+    data_dict = {root.tag: xml_to_dict(root)}
+    return data_dict
+
+
+# 這段會因每種檔案不同要改寫
+def vd_static_dict_to_df(vd_static_dict):
+    # extract shared columns
+    shared_cols = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion']
+    shared_info = {key: vd_static_dict['VDList'][key] for key in shared_cols}
+    
+    # dict to df, append shared columns
+    df = pd.json_normalize(vd_static_dict['VDList']['VDs']['VD'])
+    for key in shared_info.keys():
+        df[key] = shared_info[key]
+    
+    df.rename(columns={'DetectionLinks.DetectionLink.LinkID': 'LinkID',
+                   'DetectionLinks.DetectionLink.Bearing': 'Bearing',
+                   'DetectionLinks.DetectionLink.RoadDirection': 'RoadDirection',
+                   'DetectionLinks.DetectionLink.LaneNum': 'Lane',
+                   'DetectionLinks.DetectionLink.ActualLaneNum': 'ActualLaneNum', 
+                   'RoadSection.Start': 'Start',
+                   'RoadSection.End': 'End'
+                  }, inplace=True)
+
+    df['UpdateTime'] = pd.to_datetime(df['UpdateTime'])
+    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'SubAuthorityCode', 
+         'BiDirectional', 'LinkID', 'Bearing', 'RoadDirection', 'Lane',
+         'ActualLaneNum', 'VDType', 'LocationType', 'DetectionType', 'PositionLon',
+         'PositionLat', 'RoadID', 'RoadName', 'RoadClass', 'Start', 
+         'End', 'LocationMile']]
+    return df
+
+# 這段會因每種檔案不同要改寫
+def vd_dynamic_dict_to_df(vd_dynamic_dict):
+    # extract shared columns
+    shared_cols = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion']
+    shared_info = {key: vd_dynamic_dict['VDLiveList'][key] for key in shared_cols}
+    
+    # dict to df, append shared columns
+
+    # 這邊結構很醜，沒有chatgpt幫忙要花很長時間去解
+    df = pd.json_normalize(
+        vd_dynamic_dict['VDLiveList']['VDLives']['VDLive'],
+        record_path=['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Vehicles', 'Vehicle'],
+        meta=[
+            'VDID', 'Status', 'DataCollectTime',
+            ['LinkFlows', 'LinkFlow', 'LinkID'],
+            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'LaneID'],
+            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'LaneType'],
+            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Speed'],
+            ['LinkFlows', 'LinkFlow', 'Lanes', 'Lane', 'Occupancy']
+        ],
+        meta_prefix='meta_',
+        record_prefix='vehicle_'
+    )
+    
+    # Rename columns for better readability
+    df.columns = df.columns.str.replace('meta_LinkFlows.LinkFlow.Lanes.Lane.', 'lane_')
+    df.columns = df.columns.str.replace('meta_LinkFlows.LinkFlow.', 'link_')
+    df.columns = df.columns.str.replace('meta_', '')
+    
+    df.rename(columns = {'vehicle_VehicleType': 'VehicleType', 
+                         'vehicle_Volume': 'Volume', 
+                         'vehicle_Speed': 'Speed2',
+                         'link_LinkID': 'LinkID', 
+                         'lane_LaneID': 'LaneID',
+                         'lane_LaneType': 'LaneType', 
+                         'lane_Speed': 'Speed', 
+                         'lane_Occupancy': 'Occupancy'}, inplace=True)
+        
+    for key in shared_info.keys():
+        df[key] = shared_info[key]
+
+    df['UpdateTime'] = pd.to_datetime(df['UpdateTime'])
+    df['DataCollectTime'] = pd.to_datetime(df['DataCollectTime'])
+    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'LinkID', 
+         'LaneID', 'LaneType', 'Speed', 'Occupancy', 'VehicleType',
+         'Volume', 'Speed2', 'Status', 'DataCollectTime']]
+    return df
+
+# 這段會因每種檔案不同要改寫
+def etag_static_dict_to_df(etag_static_dict):
+    # Flatten the nested structure
+    df = pd.json_normalize(
+        etag_static_dict['ETagList']['ETags']['ETag'],
+        sep='_'
+    )
+    
+    # Add metadata fields to the DataFrame
+    df['UpdateTime'] = etag_static_dict['ETagList']['UpdateTime']
+    df['UpdateInterval'] = etag_static_dict['ETagList']['UpdateInterval']
+    df['AuthorityCode'] = etag_static_dict['ETagList']['AuthorityCode']
+    df['LinkVersion'] = etag_static_dict['ETagList']['LinkVersion']
+    
+    df.rename(columns={'RoadSection_Start': 'Start',
+                       'RoadSection_End': 'End'}, inplace=True)
+    
+    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion',
+             'ETagGantryID', 'LinkID', 'LocationType', 'PositionLon', 'PositionLat',
+             'RoadID', 'RoadName', 'RoadClass', 'RoadDirection', 'Start', 
+             'End', 'LocationMile']]
+    return df
+
+# 這段會因每種檔案不同要改寫
+def etagpair_dict_to_df(etagpair_dict):
+    # Flatten the nested structure
+    df = pd.json_normalize(
+        etagpair_dict['ETagPairList']['ETagPairs']['ETagPair'],
+        sep='_'
+    )
+    
+    # Add metadata fields to the DataFrame
+    df['UpdateTime'] = etagpair_dict['ETagPairList']['UpdateTime']
+    df['UpdateInterval'] = etagpair_dict['ETagPairList']['UpdateInterval']
+    df['AuthorityCode'] = etagpair_dict['ETagPairList']['AuthorityCode']
+    df['LinkVersion'] = etagpair_dict['ETagPairList']['LinkVersion']
+    
+    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagGantryID', 
+             'EndETagGantryID', 'Description', 'Distance', 'StartLinkID', 'EndLinkID', 
+             'Geometry']]
+    return df
+
+# 這段會因每種檔案不同要改寫
+def etagpairlive_dict_to_df(etagpair_dict):
+    # Flatten the nested structure
+    df = pd.json_normalize(
+        etagpair_dict['ETagPairLiveList']['ETagPairLives']['ETagPairLive'],
+        record_path=['Flows', 'Flow'],
+        meta=[
+            'ETagPairID', 'StartETagStatus', 'EndETagStatus', 'StartTime', 'EndTime', 'DataCollectTime'
+        ],
+        meta_prefix='meta_',
+        record_prefix='flow_'
+    )
+    
+    # Add metadata fields from the root level to the DataFrame
+    df['UpdateTime'] = etagpair_dict['ETagPairLiveList']['UpdateTime']
+    df['UpdateInterval'] = etagpair_dict['ETagPairLiveList']['UpdateInterval']
+    df['AuthorityCode'] = etagpair_dict['ETagPairLiveList']['AuthorityCode']
+   
+    df.rename(columns={'flow_VehicleType':'VehicleType',
+                       'flow_TravelTime':'TravelTime',
+                       'flow_StandardDeviation':'StandardDeviation',
+                       'flow_SpaceMeanSpeed':'SpaceMeanSpeed',
+                       'flow_VehicleCount':'VehicleCount', 
+                       'meta_ETagPairID':'ETagPairID',
+                       'meta_StartETagStatus':'StartETagStatus',
+                       'meta_EndETagStatus':'EndETagStatus', 
+                       'meta_StartTime':'StartTime',
+                       'meta_EndTime':'EndTime', 
+                       'meta_DataCollectTime':'DataCollectTime'}, inplace=True)
+    df = df[['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagStatus', 
+             'EndETagStatus', 'VehicleType', 'TravelTime', 'StandardDeviation', 'SpaceMeanSpeed', 
+             'VehicleCount', 'StartTime', 'EndTime', 'DataCollectTime']]
+    time_cols = ['UpdateTime', 'StartTime', 'EndTime', 'DataCollectTime']
+    for col in time_cols:
+        df[col]=pd.to_datetime(df[col])
+    return df
+
+# ---------------------------------------------------------------------------
+# iterparse 版本的轉換函數
+# convert_xml_to_dict -> xml_to_dict -> json_normalize 會同時持有 lxml tree、巢狀 dict
+# 與攤平後的 df，VDLive 這種 lane x vehicle 的巢狀結構尖峰記憶體最吃重
+# 下面改成邊讀邊解析，每筆紀錄處理完就把 element 清掉，欄位直接寫進 list 組成的 buffer
+# 輸出的欄位順序與型態與上面的 *_dict_to_df 相同
+# ---------------------------------------------------------------------------
+XML_HEADER_TAGS = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion']
+
+def _localname(tag: str) -> str:
+    '''
+    '{http://traffic.transportdata.tw/standard/traffic/schema/}VDID' -> 'VDID'
+    '''
+    return tag.rpartition('}')[2]
+
+def _leaf_texts(elem) -> dict:
+    '''
+    取出 elem 底下沒有子節點的直屬欄位 {localname: text}
+    '''
+    return {_localname(child.tag): child.text for child in elem
+            if isinstance(child.tag, str) and len(child) == 0}
+
+def open_xml_stream(source):
+    '''
+    回傳可供 iterparse 逐段讀取的 file object
+    .gz 路徑用 gzip.open 邊解壓邊讀，不會整個解壓到記憶體；bytes 依 gzip magic number 判斷是否需解壓
+    '''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        stream = io.BytesIO(bytes(source))
+        if bytes(source[:2]) == b'\x1f\x8b':
+            return gzip.GzipFile(fileobj=stream)
+        return stream
+    if str(source).endswith('.gz'):
+        return gzip.open(source, 'rb')
+    return open(source, 'rb')
+
+def iter_xml_records(source, record_tag: str, header: dict):
+    '''
+    以 iterparse 逐筆產生 record_tag 的 element，不論有無命名空間都能比對
+    根節點下的共用欄位 (UpdateTime 等) 會寫進 header；yield 完的 element 會被清除以維持固定記憶體
+
+    Parameters
+    ----------
+    source: str | bytes
+        .xml、.xml.gz 的路徑或原始 bytes
+    record_tag: str
+        一筆紀錄的 tag，例如 'VDLive'
+    header: dict
+        用來接收共用欄位的 dict
+    '''
+    tags = ['{*}' + record_tag] + ['{*}' + tag for tag in XML_HEADER_TAGS]
+    with open_xml_stream(source) as stream:
+        for _, elem in etree.iterparse(stream, events=('end',), tag=tags, 
+                                        remove_blank_text=True, remove_comments=True):
+            tag = _localname(elem.tag)
+            if tag != record_tag:
+                parent = elem.getparent()
+                if parent is not None and parent.getparent() is None:
+                    header[tag] = elem.text
+                continue
+            yield elem
+            # 清掉已處理的紀錄以及前面的兄弟節點
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def _buffers_to_df(buffers: dict, header: dict, columns: list, time_cols: list=()) -> pd.DataFrame:
+    '''
+    columnar buffer 組成 df，補上共用欄位並轉換時間欄位
+    '''
+    df = pd.DataFrame(buffers)
+    for key in XML_HEADER_TAGS:
+        if key in columns:
+            df[key] = header.get(key)
+    df = df[columns]
+    for col in time_cols:
+        df[col] = pd.to_datetime(df[col], format='ISO8601')
+    return df
+
+def vd_static_iterparse_to_df(source) -> pd.DataFrame:
+    '''
+    VD.xml(.gz) 逐筆解析，輸出同 vd_static_dict_to_df
+    '''
+    columns = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'SubAuthorityCode', 
+               'BiDirectional', 'LinkID', 'Bearing', 'RoadDirection', 'Lane',
+               'ActualLaneNum', 'VDType', 'LocationType', 'DetectionType', 'PositionLon',
+               'PositionLat', 'RoadID', 'RoadName', 'RoadClass', 'Start', 
+               'End', 'LocationMile']
+    # 巢狀欄位: (子節點路徑, 原欄位, 輸出欄位)
+    nested = [('{*}DetectionLinks/{*}DetectionLink', 'LinkID', 'LinkID'),
+              ('{*}DetectionLinks/{*}DetectionLink', 'Bearing', 'Bearing'),
+              ('{*}DetectionLinks/{*}DetectionLink', 'RoadDirection', 'RoadDirection'),
+              ('{*}DetectionLinks/{*}DetectionLink', 'LaneNum', 'Lane'),
+              ('{*}DetectionLinks/{*}DetectionLink', 'ActualLaneNum', 'ActualLaneNum'),
+              ('{*}RoadSection', 'Start', 'Start'),
+              ('{*}RoadSection', 'End', 'End')]
+    nested_cols = {out for _, _, out in nested}
+    flat_cols = [col for col in columns[3:] if col not in nested_cols]
+    buffers = {col: [] for col in columns[3:]}
+    header = {}
+    for elem in iter_xml_records(source, 'VD', header):
+        leaves = _leaf_texts(elem)
+        for col in flat_cols:
+            buffers[col].append(leaves.get(col))
+        sub_leaves = {}
+        for path, key, out in nested:
+            if path not in sub_leaves:
+                child = elem.find(path)
+                sub_leaves[path] = _leaf_texts(child) if child is not None else {}
+            buffers[out].append(sub_leaves[path].get(key))
+    return _buffers_to_df(buffers, header, columns, time_cols=['UpdateTime'])
+
+def vd_dynamic_iterparse_to_df(source) -> pd.DataFrame:
+    '''
+    VDLive.xml(.gz) 逐筆解析，每個 VDID x LinkFlow x Lane x Vehicle 一列，輸出同 vd_dynamic_dict_to_df
+    '''
+    columns = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'VDID', 'LinkID', 
+               'LaneID', 'LaneType', 'Speed', 'Occupancy', 'VehicleType',
+               'Volume', 'Speed2', 'Status', 'DataCollectTime']
+    buffers = {col: [] for col in columns[3:]}
+    header = {}
+    for elem in iter_xml_records(source, 'VDLive', header):
+        vd = _leaf_texts(elem)
+        for link_flow in elem.iterfind('{*}LinkFlows/{*}LinkFlow'):
+            link_id = _leaf_texts(link_flow).get('LinkID')
+            for lane in link_flow.iterfind('{*}Lanes/{*}Lane'):
+                lane_info = _leaf_texts(lane)
+                for vehicle in lane.iterfind('{*}Vehicles/{*}Vehicle'):
+                    vehicle_info = _leaf_texts(vehicle)
+                    buffers['VDID'].append(vd.get('VDID'))
+                    buffers['LinkID'].append(link_id)
+                    buffers['LaneID'].append(lane_info.get('LaneID'))
+                    buffers['LaneType'].append(lane_info.get('LaneType'))
+                    buffers['Speed'].append(lane_info.get('Speed'))
+                    buffers['Occupancy'].append(lane_info.get('Occupancy'))
+                    buffers['VehicleType'].append(vehicle_info.get('VehicleType'))
+                    buffers['Volume'].append(vehicle_info.get('Volume'))
+                    buffers['Speed2'].append(vehicle_info.get('Speed'))
+                    buffers['Status'].append(vd.get('Status'))
+                    buffers['DataCollectTime'].append(vd.get('DataCollectTime'))
+    return _buffers_to_df(buffers, header, columns, time_cols=['UpdateTime', 'DataCollectTime'])
+
+def etag_static_iterparse_to_df(source) -> pd.DataFrame:
+    '''
+    ETag.xml(.gz) 逐筆解析，輸出同 etag_static_dict_to_df
+    '''
+    columns = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'LinkVersion',
+               'ETagGantryID', 'LinkID', 'LocationType', 'PositionLon', 'PositionLat',
+               'RoadID', 'RoadName', 'RoadClass', 'RoadDirection', 'Start', 
+               'End', 'LocationMile']
+    buffers = {col: [] for col in columns[4:]}
+    header = {}
+    for elem in iter_xml_records(source, 'ETag', header):
+        leaves = _leaf_texts(elem)
+        road_section = elem.find('{*}RoadSection')
+        leaves.update(_leaf_texts(road_section) if road_section is not None else {})
+        for col in buffers:
+            buffers[col].append(leaves.get(col))
+    return _buffers_to_df(buffers, header, columns)
+
+def etagpair_iterparse_to_df(source) -> pd.DataFrame:
+    '''
+    ETagPair.xml(.gz) 逐筆解析，輸出同 etagpair_dict_to_df
+    '''
+    columns = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagGantryID', 
+               'EndETagGantryID', 'Description', 'Distance', 'StartLinkID', 'EndLinkID', 
+               'Geometry']
+    buffers = {col: [] for col in columns[3:]}
+    header = {}
+    for elem in iter_xml_records(source, 'ETagPair', header):
+        leaves = _leaf_texts(elem)
+        for col in buffers:
+            buffers[col].append(leaves.get(col))
+    return _buffers_to_df(buffers, header, columns)
+
+def etagpairlive_iterparse_to_df(source) -> pd.DataFrame:
+    '''
+    ETagPairLive.xml(.gz) 逐筆解析，每個 ETagPairID x Flow 一列，輸出同 etagpairlive_dict_to_df
+    '''
+    columns = ['UpdateTime', 'UpdateInterval', 'AuthorityCode', 'ETagPairID', 'StartETagStatus', 
+               'EndETagStatus', 'VehicleType', 'TravelTime', 'StandardDeviation', 'SpaceMeanSpeed', 
+               'VehicleCount', 'StartTime', 'EndTime', 'DataCollectTime']
+    pair_cols = ['ETagPairID', 'StartETagStatus', 'EndETagStatus', 'StartTime', 'EndTime', 'DataCollectTime']
+    flow_cols = ['VehicleType', 'TravelTime', 'StandardDeviation', 'SpaceMeanSpeed', 'VehicleCount']
+    buffers = {col: [] for col in columns[3:]}
+    header = {}
+    for elem in iter_xml_records(source, 'ETagPairLive', header):
+        pair = _leaf_texts(elem)
+        for flow in elem.iterfind('{*}Flows/{*}Flow'):
+            flow_info = _leaf_texts(flow)
+            for col in pair_cols:
+                buffers[col].append(pair.get(col))
+            for col in flow_cols:
+                buffers[col].append(flow_info.get(col))
+    return _buffers_to_df(buffers, header, columns, 
+                          time_cols=['UpdateTime', 'StartTime', 'EndTime', 'DataCollectTime'])
+
+
+# 檔名前綴 (VDLive_0000.xml.gz -> VDLive) 對應的 dict 轉 df 函數
+XML_DICT_TO_DF = {'VD': vd_static_dict_to_df,
+                  'VDLive': vd_dynamic_dict_to_df,
+                  'ETag': etag_static_dict_to_df,
+                  'ETagPair': etagpair_dict_to_df,
+                  'ETagPairLive': etagpairlive_dict_to_df}
+
+# 檔名前綴對應的 iterparse 轉 df 函數
+XML_ITERPARSE_TO_DF = {'VD': vd_static_iterparse_to_df,
+                       'VDLive': vd_dynamic_iterparse_to_df,
+                       'ETag': etag_static_iterparse_to_df,
+                       'ETagPair': etagpair_iterparse_to_df,
+                       'ETagPairLive': etagpairlive_iterparse_to_df}
+
+def xml_file_type(file_name: str) -> str:
+    '''
+    由檔名取得資料種類，例如 'ETagPairLive_0005.xml.gz' -> 'ETagPairLive'
+    '''
+    return os.path.basename(file_name).split('_')[0]
+
+def xml_gz_to_df(source, 
+                 file_type: str, 
+                 debug_xml_path: str=None, 
+                 method: str='iterparse') -> pd.DataFrame:
+    '''
+    單一 .xml.gz (路徑或 bytes) 直接在記憶體中解壓、解析並轉成 df，不經過解壓後的中間檔
+
+    Parameters
+    ----------
+    source: str | bytes
+        .xml.gz 的路徑，或從 http 下載的原始內容
+    file_type: str
+        XML_DICT_TO_DF 中的 key，'VD', 'VDLive', 'ETag', 'ETagPair', 'ETagPairLive'
+    debug_xml_path: str
+        有指定時會把解壓後的 xml 寫到這個路徑
+    method: str
+        'iterparse' 逐筆解析 (預設，記憶體固定)；'dict' 沿用 convert_xml_to_dict + *_dict_to_df
+    '''
+    if method == 'dict':
+        data_dict = convert_xml_to_dict(read_xml_bytes(source, debug_xml_path))
+        return XML_DICT_TO_DF[file_type](data_dict)
+    if debug_xml_path is not None:
+        source = read_xml_bytes(source, debug_xml_path)
+    return XML_ITERPARSE_TO_DF[file_type](source)
+
+def _ingest_sources(sources, 
+                    db_manager: 'DatabaseManager', 
+                    debug_xml_dir: str=None) -> dict:
+    '''
+    stream 系列 ingest 共用流程，sources 為 (date, file_name, 路徑或 bytes) 的 iterable
+    毀損的檔案不會中斷流程，最後統一回報；source 為 None 代表下載失敗
+    '''
+    summary = {'files': 0, 'rows': 0, 'failed': []}
+    with db_manager.bulk_load() as session:
+        for date, file_name, source in sources:
+            if source is None:
+                summary['failed'].append((date, file_name, 'download failed'))
+                continue
+            debug_xml_path = None
+            if debug_xml_dir is not None:
+                debug_xml_path = os.path.join(debug_xml_dir, date, file_name.replace('.gz', ''))
+            try:
+                df = xml_gz_to_df(source, xml_file_type(file_name), debug_xml_path)
+            except Exception as e:
+                summary['failed'].append((date, file_name, repr(e)))
+                continue
+            session.add(df, source=(date, file_name))
+            summary['files'] += 1
+            summary['rows'] += len(df)
+    _report_ingest_summary(summary)
+    return summary
+
+def _report_ingest_summary(summary: dict) -> None:
+    '''
+    印出 ingest 結果與毀損檔案清單
+    '''
+    print(f"Ingested {summary['files']} files, {summary['rows']} rows, {len(summary['failed'])} failed")
+    for date, file_name, error in summary['failed']:
+        if error == 'download failed':
+            print(f'{date}下載失敗，檔案為 {file_name}，先跳過')
+        else:
+            print(f'{date}資料毀損，檔案為 {file_name}，先跳過: {error}')
+
+def _datefolder_sources(date_list: list[str], input_zip_dir: str, file_prefix: str):
+    '''
+    依日期列出 input_zip_dir/YYYYMMDD 底下符合 file_prefix 的 .xml.gz，yield (date, file_name, path)
+    '''
+    for date in tqdm(date_list):
+        input_dir = f'{input_zip_dir}/{date}'
+        if not os.path.isdir(input_dir):
+            continue
+        for file_name in sorted(os.listdir(input_dir)):
+            if file_name.startswith(file_prefix) and file_name.endswith('.xml.gz'):
+                yield date, file_name, os.path.join(input_dir, file_name)
+
+def ingest_datefolder_stream(date_list: list[str],
+                             input_zip_dir: str,
+                             file_prefix: str,
+                             db_manager: 'DatabaseManager',
+                             debug_xml_dir: str=None) -> dict:
+    '''
+    直接讀取下載下來的 .xml.gz 寫入資料庫，取代 解壓到 unzip_* -> convert_xml_to_dict 的流程
+
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    input_zip_dir: str
+        原始 .xml.gz 的上層路徑，例如 '../data/raw/VD'
+    file_prefix: str
+        要處理的檔案種類，'VD_', 'VDLive_', 'ETag_', 'ETagPair_', 'ETagPairLive_'
+    db_manager: DatabaseManager
+        寫入的目標 table
+    debug_xml_dir: str
+        有指定時才會把解壓後的 xml 依日期寫到這個資料夾，除錯用
+
+    Return
+    ------
+    dict: files, rows 與 failed (date, file_name, error) 清單
+    '''
+    return _ingest_sources(_datefolder_sources(date_list, input_zip_dir, file_prefix), 
+                           db_manager, debug_xml_dir)
+
+def _parse_xml_source(task: tuple) -> tuple:
+    '''
+    process pool 的 worker，解析單一 .xml.gz，回傳 (date, file_name, df 或 None, error 或 None)
+    '''
+    date, file_name, source = task
+    try:
+        return date, file_name, xml_gz_to_df(source, xml_file_type(file_name)), None
+    except Exception as e:
+        return date, file_name, None, repr(e)
+
+def ingest_datefolder_parallel(date_list: list[str],
+                               input_zip_dir: str,
+                               file_prefix: str,
+                               db_manager: 'DatabaseManager',
+                               max_workers: int=None,
+                               batch_rows: int=500_000,
+                               max_pending: int=None) -> dict:
+    '''
+    多核心版本的 ingest_datefolder_stream
+    由 process pool 平行解析 .xml.gz，主程序為唯一的 writer，依檔案順序收集 df 寫入 bulk_load session，
+    累積到 batch_rows 筆才 commit 一次，SQLite 不會有多個 writer 同時寫入
+
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    input_zip_dir: str
+        原始 .xml.gz 的上層路徑，例如 '../data/raw/VD'
+    file_prefix: str
+        要處理的檔案種類，'VD_', 'VDLive_', 'ETag_', 'ETagPair_', 'ETagPairLive_'
+    db_manager: DatabaseManager
+        寫入的目標 table
+    max_workers: int
+        解析用的 process 數，預設為 cpu 數
+    batch_rows: int
+        累積多少筆才 commit 一次
+    max_pending: int
+        同時送進 pool 尚未取回的檔案數上限，避免解析速度大於寫入速度時 df 堆積在記憶體，預設為 max_workers * 4
+
+    Return
+    ------
+    dict: files, rows, commits, elapsed_sec 與 failed (date, file_name, error) 清單
+    '''
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or max_workers * 4
+    summary = {'files': 0, 'rows': 0, 'failed': []}
+    start = time.time()
+
+    def collect(future):
+        date, file_name, df, error = future.result()
+        if error is not None:
+            summary['failed'].append((date, file_name, error))
+            return
+        session.add(df, source=(date, file_name))
+        summary['files'] += 1
+        summary['rows'] += len(df)
+
+    pending = deque()
+    with db_manager.bulk_load(commit_rows=batch_rows) as session, \
+         ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for task in _datefolder_sources(date_list, input_zip_dir, file_prefix):
+            pending.append(executor.submit(_parse_xml_source, task))
+            # 依送出順序取回，寫入順序與檔案順序一致
+            if len(pending) >= max_pending:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    summary['commits'] = session.commits
+    summary['elapsed_sec'] = round(time.time() - start, 3)
+    _report_ingest_summary(summary)
+    return summary
+
+def ingest_remote_stream(date_list: list[str],
+                         dataset: str,
+                         file_prefix: str,
+                         db_manager: 'DatabaseManager',
+                         engine: 'ds.DownloadEngine'=None,
+                         debug_xml_dir: str=None,
+                         host_url: str=ds.TISVCLOUD_URL,
+                         max_pending: int=None) -> dict:
+    '''
+    從 tisvcloud 下載 .xml.gz 後直接在記憶體中解壓、解析並寫入資料庫，完全不落地
+
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    dataset: str
+        'VD' 或 'ETag'
+    file_prefix: str
+        要處理的檔案種類，'VD_', 'VDLive_', 'ETag_', 'ETagPair_', 'ETagPairLive_'
+    db_manager: DatabaseManager
+        寫入的目標 table
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    debug_xml_dir: str
+        有指定時才會把解壓後的 xml 依日期寫到這個資料夾，除錯用
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
+    max_pending: int
+        同時送出尚未解析的檔案數上限，避免解析速度跟不上下載時 response 堆積在記憶體，預設為 engine.max_workers * 4
+
+    Return
+    ------
+    dict: files, rows 與 failed (date, file_name, error) 清單，下載失敗的 error 為 'download failed'
+    '''
+    own_engine = engine is None
+    engine = ds.DownloadEngine() if own_engine else engine
+    max_pending = max_pending or engine.max_workers * 4
+
+    def sources():
+        # 下載交給執行緒池並行，解析維持在主執行緒依檔名順序進行
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=engine.max_workers) as executor:
+            for date in tqdm(date_list):
+                base_url = f"{host_url}/history/motc20/{dataset}/{date}/"
+                file_names = [f for f in ds.list_remote_files(engine, base_url) if f.startswith(file_prefix)]
+                for file_name in file_names:
+                    pending.append((date, file_name, executor.submit(engine.fetch_bytes, f'{base_url}{file_name}')))
+                    # 依送出順序取回，解析跟不上時不再送出新的下載
+                    if len(pending) >= max_pending:
+                        date_, file_name_, future = pending.popleft()
+                        yield date_, file_name_, future.result()
+            while pending:
+                date_, file_name_, future = pending.popleft()
+                yield date_, file_name_, future.result()
+
+    try:
+        return _ingest_sources(sources(), db_manager, debug_xml_dir)
+    finally:
+        if own_engine:
+            engine.close()
+
+def generate_daterange_combinations(start_year: int, 
+                                    start_month: int, 
+                                    end_year: int, 
+                                    end_month: int) -> list[list[str]]:
+    '''
+    根據輸入的起訖年、月來組成一個list of list，list中會以年月為基本單位去包裝每個月的頭尾，方便後續使用
+
+    Parameters
+    ----------
+    start_year: int
+    start_month: int
+    end_year: int
+    end_month: int
+    
+    Return
+    ------
+    list: 
+    '''
+    date_combinations = []
+    start_date = pd.Timestamp(start_year, start_month, 1)
+    end_date = pd.Timestamp(end_year, end_month, 1) + pd.offsets.MonthEnd(1)
+    
+    current_date = start_date
+    while current_date <= end_date:
+        start_of_month = current_date.strftime('%Y%m%d')
+        end_of_month = (current_date + pd.offsets.MonthEnd(1)).strftime('%Y%m%d')
+        date_combinations.append([start_of_month, end_of_month])
+        current_date += pd.offsets.MonthBegin(1)
+        
+    return date_combinations
+
+# 增量同步 (sync) 用的資料集設定
+# kind: 'datefolder' = 依日期資料夾存放的 .xml.gz, 'tdcs' = 每天一個 tar.gz
+# minutes: 動態資料的預期檔案頻率 (分鐘)
+SYNC_DATASETS = {'VD': {'kind': 'datefolder', 'raw_dir': 'VD', 'unzip_dir': 'unzip_VD',
+                        'static': ['VD_0000.xml.gz'], 'live_prefix': 'VDLive_', 'minutes': 1},
+                 'ETag': {'kind': 'datefolder', 'raw_dir': 'ETag', 'unzip_dir': 'unzip_ETag',
+                          'static': ['ETag_0000.xml.gz', 'ETagPair_0000.xml.gz'], 'live_prefix': 'ETagPairLive_', 'minutes': 5},
+                 'M03A': {'kind': 'tdcs', 'raw_dir': 'ETag_gantry_vol', 'unzip_dir': 'unzip_etag_gantry_vol', 'minutes': 5},
+                 'M04A': {'kind': 'tdcs', 'raw_dir': 'ETag_intergantry_traveltime', 'unzip_dir': 'unzip_etag_intergantry_traveltime', 'minutes': 5},
+                 'M05A': {'kind': 'tdcs', 'raw_dir': 'ETag_intergantry_speed', 'unzip_dir': 'unzip_etag_intergantry_speed', 'minutes': 5}}
+
+# VD/ETag 各檔案種類寫入的 table
+XML_TABLE_NAMES = {'VD': 'VD_STATIC',
+                   'VDLive': 'VD_DYNAMIC',
+                   'ETag': 'ETAG_STATIC',
+                   'ETagPair': 'ETAG_PAIR',
+                   'ETagPairLive': 'ETAG_PAIR_LIVE'}
+
+# M03A/M04A/M05A csv 沒有 header，欄位順序與時間格式
+TDCS_COLUMNS = {'M03A': ['TimeStamp', 'GantryID', 'Direction', 'VehicleType', 'Volume'],
+                'M04A': ['TimeStamp', 'GantryFrom', 'GantryTo', 'VehicleType', 'TravelTime', 'Traffic'],
+                'M05A': ['TimeStamp', 'GantryFrom', 'GantryTo', 'VehicleType', 'Speed', 'Volume']}
+TDCS_TIME_FORMAT = {'M03A': '%Y-%m-%d %H:%M',
+                    'M04A': '%Y/%m/%d %H:%M',
+                    'M05A': '%Y/%m/%d %H:%M'}
+TDCS_DTYPES = {'M03A': {'GantryID': str, 'Direction': str, 'VehicleType': 'int16', 'Volume': 'int32'},
+               'M04A': {'GantryFrom': str, 'GantryTo': str, 'VehicleType': 'int16', 'TravelTime': 'int32', 'Traffic': 'int32'},
+               'M05A': {'GantryFrom': str, 'GantryTo': str, 'VehicleType': 'int16', 'Speed': 'int16', 'Volume': 'int32'}}
+
+def tdcs_csv_bytes_to_df(data: bytes, dataset: str) -> pd.DataFrame:
+    '''
+    無 header 的 TDCS csv 內容 (可為多個 csv 直接串接) 轉成帶型態的 df
+    '''
+    df = pd.read_csv(io.BytesIO(data), names=TDCS_COLUMNS[dataset], dtype=TDCS_DTYPES[dataset])
+    df['TimeStamp'] = pd.to_datetime(df['TimeStamp'], format=TDCS_TIME_FORMAT[dataset])
+    return df
+
+def read_tdcs_tar(tar_path, 
+                  by: str='day', 
+                  slots: list[str]=None):
+    '''
+    不解壓到硬碟，單次走訪 M0xA_YYYYMMDD.tar.gz 中的成員，直接解析 TDCS_M0xA_YYYYMMDD_HHmm00.csv
+    同一天 (或同一小時) 的 csv 內容先串接起來，只呼叫一次 read_csv
+
+    Parameters
+    ----------
+    tar_path: str | bytes
+        tar.gz 的路徑或原始 bytes
+    by: str
+        'day' 每天 yield 一次，key 為 'YYYYMMDD'；'hour' 每小時 yield 一次，key 為 ('YYYYMMDD', 'HH')
+    slots: list[str]
+        只讀取這些 HHmm 時段，例如 ['0000', '0005']，預設全部
+
+    Return
+    ------
+    generator of (key, pd.DataFrame)
+    '''
+    slots = set(slots) if slots is not None else None
+    if isinstance(tar_path, (bytes, bytearray)):
+        tar = tarfile.open(fileobj=io.BytesIO(tar_path), mode='r|gz')
+    else:
+        tar = tarfile.open(tar_path, mode='r|gz')
+    current_key, dataset, chunks = None, None, []
+    with tar:
+        # 'r|gz' 為 stream 模式，成員必須依序讀取，不能回頭
+        for member in tar:
+            file_name = os.path.basename(member.name)
+            if not (member.isfile() and file_name.startswith('TDCS_') and file_name.endswith('.csv')):
+                continue
+            # TDCS_M04A_20240101_000000.csv -> M04A, 20240101, 0000
+            _, member_dataset, date, hhmmss = file_name[:-4].split('_')
+            if slots is not None and hhmmss[:4] not in slots:
+                continue
+            key = date if by == 'day' else (date, hhmmss[:2])
+            if key != current_key and chunks:
+                yield current_key, tdcs_csv_bytes_to_df(b''.join(chunks), dataset)
+                chunks = []
+            current_key, dataset = key, member_dataset
+            content = tar.extractfile(member).read()
+            if content and not content.endswith(b'\n'):
+                content += b'\n'
+            chunks.append(content)
+        if chunks:
+            yield current_key, tdcs_csv_bytes_to_df(b''.join(chunks), dataset)
+
+def day_slots(minutes: int) -> list[str]:
+    '''
+    一天中依固定頻率的 HHmm 字串，例如 minutes=5 -> ['0000', '0005', ..., '2355']
+    '''
+    return [f'{m // 60:02d}{m % 60:02d}' for m in range(0, 24 * 60, minutes)]
+
+def expected_raw_files(dataset: str, 
+                       date: str, 
+                       manifest: 'ds.DownloadManifest'=None) -> list[str]:
+    '''
+    某資料集某日期預期應存在的原始檔名
+    manifest 中有該日期的最終 listing (已過 settle 期間才抓取) 時以 listing 為準 (遠端本來就缺的檔案不會一直被視為缺漏)，
+    否則依 SYNC_DATASETS 的頻率推算
+    '''
+    if manifest is not None and manifest.has_listing(dataset, date):
+        return manifest.listing(dataset, date)
+    config = SYNC_DATASETS[dataset]
+    if config['kind'] == 'tdcs':
+        return [f'{dataset}_{date}.tar.gz']
+    return config['static'] + [f"{config['live_prefix']}{hhmm}.xml.gz" for hhmm in day_slots(config['minutes'])]
+
+def find_missing_raw_files(dataset: str,
+                           date_list: list[str],
+                           raw_root: str='../data/raw',
+                           manifest: 'ds.DownloadManifest'=None) -> dict:
+    '''
+    比對預期檔案與磁碟上已完成下載的檔案，找出每個日期缺漏的原始檔
+    每個日期只做一次 os.listdir，不逐檔 os.path.exists；manifest 標記為 done 但磁碟上已不存在的檔案仍視為缺漏，
+    manifest 中不是 done 的檔案 (例如被 reconcile 判定大小不符) 即使磁碟上有也視為缺漏
+
+    Return
+    ------
+    dict: {date: [缺漏的檔名]}，沒有缺漏的日期不會出現
+    '''
+    missing = {}
+    for date, (_, finalized) in _finalized_raw_files(dataset, date_list, raw_root, manifest):
+        date_missing = [f for f in expected_raw_files(dataset, date, manifest) if f not in finalized]
+        if date_missing:
+            missing[date] = date_missing
+    return missing
+
+def _finalized_raw_files(dataset: str,
+                         date_list: list[str],
+                         raw_root: str,
+                         manifest: 'ds.DownloadManifest'=None):
+    '''
+    逐日 yield (date, (save_dir, 磁碟上已完成下載的檔名 set))，每個日期只做一次 os.listdir，
+    殘留 .part 的檔案與 manifest 中不是 done 的檔案不算完成
+    '''
+    config = SYNC_DATASETS[dataset]
+    tdcs_files = None
+    for date in date_list:
+        if config['kind'] == 'tdcs':
+            save_dir = f"{raw_root}/{config['raw_dir']}"
+            if tdcs_files is None:
+                tdcs_files = set(os.listdir(save_dir)) if os.path.isdir(save_dir) else set()
+            on_disk = tdcs_files
+        else:
+            save_dir = f"{raw_root}/{config['raw_dir']}/{date}"
+            on_disk = set(os.listdir(save_dir)) if os.path.isdir(save_dir) else set()
+        # 有殘留 .part 的檔案視為未完成
+        finalized = {f for f in on_disk if f + ds.PART_SUFFIX not in on_disk}
+        if manifest is not None:
+            finalized -= manifest.stale_files(dataset, date, save_dir)
+        yield date, (save_dir, finalized)
+
+def ingested_xml_files(db_path: str,
+                       table_name: str,
+                       date_list: list[str],
+                       backend: str='sqlite') -> dict:
+    '''
+    INGEST_LOG 中 table_name 在各日期已寫入的原始檔
+
+    Return
+    ------
+    dict: {date: set(檔名)}，沒有紀錄的日期不會出現
+    '''
+    ingested = {}
+    with open_table(backend, db_path, INGEST_LOG_TABLE, schema='INGEST_LOG') as log_tb:
+        if not log_tb.table_exists():
+            return ingested
+        log_df = log_tb.read_data(columns=['Date', 'FileName'], 
+                                  filters={'TableName': [table_name], 'Date': list(date_list)})
+    for date, file_name in zip(log_df['Date'], log_df['FileName']):
+        ingested.setdefault(date, set()).add(file_name)
+    return ingested
+
+def _table_has_rows_on(db_manager, date: str) -> bool:
+    '''
+    table 在 date 當天 (台灣時間) 是否已有資料，優先使用索引開頭的時間欄位，只讀取第一筆
+    '''
+    if not db_manager.table_exists():
+        return False
+    schema = TABLE_SCHEMAS[db_manager.schema]
+    indexed = [columns[0] for columns in schema['indexes'] if columns[0] in schema['time_columns']]
+    time_column = indexed[0] if indexed else schema_time_column(db_manager.schema)
+    start = pd.Timestamp(date)
+    chunks = db_manager.iter_data(chunksize=1, columns=[time_column], start=start, end=start + pd.Timedelta(days=1),
+                                  time_column=time_column, compact=False)
+    return next(chunks, None) is not None
+
+def find_missing_xml_files(db_path: str,
+                           dataset: str,
+                           date_list: list[str],
+                           raw_root: str='../data/raw',
+                           backend: str='sqlite',
+                           manifest: 'ds.DownloadManifest'=None) -> dict:
+    '''
+    VD/ETag 的資料庫端缺漏檢查：磁碟上已完成下載、但 INGEST_LOG 中沒有寫入紀錄的原始檔，
+    不論是本次或之前下載的都會列出 (例如下載後 ingest 中斷、或只下載沒有寫入資料庫)
+    INGEST_LOG 建立前寫入的舊資料庫沒有紀錄，某日期沒有任何紀錄但 table 當天已有資料時視為已寫入，避免重複寫入
+
+    Return
+    ------
+    dict: {table_name: [(date, file_name, path)]}，沒有缺漏的 table 不會出現
+    '''
+    finalized = dict(_finalized_raw_files(dataset, date_list, raw_root, manifest))
+    missing = {}
+    for file_type, table_name in XML_TABLE_NAMES.items():
+        sources = {date: sorted(f for f in files if f.endswith('.xml.gz') and xml_file_type(f) == file_type)
+                   for date, (_, files) in finalized.items()}
+        if not any(sources.values()):
+            continue
+        ingested = ingested_xml_files(db_path, table_name, [date for date, files in sources.items() if files], backend)
+        with open_table(backend, db_path, table_name, schema=table_name) as db_manager:
+            for date, file_names in sources.items():
+                if not file_names:
+                    continue
+                if date not in ingested and _table_has_rows_on(db_manager, date):
+                    continue
+                save_dir = finalized[date][0]
+                missing.setdefault(table_name, []).extend(
+                    (date, file_name, os.path.join(save_dir, file_name))
+                    for file_name in file_names if file_name not in ingested.get(date, set()))
+    return {table_name: sources for table_name, sources in missing.items() if sources}
+
+def find_missing_tdcs_slots(db_path: str,
+                            dataset: str,
+                            date_list: list[str],
+                            table_name_prefix: str=None,
+                            backend: str='sqlite') -> dict:
+    '''
+    檢查資料庫中 ETAG_M0xA_YYYYMM table (或 parquet store 中的 M0xA table) 缺少哪些 5 分鐘時段
+
+    Return
+    ------
+    dict: {date: [缺漏的 HHmm]}，沒有缺漏的日期不會出現
+    '''
+    table_name_prefix = table_name_prefix or f'ETAG_{dataset}'
+    slots = day_slots(SYNC_DATASETS[dataset]['minutes'])
+    present = {}
+    if backend == 'parquet':
+        start = pd.Timestamp(min(date_list))
+        end = pd.Timestamp(max(date_list)) + pd.Timedelta(days=1)
+        store = ParquetStoreManager(db_path, dataset, schema=dataset)
+        timestamps = store.read_data(columns=['TimeStamp'], start=start, end=end)['TimeStamp'].drop_duplicates()
+        for date, hhmm in zip(timestamps.dt.strftime('%Y%m%d'), timestamps.dt.strftime('%H%M')):
+            present.setdefault(date, set()).add(hhmm)
+    else:
+        con = sqlite3.connect(db_path)
+        try:
+            tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for year_month in sorted({date[:6] for date in date_list}):
+                table_name = f'{table_name_prefix}_{year_month}'
+                if table_name not in tables:
+                    continue
+                values = pd.Series([row[0] for row in con.execute(f'SELECT DISTINCT TimeStamp FROM {table_name}')])
+                # typed table 存的是 epoch 秒數，舊的無型態 table 存的是字串
+                if pd.api.types.is_numeric_dtype(values):
+                    timestamps = decode_timestamp(values)
+                else:
+                    timestamps = pd.to_datetime(values, format='ISO8601')
+                for date, hhmm in zip(timestamps.dt.strftime('%Y%m%d'), timestamps.dt.strftime('%H%M')):
+                    present.setdefault(date, set()).add(hhmm)
+        finally:
+            con.close()
+    missing = {}
+    for date in date_list:
+        date_missing = [hhmm for hhmm in slots if hhmm not in present.get(date, set())]
+        if date_missing:
+            missing[date] = date_missing
+    return missing
+
+def _ingest_tdcs_slots(db_path: str,
+                       dataset: str,
+                       missing_slots: dict,
+                       raw_dir: str,
+                       backend: str='sqlite',
+                       manifest: 'ds.DownloadManifest'=None) -> int:
+    '''
+    直接從 raw_dir 下的 M0xA_YYYYMMDD.tar.gz 讀取缺漏時段寫入對應月份的 table，回傳寫入筆數
+    有 manifest 時，讀完後把 tar.gz 中本來就沒有的時段記錄下來，之後同一個檔案不會再為了這些時段重新讀取
+    '''
+    n_rows = 0
+    for date, slots in tqdm(missing_slots.items()):
+        tar_path = os.path.join(raw_dir, f'{dataset}_{date}.tar.gz')
+        if not ds.is_finalized(tar_path):
+            continue
+        size = os.path.getsize(tar_path)
+        if manifest is not None:
+            absent = manifest.absent_slots(dataset, date, size)
+            slots = [hhmm for hhmm in slots if hhmm not in absent]
+            if not slots:
+                continue
+        try:
+            frames = [df for _, df in read_tdcs_tar(tar_path, by='day', slots=slots)]
+        except (tarfile.TarError, OSError, EOFError, ValueError) as e:
+            print(f'{tar_path} 讀取失敗，先跳過: {e!r}')
+            continue
+        if manifest is not None:
+            found = {hhmm for df in frames for hhmm in df['TimeStamp'].dt.strftime('%H%M').unique()}
+            manifest.record_archive(dataset, date, size, 
+                                    sorted(absent | {hhmm for hhmm in slots if hhmm not in found}))
+        if not frames:
+            continue
+        # M04A 的彙總表由 manager 在 commit 時只重算新寫入時段所在的區間
+        with open_table(backend, db_path, tdcs_table_name(backend, dataset, date[:6]), schema=dataset) as etag_temp_tb:
+            etag_temp_tb.initialize_table()
+            with etag_temp_tb.bulk_load() as session:
+                for df in frames:
+                    session.add(df)
+                    n_rows += len(df)
+    return n_rows
+
+def ingest_tdcs_archives(date_list: list[str],
+                         raw_dir: str,
+                         db_path: str,
+                         backend: str='sqlite',
+                         only_missing: bool=True,
+                         manifest: 'ds.DownloadManifest'=None) -> dict:
+    '''
+    不解壓，直接以 read_tdcs_tar 讀取 raw_dir 下的 M0xA_YYYYMMDD.tar.gz，以 bulk_load 寫入對應月份的 table
+    取代 decompress_etag_* 解壓成每天 288 個 csv 再逐檔 read_csv 的流程，M04A 寫入後同時更新彙總表
+
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    raw_dir: str
+        tar.gz 所在的資料夾，例如 '../data/raw/ETag_intergantry_traveltime'，資料集由檔名判斷
+    db_path: str
+        sqlite 為資料庫路徑，parquet 為 store 根目錄
+    backend: str
+        'sqlite' 或 'parquet'
+    only_missing: bool
+        True 時只寫入資料庫中缺少的 5 分鐘時段 (find_missing_tdcs_slots)，重複執行不會重複寫入；
+        False 時整個 tar.gz 都寫入
+    manifest: DownloadManifest
+        有指定時記錄 tar.gz 中本來就沒有的時段，之後不再重讀
+
+    Return
+    ------
+    dict: {dataset: 寫入筆數}
+    '''
+    dates = set(date_list)
+    archives = {}
+    for file_name in sorted(os.listdir(raw_dir)):
+        match = re.fullmatch(r'(M0[345]A)_(\d{8})\.tar\.gz', file_name)
+        if match and match.group(2) in dates:
+            archives.setdefault(match.group(1), []).append(match.group(2))
+    written = {}
+    for dataset, archive_dates in archives.items():
+        if only_missing:
+            slots = find_missing_tdcs_slots(db_path, dataset, archive_dates, backend=backend)
+        else:
+            slots = {date: day_slots(SYNC_DATASETS[dataset]['minutes']) for date in archive_dates}
+        written[dataset] = _ingest_tdcs_slots(db_path, dataset, slots, raw_dir, backend=backend, manifest=manifest)
+    return written
+
+def sync_raw_datasets(start_date: str,
+                      end_date: str,
+                      datasets: list[str]=('VD', 'ETag', 'M03A', 'M04A', 'M05A'),
+                      raw_root: str='../data/raw',
+                      db_path: str=None,
+                      decompress: bool=True,
+                      backend: str='sqlite',
+                      engine: 'ds.DownloadEngine'=None,
+                      manifest: 'ds.DownloadManifest'=None,
+                      host_url: str=ds.TISVCLOUD_URL) -> dict:
+    '''
+    增量同步模式：找出日期區間內各資料集缺漏的日期與當日檔案，只下載、解壓、寫入缺漏的部分
+    已經完整的日期只需要一次 listdir 與一次資料庫查詢，重複執行幾乎沒有成本
+    開始前先以 manifest.reconcile 把已被刪除或大小不符的 done 檔案改回 pending
+
+    Parameters
+    ----------
+    start_date: str
+        e.g. '20230101'
+    end_date: str
+        e.g. '20231231'
+    datasets: list[str]
+        要同步的資料集，'VD', 'ETag', 'M03A', 'M04A', 'M05A'
+    raw_root: str
+        原始資料與解壓資料的上層路徑，資料夾名稱依 SYNC_DATASETS
+    db_path: str
+        有指定時會把缺漏的資料寫入資料庫，VD/ETag 寫入磁碟上所有 INGEST_LOG 中還沒有紀錄的檔案 (find_missing_xml_files)，
+        M03A/M04A/M05A 依資料庫中實際缺少的 5 分鐘時段寫入，tar.gz 本來就沒有的時段記錄在 manifest 中不再重讀
+    decompress: bool
+        未指定 db_path 時，M03A/M04A/M05A 是否把新下載的 tar.gz 解壓到 unzip 資料夾
+        寫入資料庫時 VD/ETag 直接讀 .xml.gz、M03A/M04A/M05A 直接讀 tar.gz，都不需要解壓
+    backend: str
+        'sqlite' 寫入 db_path 資料庫；'parquet' 時 db_path 為 parquet store 的根目錄
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 raw_root 下的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
+
+    Return
+    ------
+    dict: {dataset: {'missing_files', 'downloaded', 'failed', 'ingested_rows'}}
+    '''
+    date_list = ds.generate_date_strings(start_date, end_date)
+    own_engine = engine is None
+    engine = ds.DownloadEngine() if own_engine else engine
+    own_manifest = manifest is None
+    manifest = ds.DownloadManifest(os.path.join(raw_root, ds.MANIFEST_FILE_NAME)) if own_manifest else manifest
+    summary = {}
+    try:
+        for dataset in datasets:
+            config = SYNC_DATASETS[dataset]
+            n_reset = manifest.reconcile(dataset)
+            if n_reset:
+                print(f'{dataset}: {n_reset} files marked done are missing or truncated on disk')
+            missing = find_missing_raw_files(dataset, date_list, raw_root, manifest)
+            n_missing = sum(len(files) for files in missing.values())
+            print(f'{dataset}: {n_missing} files missing over {len(missing)} dates')
+
+            # 只下載缺漏的檔案
+            tasks, task_keys = [], []
+            for date, file_names in missing.items():
+                if config['kind'] == 'tdcs':
+                    base_url = f'{host_url}/history/TDCS/{dataset}/'
+                    save_dir = f"{raw_root}/{config['raw_dir']}"
+                else:
+                    base_url = f'{host_url}/history/motc20/{dataset}/{date}/'
+                    save_dir = f"{raw_root}/{config['raw_dir']}/{date}"
+                for file_name in file_names:
+                    tasks.append((f'{base_url}{file_name}', os.path.join(save_dir, file_name)))
+                    task_keys.append((dataset, date, file_name, save_dir))
+            stats = ds.run_download_tasks(tasks, engine, desc=dataset)
+            ds.record_download_results(manifest, task_keys)
+            downloaded = [key for key in task_keys if ds.is_finalized(os.path.join(key[3], key[2]))]
+            if config['kind'] == 'datefolder':
+                # 下載失敗且已過 settle 期間的日期補抓一次 listing 存入 manifest，遠端本來就不存在的檔案之後就不會再被視為缺漏
+                # 較近的日期遠端可能還在補檔，listing 不快取，下次同步仍依頻率推算
+                failed_dates = {key[1] for key in task_keys if not ds.is_finalized(os.path.join(key[3], key[2]))}
+                for date in sorted(failed_dates):
+                    if ds.is_historical(date) and not manifest.has_listing(dataset, date):
+                        ds.get_remote_listing(engine, manifest, dataset, date, f'{host_url}/history/motc20/{dataset}/{date}/')
+
+            # 解壓與寫入只處理缺漏的部分
+            ingested_rows = 0
+            if config['kind'] == 'tdcs':
+                if db_path is not None:
+                    missing_slots = find_missing_tdcs_slots(db_path, dataset, date_list, backend=backend)
+                    ingested_rows = _ingest_tdcs_slots(db_path, dataset, missing_slots, 
+                                                       f"{raw_root}/{config['raw_dir']}", backend=backend,
+                                                       manifest=manifest)
+                elif decompress and downloaded:
+                    decompress_procedure_direct(sorted({key[1] for key in downloaded}),
+                                                f"{raw_root}/{config['raw_dir']}",
+                                                f"{raw_root}/{config['unzip_dir']}")
+            elif db_path is not None:
+                # 不只本次下載的檔案，之前下載但還沒寫入 (或寫入中斷) 的檔案也一併補上
+                missing_sources = find_missing_xml_files(db_path, dataset, date_list, raw_root, backend, manifest)
+                for table_name, sources in missing_sources.items():
+                    with open_table(backend, db_path, table_name, schema=table_name) as db_manager:
+                        result = _ingest_sources(sources, db_manager)
+                    ingested_rows += result['rows']
+
+            summary[dataset] = {'missing_files': n_missing,
+                                'downloaded': len(downloaded),
+                                'failed': stats['failed'],
+                                'ingested_rows': ingested_rows}
+    finally:
+        if own_engine:
+            engine.close()
+        if own_manifest:
+            manifest.close()
+    return summary
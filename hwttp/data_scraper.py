@@ -1,10 +1,36 @@
 import requests
 import pandas as pd
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 import os
+import re
+import json
 import time
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+import urllib3
+import hashlib
+import base64
+
+# 下載中的暫存檔副檔名，完成驗證後才會 rename 成正式檔名
+PART_SUFFIX = '.part'
+# 資料來源主機，離線測試時可改指向 scraper_replay.ReplayServer
+TISVCLOUD_URL = 'https://tisvcloud.freeway.gov.tw'
+# 下載紀錄的檔名，預設放在原始資料的上層資料夾 (例如 ../data/raw)，所有資料集共用
+MANIFEST_FILE_NAME = 'download_manifest.db'
+DEFAULT_MANIFEST_PATH = f'../data/raw/{MANIFEST_FILE_NAME}'
+# 日期結束後多少天內遠端目錄可能仍在補上傳檔案，這段期間的 listing 不快取
+LISTING_SETTLE_DAYS = 2
+
+def default_manifest_path(save_dir: str) -> str:
+    '''
+    依資料集的存放路徑推算預設的 manifest 位置，即 save_dir 上一層資料夾中的 MANIFEST_FILE_NAME
+    例如 '../data/raw/VD/' -> '../data/raw/download_manifest.db'
+    '''
+    return os.path.join(os.path.dirname(os.path.normpath(save_dir)), MANIFEST_FILE_NAME)
 
 def create_directory_if_not_exists(path: str) -> None:
     """
@@ -26,9 +52,10 @@ def create_directory_if_not_exists(path: str) -> None:
     return None
 
 def download_file(url: str, 
-                  save_path: str) -> None:
+                  save_path: str,
+                  engine: 'DownloadEngine'=None) -> None:
     '''
-    單一文件下載處理
+    單一文件下載處理，會先寫入暫存的 .part 檔，中斷後可續傳，驗證完整後才 rename 成 save_path
 
     Parameters
     ----------
@@ -36,22 +63,43 @@ def download_file(url: str,
         目標文件的url
     save_path: str
         文件下載後儲存的路徑
+    engine: DownloadEngine
+        可傳入共用的下載引擎重複使用連線，不傳入時會建立一個單次使用的引擎
     
     Return
     -----
     None
     '''
-    response = requests.get(url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024  # 1 Kilobyte
-    
-    if response.status_code != 200:
-        print(f"Failed to download {url}")
+    if engine is not None:
+        engine.fetch(url, save_path)
         return
+    with DownloadEngine(max_workers=1) as engine:
+        engine.fetch(url, save_path)
 
-    with open(save_path, 'wb') as file:
-        for data in response.iter_content(block_size):
-            file.write(data)
+def is_finalized(save_path: str) -> bool:
+    '''
+    檢查檔案是否為已完成下載的正式檔案 (存在且沒有殘留的 .part 暫存檔)
+    '''
+    return os.path.exists(save_path) and not os.path.exists(save_path + PART_SUFFIX)
+
+def _parse_content_range_total(content_range: str) -> int:
+    '''
+    解析 'bytes 100-199/1000' 格式的 Content-Range，回傳檔案總長度，無法得知時回傳 -1
+    '''
+    if not content_range or '/' not in content_range:
+        return -1
+    total = content_range.rsplit('/', 1)[1].strip()
+    return int(total) if total.isdigit() else -1
+
+def _verify_md5(file_path: str, content_md5: str, block_size: int=1024*1024) -> bool:
+    '''
+    比對檔案與 Content-MD5 header (base64 編碼的 md5)
+    '''
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode() == content_md5.strip()
 
 def download_files(base_url: str, 
                    file_names: list[str], 
@@ -86,6 +134,693 @@ def download_files(base_url: str,
             print(f"Downloading {url} to {save_path} facing errors")
 
 
+class TokenBucketRateLimiter:
+    '''
+    token bucket 限速器，控制對單一主機送出請求的頻率
+    遇到 429/5xx 或回應過慢時會把速率砍半 (backoff)，之後每次正常回應再逐步加回 max_rate
+
+    Parameters
+    ----------
+    rate: float
+        每秒補充的 token 數，也就是穩定狀態下每秒最多送出的請求數
+    capacity: int
+        bucket 容量，允許瞬間爆發的請求數
+    min_rate: float
+        backoff 後速率的下限
+    backoff_factor: float
+        每次 backoff 時速率乘上的倍數
+    recover_step: float
+        每次正常回應後速率增加的量
+    '''
+    def __init__(self,
+                 rate: float=4.0,
+                 capacity: int=8,
+                 min_rate: float=0.2,
+                 backoff_factor: float=0.5,
+                 recover_step: float=0.1) -> None:
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.backoff_factor = backoff_factor
+        self.recover_step = recover_step
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self) -> None:
+        '''
+        取得一個 token，不足時會 sleep 到補滿為止
+        '''
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self) -> None:
+        '''
+        降低速率並清空 bucket，讓後續請求必須等待
+        '''
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+            self._tokens = min(self._tokens, 0.0)
+
+    def recover(self) -> None:
+        '''
+        正常回應後逐步把速率加回 max_rate
+        '''
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.recover_step)
+
+
+class DownloadStats:
+    '''
+    單次爬取的下載統計，記錄檔案數、位元組數、重試次數與失敗清單
+    '''
+    def __init__(self) -> None:
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.skipped = 0
+        self.failed = []
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    def add_file(self, n_bytes: int) -> None:
+        with self._lock:
+            self.files += 1
+            self.bytes += n_bytes
+
+    def add_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def add_failed(self, url: str) -> None:
+        with self._lock:
+            self.failed.append(url)
+
+    def stop(self) -> None:
+        self.end_time = time.perf_counter()
+
+    def summary(self) -> dict:
+        '''
+        回傳本次下載的統計結果，包含 files/s 與 MB/s
+        '''
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        elapsed = max(end_time - self.start_time, 1e-9)
+        return {'files': self.files,
+                'bytes': self.bytes,
+                'retries': self.retries,
+                'skipped': self.skipped,
+                'failed': len(self.failed),
+                'elapsed_sec': round(elapsed, 3),
+                'files_per_sec': round(self.files / elapsed, 3),
+                'mb_per_sec': round(self.bytes / elapsed / 1024**2, 3)}
+
+    def report(self) -> None:
+        info = self.summary()
+        print(f"Downloaded {info['files']} files ({info['bytes'] / 1024**2:.1f} MB) in {info['elapsed_sec']} s, "
+              f"{info['files_per_sec']} files/s, {info['mb_per_sec']} MB/s, "
+              f"retries={info['retries']}, skipped={info['skipped']}, failed={info['failed']}")
+
+
+class DownloadEngine:
+    '''
+    多執行緒下載引擎，取代原本一次一檔 + 固定 sleep 的做法
+    每個主機共用一個 keep-alive 的 requests.Session (連線池大小 = max_workers)，
+    並以 TokenBucketRateLimiter 控制請求速率，遇到 429/5xx/過慢回應時自動 backoff 後重試
+
+    Parameters
+    ----------
+    max_workers: int
+        同時下載的執行緒數量上限
+    rate: float
+        每個主機每秒最多送出的請求數
+    burst: int
+        rate limiter 允許的瞬間爆發請求數
+    max_retries: int
+        單一請求失敗時最多重試的次數
+    timeout: float
+        單一請求的 timeout 秒數
+    slow_response_sec: float
+        回應時間超過此秒數視為伺服器壅塞，會觸發 backoff
+    chunk_size: int
+        每次從連線讀取的位元組數
+    buffer_size: int
+        寫檔時的緩衝區大小
+
+    Usage
+    -----
+    engine = DownloadEngine(max_workers=8, rate=4)
+    scrape_vd_data(date_list, engine=engine)
+    scrape_etag_info(date_list, engine=engine)
+    engine.close()
+    '''
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self,
+                 max_workers: int=8,
+                 rate: float=4.0,
+                 burst: int=8,
+                 max_retries: int=3,
+                 timeout: float=30,
+                 slow_response_sec: float=10.0,
+                 chunk_size: int=1024*1024,
+                 buffer_size: int=1024*1024*4) -> None:
+        self.max_workers = max_workers
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.slow_response_sec = slow_response_sec
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self._sessions = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _host_resources(self, url: str) -> tuple[requests.Session, TokenBucketRateLimiter]:
+        '''
+        依主機取得共用的 session 與 rate limiter，不存在時建立
+        '''
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+                self._limiters[host] = TokenBucketRateLimiter(rate=self.rate, capacity=self.burst)
+            return self._sessions[host], self._limiters[host]
+
+    def request(self,
+                url: str,
+                stream: bool=False,
+                stats: DownloadStats=None,
+                headers: dict=None) -> requests.Response:
+        '''
+        送出 GET 請求，遇到連線錯誤、429/5xx 時 backoff 並重試
+
+        Return
+        ------
+        requests.Response，重試次數用盡時回傳最後一次的 response，連線錯誤則拋出例外
+        '''
+        session, limiter = self._host_resources(url)
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0 and stats is not None:
+                stats.add_retry()
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = session.get(url, stream=stream, timeout=self.timeout, headers=headers)
+            except requests.RequestException:
+                limiter.backoff()
+                if attempt == self.max_retries:
+                    raise
+                continue
+
+            if response.status_code in self.retry_status and attempt < self.max_retries:
+                response.close()
+                limiter.backoff()
+                continue
+
+            if time.perf_counter() - start > self.slow_response_sec:
+                limiter.backoff()
+            else:
+                limiter.recover()
+            return response
+        return response
+
+    def fetch(self,
+              url: str,
+              save_path: str,
+              stats: DownloadStats=None) -> int:
+        '''
+        下載單一檔案到 save_path
+        下載過程先寫入 save_path + '.part'，中斷後再次呼叫會用 HTTP Range 從已下載的位置續傳，
+        完成後比對檔案大小 (以及伺服器有提供 Content-MD5 時的 checksum) 才 rename 成正式檔名，
+        因此 save_path 存在就代表是完整的檔案
+
+        Return
+        ------
+        int: 本次寫入的位元組數，失敗時回傳 -1
+        '''
+        stats = stats if stats is not None else DownloadStats()
+        part_path = save_path + PART_SUFFIX
+        os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+
+        n_bytes = 0
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                stats.add_retry()
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': f'bytes={offset}-'} if offset > 0 else None
+            try:
+                response = self.request(url, stream=True, stats=stats, headers=headers)
+            except requests.RequestException:
+                break
+
+            if response.status_code == 416:
+                # part file 比遠端還大或已失效，從頭下載
+                response.close()
+                os.remove(part_path)
+                continue
+            if response.status_code not in (200, 206):
+                response.close()
+                break
+
+            if response.status_code == 200:
+                # 伺服器不支援 Range 時會回傳完整內容，要從頭寫
+                offset = 0
+                expected_size = int(response.headers.get('content-length', -1))
+            else:
+                expected_size = _parse_content_range_total(response.headers.get('content-range'))
+            expected_md5 = response.headers.get('content-md5')
+
+            mode = 'ab' if offset > 0 else 'wb'
+            try:
+                with response, open(part_path, mode, buffering=self.buffer_size) as file:
+                    # 使用 raw stream 保留原始位元組，避免 Content-Encoding 被自動解壓
+                    for data in response.raw.stream(self.chunk_size, decode_content=False):
+                        file.write(data)
+                        n_bytes += len(data)
+            except (requests.RequestException, urllib3.exceptions.HTTPError, ConnectionError):
+                # 連線中斷，保留 part file 下一輪續傳
+                continue
+
+            part_size = os.path.getsize(part_path)
+            if expected_size >= 0 and part_size != expected_size:
+                continue
+            if expected_md5 and not _verify_md5(part_path, expected_md5):
+                print(f"Checksum mismatch for {url}, download again")
+                os.remove(part_path)
+                continue
+
+            os.replace(part_path, save_path)
+            stats.add_file(n_bytes)
+            return n_bytes
+
+        print(f"Failed to download {url}")
+        stats.add_failed(url)
+        return -1
+
+    def fetch_bytes(self,
+                    url: str,
+                    stats: DownloadStats=None) -> bytes:
+        '''
+        下載單一檔案並直接回傳內容 (不寫入磁碟)，供 stream ingestion 使用
+
+        Return
+        ------
+        bytes: 檔案內容，失敗時回傳 None
+        '''
+        stats = stats if stats is not None else DownloadStats()
+        try:
+            response = self.request(url, stats=stats)
+        except requests.RequestException:
+            response = None
+        if response is None or response.status_code != 200:
+            print(f"Failed to download {url}")
+            stats.add_failed(url)
+            return None
+        stats.add_file(len(response.content))
+        return response.content
+
+    def run(self,
+            tasks: list[tuple[str, str]],
+            stats: DownloadStats=None,
+            desc: str=None) -> DownloadStats:
+        '''
+        以執行緒池同時下載多個檔案
+
+        Parameters
+        ----------
+        tasks: list[tuple[str, str]]
+            下載任務清單，每一筆為 (url, save_path)
+        stats: DownloadStats
+            可傳入既有的統計物件累加，不傳入會自動建立
+        desc: str
+            tqdm 進度條的描述
+
+        Return
+        ------
+        DownloadStats
+        '''
+        stats = stats if stats is not None else DownloadStats()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.fetch, url, save_path, stats) for url, save_path in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                future.result()
+        stats.stop()
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._limiters.clear()
+
+
+# index 頁面中的連結，用 regex 取代 BeautifulSoup html.parser 解析整份 html
+HREF_PATTERN = re.compile(r'href="([^"]+)"')
+
+def list_remote_files(engine: DownloadEngine,
+                      base_url: str,
+                      suffix: str='.xml.gz') -> list[str]:
+    '''
+    解析日期目錄的 index 頁面，取得所有以 suffix 結尾的檔名 (已去重、排序)
+    '''
+    response = engine.request(base_url)
+    if response.status_code != 200:
+        return []
+    return sorted({href for href in HREF_PATTERN.findall(response.text) if href.endswith(suffix)})
+
+
+def taipei_now() -> datetime:
+    '''
+    目前的台灣時間 (不含時區資訊)
+    '''
+    return datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=8)
+
+
+def is_historical(date: str, settle_days: int=LISTING_SETTLE_DAYS) -> bool:
+    '''
+    判斷日期是否已經過了 settle_days 天 (以台灣時間計算)，例如 settle_days=2 時今天為 20230103 則 20230101 以前為 True
+    剛過午夜時前一天的檔案可能還沒上傳完，settle 期間過後目錄內容才不會再變動，listing 可以永久快取
+    '''
+    settled = (taipei_now() - timedelta(days=settle_days)).strftime('%Y%m%d')
+    return date <= settled
+
+
+def is_final_listing(date: str, fetched_at: str, settle_days: int=LISTING_SETTLE_DAYS) -> bool:
+    '''
+    listing 是否在 date 結束 settle_days - 1 天後才抓取 (fetched_at 為台灣時間 isoformat)，之前抓的可能缺少晚上傳的檔案
+    '''
+    settled = datetime.strptime(date, '%Y%m%d') + timedelta(days=settle_days)
+    return fetched_at >= settled.isoformat(timespec='seconds')
+
+
+class DownloadManifest:
+    '''
+    下載紀錄 (manifest)，以 SQLite 記錄每個遠端檔案的名稱、大小、日期與下載狀態，並快取歷史日期的目錄 listing
+    重新執行 scrape_* 時只需要比對 manifest 與 listing 的差異，不用重新抓 index 頁面，也不用逐檔 os.path.exists
+
+    Parameters
+    ----------
+    db_path: str
+        manifest 的 SQLite 檔案路徑
+
+    Usage
+    -----
+    manifest = DownloadManifest('../data/raw/download_manifest.db')
+    scrape_vd_data(date_list, manifest=manifest)
+    manifest.completeness('VD')
+    '''
+    def __init__(self, db_path: str=DEFAULT_MANIFEST_PATH) -> None:
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.con = sqlite3.connect(db_path)
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS listings(
+                dataset TEXT, date TEXT, base_url TEXT, fetched_at TEXT, file_names TEXT,
+                PRIMARY KEY(dataset, date));
+            CREATE TABLE IF NOT EXISTS files(
+                dataset TEXT, date TEXT, file_name TEXT, save_dir TEXT,
+                size INTEGER, status TEXT, updated_at TEXT,
+                PRIMARY KEY(dataset, date, file_name));
+            CREATE TABLE IF NOT EXISTS archives(
+                dataset TEXT, date TEXT, size INTEGER, absent_slots TEXT, updated_at TEXT,
+                PRIMARY KEY(dataset, date));
+            ''')
+        self.con.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.con.close()
+
+    def has_listing(self, dataset: str, date: str) -> bool:
+        '''
+        是否有 date 的最終 listing，settle 期間內抓取的 listing (舊版 manifest 可能留下) 視為沒有，會重新抓取
+        '''
+        cur = self.con.execute('SELECT fetched_at FROM listings WHERE dataset = ? AND date = ?', (dataset, date))
+        row = cur.fetchone()
+        return row is not None and is_final_listing(date, row[0])
+
+    def listing(self, dataset: str, date: str) -> list[str]:
+        '''
+        取得快取的 listing 檔名清單 (已排序)
+        '''
+        cur = self.con.execute('SELECT file_names FROM listings WHERE dataset = ? AND date = ?', (dataset, date))
+        row = cur.fetchone()
+        return json.loads(row[0]) if row is not None else []
+
+    def record_listing(self,
+                       dataset: str,
+                       date: str,
+                       base_url: str,
+                       file_names: list[str]) -> None:
+        '''
+        記錄一個日期目錄的 listing，檔案狀態初始為 pending，fetched_at 為台灣時間
+        '''
+        now = datetime.now().isoformat(timespec='seconds')
+        fetched_at = taipei_now().isoformat(timespec='seconds')
+        with self.con:
+            self.con.executemany('''INSERT OR IGNORE INTO files(dataset, date, file_name, status, updated_at)
+                                    VALUES (?, ?, ?, 'pending', ?)''',
+                                 [(dataset, date, file_name, now) for file_name in file_names])
+            self.con.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                             (dataset, date, base_url, fetched_at, json.dumps(sorted(file_names))))
+
+    def done_files(self, dataset: str, date: str, save_dir: str) -> set[str]:
+        '''
+        取得指定日期、存放路徑下已完成下載的檔名
+        '''
+        cur = self.con.execute("""SELECT file_name FROM files
+                                  WHERE dataset = ? AND date = ? AND save_dir = ? AND status = 'done'""",
+                               (dataset, date, os.path.normpath(save_dir)))
+        return {row[0] for row in cur.fetchall()}
+
+    def stale_files(self, dataset: str, date: str, save_dir: str) -> set[str]:
+        '''
+        取得指定日期、存放路徑下曾經下載過但目前不是 done 的檔名 (下載失敗或被 reconcile 改回 pending)，
+        這些檔案即使磁碟上有同名檔案也不能視為完整
+        '''
+        cur = self.con.execute("""SELECT file_name FROM files
+                                  WHERE dataset = ? AND date = ? AND save_dir = ? AND status != 'done'""",
+                               (dataset, date, os.path.normpath(save_dir)))
+        return {row[0] for row in cur.fetchall()}
+
+    def record_results(self, results: list[tuple[str, str, str, str, int]]) -> None:
+        '''
+        批次寫入下載結果
+
+        Parameters
+        ----------
+        results: list[tuple]
+            每筆為 (dataset, date, file_name, save_dir, size)，size < 0 代表下載失敗
+        '''
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = [(dataset, date, file_name, os.path.normpath(save_dir),
+                 size if size >= 0 else None, 'done' if size >= 0 else 'failed', now)
+                for dataset, date, file_name, save_dir, size in results]
+        with self.con:
+            self.con.executemany('''INSERT INTO files(dataset, date, file_name, save_dir, size, status, updated_at)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(dataset, date, file_name) DO UPDATE SET
+                                        save_dir = excluded.save_dir, size = excluded.size,
+                                        status = excluded.status, updated_at = excluded.updated_at''',
+                                 rows)
+
+    def reconcile(self, dataset: str=None) -> int:
+        '''
+        檢查標記為 done 的檔案是否仍存在且大小一致，不一致的改回 pending，回傳被重設的筆數
+        '''
+        query = "SELECT dataset, date, file_name, save_dir, size FROM files WHERE status = 'done'"
+        params = ()
+        if dataset is not None:
+            query += ' AND dataset = ?'
+            params = (dataset,)
+        reset = []
+        for ds_name, date, file_name, save_dir, size in self.con.execute(query, params).fetchall():
+            save_path = os.path.join(save_dir, file_name)
+            if not is_finalized(save_path) or os.path.getsize(save_path) != size:
+                reset.append((ds_name, date, file_name))
+        with self.con:
+            self.con.executemany("UPDATE files SET status = 'pending' WHERE dataset = ? AND date = ? AND file_name = ?",
+                                 reset)
+        return len(reset)
+
+    def record_archive(self,
+                       dataset: str,
+                       date: str,
+                       size: int,
+                       absent_slots: list[str]) -> None:
+        '''
+        記錄 TDCS tar.gz 已完整讀取過，以及其中本來就沒有的 HHmm 時段 (遠端的檔案就缺)，
+        之後同步時這些時段不會再被視為缺漏而重複讀取整個 tar.gz
+        '''
+        now = datetime.now().isoformat(timespec='seconds')
+        with self.con:
+            self.con.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)',
+                             (dataset, date, size, json.dumps(sorted(absent_slots)), now))
+
+    def absent_slots(self, dataset: str, date: str, size: int) -> set[str]:
+        '''
+        record_archive 記錄的缺少時段，檔案大小與記錄時不同 (重新下載過) 時視為沒有紀錄，回傳空 set
+        '''
+        cur = self.con.execute('SELECT size, absent_slots FROM archives WHERE dataset = ? AND date = ?', (dataset, date))
+        row = cur.fetchone()
+        if row is None or row[0] != size:
+            return set()
+        return set(json.loads(row[1]))
+
+    def completeness(self, dataset: str=None) -> pd.DataFrame:
+        '''
+        依 dataset、date 統計檔案數與完成下載的比例
+
+        Return
+        ------
+        pd.DataFrame: columns = dataset, date, total, done, failed, pending, bytes, done_ratio
+        '''
+        query = '''SELECT dataset, date, COUNT(*) AS total,
+                          SUM(status = 'done') AS done,
+                          SUM(status = 'failed') AS failed,
+                          SUM(status = 'pending') AS pending,
+                          COALESCE(SUM(size), 0) AS bytes
+                   FROM files'''
+        params = ()
+        if dataset is not None:
+            query += ' WHERE dataset = ?'
+            params = (dataset,)
+        query += ' GROUP BY dataset, date ORDER BY dataset, date'
+        df = pd.read_sql_query(query, self.con, params=params)
+        df['done_ratio'] = (df['done'] / df['total']).round(4)
+        return df
+
+
+def get_remote_listing(engine: DownloadEngine,
+                       manifest: DownloadManifest,
+                       dataset: str,
+                       date: str,
+                       base_url: str,
+                       suffix: str='.xml.gz') -> list[str]:
+    '''
+    取得日期目錄的檔名清單，已過 settle 期間的日期優先使用 manifest 中的快取，
+    較近的日期 (仍可能增加檔案) 每次都重新抓取且不快取
+    '''
+    if manifest.has_listing(dataset, date):
+        return manifest.listing(dataset, date)
+    file_names = list_remote_files(engine, base_url, suffix)
+    if file_names and is_historical(date):
+        manifest.record_listing(dataset, date, base_url, file_names)
+    return file_names
+
+
+def plan_download_tasks(manifest: DownloadManifest,
+                        dataset: str,
+                        date: str,
+                        base_url: str,
+                        save_dir: str,
+                        file_names: list[str]) -> tuple[list, list, int]:
+    '''
+    比對 manifest 與 listing，找出需要下載的檔案
+    manifest 標記為 done 的檔案也要在磁碟上是完整檔案才跳過 (被刪除的會重新下載)，
+    manifest 尚未記錄、但磁碟上已有完整檔案的 (例如 manifest 建立前下載的)，會直接補記為 done
+
+    Return
+    ------
+    tasks: list[tuple[str, str]]
+        (url, save_path)
+    task_keys: list[tuple[str, str, str, str]]
+        (dataset, date, file_name, save_dir)，對應 tasks，下載後寫回 manifest 使用
+    skipped: int
+        不需下載的檔案數
+    '''
+    # 整個目錄只 listdir 一次，有殘留 .part 的檔案視為未完成
+    on_disk = set(os.listdir(save_dir)) if os.path.isdir(save_dir) else set()
+    finalized = {f for f in on_disk if f + PART_SUFFIX not in on_disk}
+    done = manifest.done_files(dataset, date, save_dir) & finalized
+    tasks, task_keys, found = [], [], []
+    skipped = 0
+    for file_name in file_names:
+        if file_name in done:
+            skipped += 1
+            continue
+        save_path = os.path.join(save_dir, file_name)
+        if file_name in finalized:
+            found.append((dataset, date, file_name, save_dir, os.path.getsize(save_path)))
+            skipped += 1
+            continue
+        tasks.append((f"{base_url}{file_name}", save_path))
+        task_keys.append((dataset, date, file_name, save_dir))
+    if found:
+        manifest.record_results(found)
+    return tasks, task_keys, skipped
+
+
+def record_download_results(manifest: DownloadManifest,
+                            task_keys: list[tuple[str, str, str, str]]) -> None:
+    '''
+    下載完成後把每個任務的結果 (完成檔案大小或失敗) 寫回 manifest
+    '''
+    results = []
+    for dataset, date, file_name, save_dir in task_keys:
+        save_path = os.path.join(save_dir, file_name)
+        size = os.path.getsize(save_path) if is_finalized(save_path) else -1
+        results.append((dataset, date, file_name, save_dir, size))
+    manifest.record_results(results)
+
+
+def run_download_tasks(tasks: list[tuple[str, str]],
+                       engine: DownloadEngine=None,
+                       skipped: int=0,
+                       desc: str=None) -> dict:
+    '''
+    scrape_* 共用的下載流程，未傳入 engine 時會建立一個預設的引擎並在結束後關閉
+
+    Return
+    ------
+    dict: DownloadStats.summary() 的結果
+    '''
+    own_engine = engine is None
+    engine = DownloadEngine() if own_engine else engine
+    stats = DownloadStats()
+    stats.skipped = skipped
+    try:
+        engine.run(tasks, stats=stats, desc=desc)
+    finally:
+        if own_engine:
+            engine.close()
+    stats.report()
+    return stats.summary()
+
+
 def generate_date_strings(start_date: str, 
                           end_date: str) -> list:
     '''
@@ -117,7 +852,10 @@ def generate_date_strings(start_date: str,
 
 def scrape_vd_data(date_list: list[str],
                    save_dir_upper: str='../data/raw/VD/',
-                   select_data: str='all') -> None:
+                   select_data: str='all',
+                   engine: DownloadEngine=None,
+                   manifest: DownloadManifest=None,
+                   host_url: str=TISVCLOUD_URL) -> dict:
     '''
     可指定一連串的時間資訊下進行VD資料的爬取，原始VD資料有區分動態與靜態資訊，可透過指定參數來決定下載目標
 
@@ -129,57 +867,71 @@ def scrape_vd_data(date_list: list[str],
         資料爬取存放的上層路徑，其下日期的子資料夾會自動生成
     select_data: str
         原始資料有區分靜態、動態，'both'= 全數下載, 'static'=下載靜態, 'dynamic'= 下載動態
+    engine: DownloadEngine
+        下載引擎，可指定同時下載數與速率，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir_upper 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
     
     Return
     ------
-    None
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
     '''
     if select_data not in ['all', 'static', 'dynamic']:
         return 'select_data need to specify, please check the docstring.'
 
     create_directory_if_not_exists(save_dir_upper)
 
-    for exact_date in tqdm(date_list):
-        # 基本爬取的日期，以及預計要存放的路徑 
-        base_url = f"https://tisvcloud.freeway.gov.tw/history/motc20/VD/{exact_date}/"
-        save_dir = f'{save_dir_upper}{exact_date}'
+    own_engine = engine is None
+    engine = DownloadEngine() if own_engine else engine
+    own_manifest = manifest is None
+    manifest = DownloadManifest(default_manifest_path(save_dir_upper)) if own_manifest else manifest
+    tasks, task_keys = [], []
+    skipped = 0
+    try:
+        for exact_date in tqdm(date_list):
+            # 基本爬取的日期，以及預計要存放的路徑 
+            base_url = f"{host_url}/history/motc20/VD/{exact_date}/"
+            save_dir = f'{save_dir_upper}{exact_date}'
         
-        # 爬取該日期頁面下所有合理的
-        response = requests.get(base_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        file_paths = []
-        for i in soup.find_all('a'):
-            if i.get('href').endswith('.xml.gz'):
-                file_paths.append(i.get('href'))
-        
-        # 這種抓法會有名稱重複，因此要去重、排序
-        # 裡面會有靜態、動態的VD資訊
-        # VD 動態資訊(v2.0)	= YYYYMMDD/VDLive_HHmm.xml.gz
-        # VD 靜態資訊(v2.0)	= YYYYMMDD/VD_0000.xml.gz
-        
-        file_paths = list(set(file_paths))
-        file_paths.sort()
-
-        # 排除或保留指定的資料類型
-        if select_data =='static':
-            file_paths = [file_path for file_path in file_paths if 'VD_' in file_path]
-        elif select_data == 'dynamic':
-            file_paths = [file_path for file_path in file_paths if 'VDLive_' in file_path]
-        else:
-            pass
+            # 爬取該日期頁面下所有合理的，已去重、排序
+            # 裡面會有靜態、動態的VD資訊
+            # VD 動態資訊(v2.0)	= YYYYMMDD/VDLive_HHmm.xml.gz
+            # VD 靜態資訊(v2.0)	= YYYYMMDD/VD_0000.xml.gz
+            file_paths = get_remote_listing(engine, manifest, 'VD', exact_date, base_url)
+
+            # 排除或保留指定的資料類型
+            if select_data =='static':
+                file_paths = [file_path for file_path in file_paths if 'VD_' in file_path]
+            elif select_data == 'dynamic':
+                file_paths = [file_path for file_path in file_paths if 'VDLive_' in file_path]
+            else:
+                pass
             
-        # file_names = [f"VDLive_{i:04d}.xml.gz" for i in range(1, 2359)]  # 根据你需要的文件名生成列表
-        for file_name in file_paths:
-            if os.path.exists(save_dir+'/'+file_name): # 跳過已經有檔案的部分
-                continue
-            download_files(base_url, [file_name], save_dir)
-            time.sleep(1.5)
-        # time.sleep(3)
+            # 只下載 manifest 中尚未完成的檔案，殘留 .part 的會續傳
+            date_tasks, date_keys, date_skipped = plan_download_tasks(manifest, 'VD', exact_date, base_url,
+                                                                      save_dir, file_paths)
+            tasks.extend(date_tasks)
+            task_keys.extend(date_keys)
+            skipped += date_skipped
+
+        stats = run_download_tasks(tasks, engine, skipped, desc='VD')
+        record_download_results(manifest, task_keys)
+        return stats
+    finally:
+        if own_engine:
+            engine.close()
+        if own_manifest:
+            manifest.close()
 
 
 def scrape_etag_info(date_list: list[str],
                      save_dir_upper: str='../data/raw/ETag/',
-                     select_data: str='all') -> None:
+                     select_data: str='all',
+                     engine: DownloadEngine=None,
+                     manifest: DownloadManifest=None,
+                     host_url: str=TISVCLOUD_URL) -> dict:
     '''
     可指定一連串的時間資訊下進行ETag資料的爬取，原始資料有區分動態與靜態資訊，可透過指定參數來決定下載目標
 
@@ -194,88 +946,131 @@ def scrape_etag_info(date_list: list[str],
         eTag 靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETag_0000.xml.gz  
         eTag 配對路徑靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPair_0000.xml.gz  
         eTag 配對路徑動態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPairLive_HHmm.xml.gz  
+    engine: DownloadEngine
+        下載引擎，可指定同時下載數與速率，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir_upper 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
     
     Return
     ------
-    None
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
     '''
     if select_data not in ['all', 'info', 'pair_static', 'pair_dynamic']:
         return 'select_data need to specify, please check the docstring.'
     
-    for exact_date in tqdm(date_list):
-        # 基本爬取的日期，以及預計要存放的路徑 
-        base_url = f"https://tisvcloud.freeway.gov.tw/history/motc20/ETag/{exact_date}/"
-        save_dir = f'{save_dir_upper}{exact_date}'
+    own_engine = engine is None
+    engine = DownloadEngine() if own_engine else engine
+    own_manifest = manifest is None
+    manifest = DownloadManifest(default_manifest_path(save_dir_upper)) if own_manifest else manifest
+    tasks, task_keys = [], []
+    skipped = 0
+    try:
+        for exact_date in tqdm(date_list):
+            # 基本爬取的日期，以及預計要存放的路徑 
+            base_url = f"{host_url}/history/motc20/ETag/{exact_date}/"
+            save_dir = f'{save_dir_upper}{exact_date}'
         
-        create_directory_if_not_exists(save_dir)
+            create_directory_if_not_exists(save_dir)
         
-        # 爬取該日期頁面下所有合理的
-        response = requests.get(base_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        file_paths = []
-        for i in soup.find_all('a'):
-            if i.get('href').endswith('.xml.gz'):
-                file_paths.append(i.get('href'))
-        
-        # 這種抓法會有名稱重複，因此要去重、排序
-        # 裡面會有3種的ETag資訊
-        # eTag 靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETag_0000.xml.gz	
-        # eTag 配對路徑靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPair_0000.xml.gz
-        # eTag 配對路徑動態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPairLive_HHmm.xml.gz
-        
-        file_paths = list(set(file_paths))
-        file_paths.sort()
-
-        # 排除或保留指定的資料類型
-        if select_data =='info':
-            file_paths = [file_path for file_path in file_paths if 'ETag_' in file_path]
-        elif select_data == 'pair_static':
-            file_paths = [file_path for file_path in file_paths if 'ETagPair_' in file_path]
-        elif select_data == 'pair_dynamic':
-            file_paths = [file_path for file_path in file_paths if 'ETagPairLive_' in file_path]
-        else:
-            pass
-
-        for file_name in file_paths:
-            if os.path.exists(save_dir+'/'+file_name): # 跳過已經有檔案的部分
-                continue
-            download_files(base_url, [file_name], save_dir)
-            time.sleep(1)
-        # time.sleep(3)
+            # 爬取該日期頁面下所有合理的，已去重、排序
+            # 裡面會有3種的ETag資訊
+            # eTag 靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETag_0000.xml.gz	
+            # eTag 配對路徑靜態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPair_0000.xml.gz
+            # eTag 配對路徑動態資訊(v2.0) = ./history/motc20/ETag/YYYYMMDD/ETagPairLive_HHmm.xml.gz
+            file_paths = get_remote_listing(engine, manifest, 'ETag', exact_date, base_url)
 
-def scrape_etag_intergantry_traveltime(date_list: list[str],
-                                       save_dir: str='../data/raw/ETag_intergantry_traveltime') -> None:
+            # 排除或保留指定的資料類型
+            if select_data =='info':
+                file_paths = [file_path for file_path in file_paths if 'ETag_' in file_path]
+            elif select_data == 'pair_static':
+                file_paths = [file_path for file_path in file_paths if 'ETagPair_' in file_path]
+            elif select_data == 'pair_dynamic':
+                file_paths = [file_path for file_path in file_paths if 'ETagPairLive_' in file_path]
+            else:
+                pass
+
+            # 只下載 manifest 中尚未完成的檔案，殘留 .part 的會續傳
+            date_tasks, date_keys, date_skipped = plan_download_tasks(manifest, 'ETag', exact_date, base_url,
+                                                                      save_dir, file_paths)
+            tasks.extend(date_tasks)
+            task_keys.extend(date_keys)
+            skipped += date_skipped
+
+        stats = run_download_tasks(tasks, engine, skipped, desc='ETag')
+        record_download_results(manifest, task_keys)
+        return stats
+    finally:
+        if own_engine:
+            engine.close()
+        if own_manifest:
+            manifest.close()
+
+
+def scrape_tdcs_data(date_list: list[str],
+                     dataset: str,
+                     save_dir: str,
+                     engine: DownloadEngine=None,
+                     manifest: DownloadManifest=None,
+                     host_url: str=TISVCLOUD_URL) -> dict:
     '''
-    可指定一連串的時間資訊下進行ETag gantry間通過所花費的旅行時間為主資料的爬取
+    M03A, M04A, M05A 共用的爬取流程，這三種資料都是每天一個 M0xA_YYYYMMDD.tar.gz
 
     Parameters
     ----------
     date_list: list[str]
         輸入日期串，像是['20230101', '20230102']
+    dataset: str
+        'M03A', 'M04A', 'M05A'
     save_dir: str
         資料下載後儲存的路徑，如果不存在會自動建立folder
-    
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
+
     Return
     ------
-    None
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
     '''
+    base_url = f"{host_url}/history/TDCS/{dataset}/"
 
-    base_url = f"https://tisvcloud.freeway.gov.tw/history/TDCS/M04A/"
-    
     create_directory_if_not_exists(save_dir)
 
+    own_manifest = manifest is None
+    manifest = DownloadManifest(default_manifest_path(save_dir)) if own_manifest else manifest
+    tasks, task_keys = [], []
+    skipped = 0
+    try:
+        for date in date_list:
+            # 每天只有一個檔案，檔名固定不需要抓 listing
+            file_name = f'{dataset}_{date}.tar.gz'
+            if is_historical(date) and not manifest.has_listing(dataset, date):
+                manifest.record_listing(dataset, date, base_url, [file_name])
+            date_tasks, date_keys, date_skipped = plan_download_tasks(manifest, dataset, date, base_url,
+                                                                      save_dir, [file_name])
+            tasks.extend(date_tasks)
+            task_keys.extend(date_keys)
+            skipped += date_skipped
 
-    for date in tqdm(date_list):
-        file_name = f'M04A_{date}.tar.gz'
-        if os.path.exists(save_dir+'/'+file_name): # 跳過已經有檔案的部分
-            continue
-        download_files(base_url, [file_name], save_dir)
-        time.sleep(1) 
+        stats = run_download_tasks(tasks, engine, skipped, desc=dataset)
+        record_download_results(manifest, task_keys)
+        return stats
+    finally:
+        if own_manifest:
+            manifest.close()
 
-def scrape_etag_gantry_volume(date_list: list[str],
-                              save_dir: str='../data/raw/ETag_gantry_vol') -> None:
+
+def scrape_etag_intergantry_traveltime(date_list: list[str],
+                                       save_dir: str='../data/raw/ETag_intergantry_traveltime',
+                                       engine: DownloadEngine=None,
+                                       manifest: DownloadManifest=None,
+                                       host_url: str=TISVCLOUD_URL) -> dict:
     '''
-    可指定一連串的時間資訊下進行ETag gantry通過車流量為主資料的爬取
+    可指定一連串的時間資訊下進行ETag gantry間通過所花費的旅行時間為主資料的爬取
 
     Parameters
     ----------
@@ -283,24 +1078,51 @@ def scrape_etag_gantry_volume(date_list: list[str],
         輸入日期串，像是['20230101', '20230102']
     save_dir: str
         資料下載後儲存的路徑，如果不存在會自動建立folder
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
     
     Return
     ------
-    None
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
     '''
-    base_url = f"https://tisvcloud.freeway.gov.tw/history/TDCS/M03A/"
+    return scrape_tdcs_data(date_list, 'M04A', save_dir, engine, manifest, host_url)
 
-    create_directory_if_not_exists(save_dir)
+def scrape_etag_gantry_volume(date_list: list[str],
+                              save_dir: str='../data/raw/ETag_gantry_vol',
+                              engine: DownloadEngine=None,
+                              manifest: DownloadManifest=None,
+                              host_url: str=TISVCLOUD_URL) -> dict:
+    '''
+    可指定一連串的時間資訊下進行ETag gantry通過車流量為主資料的爬取
 
-    for date in tqdm(date_list):
-        file_name = f'M03A_{date}.tar.gz'   
-        if os.path.exists(save_dir+'/'+file_name): # 跳過已經有檔案的部分
-            continue
-        download_files(base_url, [file_name], save_dir)
-        time.sleep(1) 
+    Parameters
+    ----------
+    date_list: list[str]
+        輸入日期串，像是['20230101', '20230102']
+    save_dir: str
+        資料下載後儲存的路徑，如果不存在會自動建立folder
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
+    
+    Return
+    ------
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
+    '''
+    return scrape_tdcs_data(date_list, 'M03A', save_dir, engine, manifest, host_url)
 
 def scrape_etag_intergantry_speed(date_list: list[str],
-                                  save_dir: str='../data/raw/ETag_intergantry_speed') -> None:
+                                  save_dir: str='../data/raw/ETag_intergantry_speed',
+                                  engine: DownloadEngine=None,
+                                  manifest: DownloadManifest=None,
+                                  host_url: str=TISVCLOUD_URL) -> dict:
     '''
     可指定一連串的時間資訊下進行ETag gantry間通過車速為主資料的爬取
 
@@ -310,21 +1132,15 @@ def scrape_etag_intergantry_speed(date_list: list[str],
         輸入日期串，像是['20230101', '20230102']
     save_dir: str
         資料下載後儲存的路徑，如果不存在會自動建立folder
+    engine: DownloadEngine
+        下載引擎，不傳入時使用預設設定
+    manifest: DownloadManifest
+        下載紀錄，不傳入時使用 save_dir 上一層資料夾中的 MANIFEST_FILE_NAME
+    host_url: str
+        資料來源主機，預設為 TISVCLOUD_URL
     
     Return
     ------
-    None
+    dict: 本次下載的統計 (files/s, MB/s, retries...)
     '''
-    
-    base_url = f"https://tisvcloud.freeway.gov.tw/history/TDCS/M05A/"
-
-    create_directory_if_not_exists(save_dir)
-
-    for date in tqdm(date_list):
-        file_name = f'M05A_{date}.tar.gz'
-        if os.path.exists(save_dir+'/'+file_name): # 跳過已經有檔案的部分
-            continue
-        download_files(base_url, [file_name], save_dir)
-        time.sleep(1) 
-    
-    return None
\ No newline at end of file
+    return scrape_tdcs_data(date_list, 'M05A', save_dir, engine, manifest, host_url)
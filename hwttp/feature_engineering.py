@@ -0,0 +1,264 @@
+#      feature store for the b/p/c/h/t/r feature blocks
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from . import hwtoolkit as tk
+
+
+# 每個區塊以 gf_gt, TimeStamp 對應回基礎資料
+KEY_COLUMNS = ['gf_gt', 'TimeStamp']
+
+def _dtype_signature(df: pd.DataFrame) -> bytes:
+    return repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode()
+
+def _row_hashes(df: pd.DataFrame) -> np.ndarray:
+    try:
+        values = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        # 欄位中有無法 hash 的物件 (例如 list) 時改用字串內容
+        values = pd.util.hash_pandas_object(df.astype(str), index=False)
+    return values.to_numpy()
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    '''
+    DataFrame 內容 (欄位名稱、型態與值) 的 hash
+    '''
+    digest = hashlib.sha1(_dtype_signature(df))
+    digest.update(_row_hashes(df).tobytes())
+    return digest.hexdigest()
+
+
+class FeatureStore():
+    def __init__(self,
+                 store_dir: str,
+                 resource: 'tk.hw_df_resource',
+                 base_df: pd.DataFrame):
+        """
+        Computes every feature block once per gantry pair and stores it as
+        store_dir/{block}/{gf_gt}-{hash}.parquet. The hash covers the block version, the pair's rows of
+        the base frame ('_p' also its downstream pairs' rows) and the block's input tables, so adding
+        data for one pair only recomputes that pair. Combinations are then assembled by column selection.
+
+        The base frame is hashed once here. Input tables are hashed the first time a block uses them
+        and again only when the resource attribute is replaced by another object; a table modified in
+        place is not detected.
+
+        Parameters:
+        - store_dir: Directory of the block files, created if missing.
+        - resource: hw_df_resource with the environment/event info loaded and milelocation_info_df generated.
+        - base_df: Base travel time frame (e.g. hw5_15watt) with unique (gf_gt, TimeStamp) rows.
+        """
+        self.store_dir = store_dir
+        self.resource = resource
+        self.base_df = base_df
+        # 每個門架對在 base_df 的列位置與內容 hash，逐列 hash 後再依門架對合併，只需掃描一次
+        self.pairs = list(pd.unique(base_df['gf_gt'].astype(str)))
+        positions = pd.Series(np.arange(len(base_df))).groupby(base_df['gf_gt'].astype(str).to_numpy()).indices
+        self._pair_rows = {pair: positions[pair] for pair in self.pairs}
+        signature, hashes = _dtype_signature(base_df), _row_hashes(base_df)
+        self._pair_fingerprints = {pair: hashlib.sha1(signature + hashes[rows].tobytes()).hexdigest()
+                                   for pair, rows in self._pair_rows.items()}
+        topology = getattr(resource, 'gantry_topology', None) or tk.GantryTopology(self.pairs)
+        # '_p' 用到的第 1 層下游門架對 (只保留 base_df 中有的)
+        downstream = topology.hop_edges('downstream', 1)
+        downstream = downstream[downstream['neighbor_gf_gt'].isin(self._pair_rows)]
+        self._downstream = {pair: [] for pair in self.pairs}
+        for pair, neighbor in downstream.itertuples(index=False):
+            if pair in self._downstream:
+                self._downstream[pair].append(neighbor)
+        self._table_fingerprints = dict()
+        self._block_keys = dict()
+        # CongestionIndex 與日曆特徵表的快取也放在 store_dir
+        self.cache_paths = {'congestion_index': os.path.join(store_dir, 'congestion_index.npz'),
+                            'calendar_table': os.path.join(store_dir, 'calendar_table.parquet')}
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _table_fingerprint(self, attr: str) -> str:
+        table = getattr(self.resource, attr)
+        if attr not in self._table_fingerprints or self._table_fingerprints[attr][0] is not table:
+            self._table_fingerprints[attr] = (table, frame_fingerprint(table))
+        return self._table_fingerprints[attr][1]
+
+    def block_keys(self, name: str) -> dict:
+        """
+        Content hash of block `name` for every gantry pair: version, the pair's base rows and input tables.
+        """
+        block = tk.FEATURE_BLOCKS[name]
+        tables = tuple(self._table_fingerprint(attr) for attr in block['tables'])
+        if self._block_keys.get(name, (None,))[0] != tables:
+            keys = dict()
+            for pair in self.pairs:
+                digest = hashlib.sha1(f"{name}:{block['version']}:{pair}:{self._pair_fingerprints[pair]}".encode())
+                if block['scope'] == 'downstream':
+                    for neighbor in self._downstream[pair]:
+                        digest.update(f'{neighbor}:{self._pair_fingerprints[neighbor]}'.encode())
+                for fingerprint in tables:
+                    digest.update(fingerprint.encode())
+                keys[pair] = digest.hexdigest()[:16]
+            self._block_keys[name] = (tables, keys)
+        return self._block_keys[name][1]
+
+    def block_key(self, name: str, gantry_pair: str) -> str:
+        return self.block_keys(name)[gantry_pair]
+
+    def block_dir(self, name: str) -> str:
+        return os.path.join(self.store_dir, name.strip('_'))
+
+    def block_path(self, name: str, gantry_pair: str) -> str:
+        return os.path.join(self.block_dir(name), f'{gantry_pair}-{self.block_key(name, gantry_pair)}.parquet')
+
+    def _write_block(self, output: pd.DataFrame, path: str):
+        new_cols = [col for col in output.columns if col not in self.base_df.columns]
+        table = pa.Table.from_pandas(output[KEY_COLUMNS + new_cols], preserve_index=False)
+        # pyarrow 讀回時不會還原非字串類別 (例如 accident_type)，另存類別定義
+        categories = {col: {'categories': output[col].cat.categories.tolist(), 'ordered': bool(output[col].cat.ordered)}
+                      for col in new_cols if isinstance(output[col].dtype, pd.CategoricalDtype)}
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               b'feature_categories': json.dumps(categories, default=str).encode()})
+        temp_path = path + '.tmp'
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+
+    def compute_block(self, name: str, gantry_pairs: list=None, force: bool=False) -> list:
+        """
+        Computes block `name` for the gantry pairs (default all pairs of the base frame) whose file is
+        missing or out of date, returns the file paths of the pairs. Only the key columns and the
+        columns added by the block are stored.
+
+        '_p' is computed once over the stale pairs and their downstream pairs. The other blocks are
+        computed on each pair's rows alone, like run_combinations_parallel.
+        """
+        gantry_pairs = self.pairs if gantry_pairs is None else list(gantry_pairs)
+        paths = [self.block_path(name, pair) for pair in gantry_pairs]
+        stale = [pair for pair, path in zip(gantry_pairs, paths) if force or not os.path.exists(path)]
+        if not stale:
+            return paths
+        block = tk.FEATURE_BLOCKS[name]
+        os.makedirs(self.block_dir(name), exist_ok=True)
+        if block['scope'] == 'downstream':
+            needed = list(dict.fromkeys(stale + [neighbor for pair in stale for neighbor in self._downstream[pair]]))
+            rows = np.sort(np.concatenate([self._pair_rows[pair] for pair in needed]))
+            output = block['compute'](self.base_df.iloc[rows], self.resource, self.cache_paths)
+            pair_column = output['gf_gt'].astype(str)
+            for pair in stale:
+                self._write_block(output[pair_column == pair], self.block_path(name, pair))
+        else:
+            tk.prepare_block_caches([name], self.base_df, self.resource, self.cache_paths)
+            for pair in tqdm(stale, disable=len(stale) < 2):
+                output = block['compute'](self.base_df.iloc[self._pair_rows[pair]], self.resource, self.cache_paths)
+                self._write_block(output, self.block_path(name, pair))
+        print(f'Complete computing feature block {name}: {len(stale)} gantry pairs')
+        return paths
+
+    def status(self) -> pd.DataFrame:
+        """
+        Returns one row per block and gantry pair with its current key and whether its file is up to date.
+        """
+        rows = [{'block': name, 'gf_gt': pair, 'key': key,
+                 'cached': os.path.exists(self.block_path(name, pair))}
+                for name in tk.FEATURE_BLOCKS for pair, key in self.block_keys(name).items()]
+        return pd.DataFrame(rows)
+
+    def remove_stale(self) -> list:
+        """
+        Deletes block files whose key no longer matches the current inputs (including pairs that are
+        no longer in the base frame), returns the deleted paths relative to store_dir.
+        """
+        removed = []
+        for name in tk.FEATURE_BLOCKS:
+            if not os.path.isdir(self.block_dir(name)):
+                continue
+            current = {os.path.basename(self.block_path(name, pair)) for pair in self.pairs}
+            for file_name in os.listdir(self.block_dir(name)):
+                if file_name.endswith('.parquet') and file_name not in current:
+                    os.remove(os.path.join(self.block_dir(name), file_name))
+                    removed.append(os.path.join(name.strip('_'), file_name))
+        # 舊版整個基礎資料一個檔案的 store_dir/{block}-{hash}.parquet
+        prefixes = tuple(f'{name.strip("_")}-' for name in tk.FEATURE_BLOCKS)
+        for file_name in os.listdir(self.store_dir):
+            if file_name.endswith('.parquet') and file_name.startswith(prefixes):
+                os.remove(os.path.join(self.store_dir, file_name))
+                removed.append(file_name)
+        return removed
+
+    def read_block(self,
+                   name: str,
+                   gantry_pairs: list=None,
+                   start: str=None,
+                   end: str=None) -> pd.DataFrame:
+        """
+        Reads block `name` (computing it first if needed) for the gantry pairs (default all pairs),
+        filtered by [start, end).
+        """
+        filters = []
+        if start is not None:
+            filters.append(('TimeStamp', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('TimeStamp', '<', pd.Timestamp(end)))
+        frames = []
+        for path in self.compute_block(name, gantry_pairs):
+            table = pq.read_table(path, filters=filters or None)
+            df = table.to_pandas()
+            categories = json.loads((table.schema.metadata or {}).get(b'feature_categories', b'{}'))
+            for col, dtype in categories.items():
+                df[col] = df[col].astype(pd.CategoricalDtype(dtype['categories'], ordered=dtype['ordered']))
+            # 字串欄位的缺值讀回為 None，改回 add_* 產生的 NaN (例如 holiday_name)
+            for col in df.select_dtypes(include='object').columns.difference(KEY_COLUMNS):
+                df[col] = df[col].where(df[col].notna(), np.nan)
+            frames.append(df)
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=KEY_COLUMNS)
+
+    def assemble(self,
+                 gantry_pair: str,
+                 combo: list,
+                 start: str=None,
+                 end: str=None) -> pd.DataFrame:
+        """
+        Returns the base rows of gantry_pair with the columns of the blocks in combo, in the same
+        column order and with the same index as applying the add_* functions one after another ('_p' first).
+
+        Parameters:
+        - gantry_pair: 'GantryFrom-GantryTo'.
+        - combo: Block names, e.g. ['_c', '_h', '_t', '_r', '_p'].
+        - start: Inclusive lower bound of TimeStamp.
+        - end: Exclusive upper bound of TimeStamp.
+        """
+        rows = self._pair_rows[gantry_pair]
+        timestamps = self.base_df['TimeStamp'].iloc[rows]
+        keep = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            keep &= (timestamps >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            keep &= (timestamps < pd.Timestamp(end)).to_numpy()
+        rows = rows[keep]
+        df = self.base_df.iloc[rows].copy()
+        for name in tk.ordered_blocks(combo):
+            block = self.read_block(name, [gantry_pair], start, end)
+            df = df.merge(block, on=KEY_COLUMNS, how='left', validate='one_to_one').set_axis(df.index)
+        if any(tk.FEATURE_BLOCKS[name]['resets_index'] for name in combo):
+            # add_traffic_event, add_road_build_event 的 merge 會重設 index，notebook 中為整個基礎資料的列位置
+            df.index = rows
+        return df
+
+    def assemble_all(self, combinations: dict, start: str=None, end: str=None) -> dict:
+        """
+        Assembles {gantry_pair: combo} into {combination_name: DataFrame}, like the combination loop of
+        modelling_feature_selection.ipynb. Every block is computed at most once per gantry pair.
+        """
+        block_pairs = dict()
+        for pair, combo in combinations.items():
+            for name in combo:
+                block_pairs.setdefault(name, []).append(pair)
+        for name, pairs in block_pairs.items():
+            self.compute_block(name, pairs)
+        return {tk.combination_name(pair, combo): self.assemble(pair, combo, start, end)
+                for pair, combo in combinations.items()}
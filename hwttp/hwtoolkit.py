@@ -2,6 +2,15 @@
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from . import data_cleaning as dc
 
 
 def highway_mileage(section_info, etag_5n_loc, RoadID, RoadDirection):
@@ -51,29 +60,40 @@ def highway_mileage(section_info, etag_5n_loc, RoadID, RoadDirection):
 
     return highway_mileage_info
     
-def traveltime_aggregation(hw5_m04a_df):
-    # Traffic=0時代表對應車種沒有資料，TravelTime就會=0，這邊代表他並不是真的TravelTime超快
-    # 所以我可以做出計算weighted_average_travel_time(watt)，一定程度可以縮減資料的筆數
-    def weighted_average(dataframe, value, weight):
-        val = dataframe[value]
-        wt = dataframe[weight]
-    
-        # 針對weight pass進來都沒有東西的話，要做額外處理
-        if wt.sum() == 0:
-            ans = 0
-        else:
-            ans = (val * wt).sum() / wt.sum()
-        return ans
-
-    # aggregation
-    hw5_m04a_agg_df = hw5_m04a_df.groupby(['TimeStamp', 'GantryFrom', 'GantryTo'])\
-                                 .apply(lambda x: pd.Series({'WeightedAvgTravelTime': weighted_average(x, 'TravelTime', 'Traffic'),
-                                                             'TotalTraffic': sum(x['Traffic'])
-                                                            }))\
-                                 .reset_index()
-    # columns modification
-    hw5_m04a_agg_df['gf_gt'] = hw5_m04a_agg_df['GantryFrom']+'-'+hw5_m04a_agg_df['GantryTo']
-    return hw5_m04a_agg_df
+def traveltime_aggregation(hw5_m04a_df, resolution=5, by_vehicle_type=False, dispersion=False):
+    '''
+    把 M04A 彙總成各門架對每個時間區間的 WeightedAvgTravelTime (以 Traffic 加權) 與 TotalTraffic
+    以分組加總計算，不對每個分組呼叫 python 函式；Traffic 加總為 0 (沒有資料) 時 WeightedAvgTravelTime 為 0
+
+    Parameters
+    ----------
+    hw5_m04a_df: pd.DataFrame
+        M04A 原始資料，需有 TimeStamp, GantryFrom, GantryTo, TravelTime, Traffic (by_vehicle_type 時需 VehicleType)
+    resolution: int
+        時間區間長度 (分鐘)，5/15/30/60，TimeStamp 為區間起點
+    by_vehicle_type: bool
+        是否加上各車種的 TravelTime_{車種}、Traffic_{車種} 與流量占比 TrafficShare_{車種}
+    dispersion: bool
+        是否加上以流量加權的 TravelTime 標準差 TravelTimeStd
+
+    Return
+    ------
+    pd.DataFrame: TimeStamp, GantryFrom, GantryTo, WeightedAvgTravelTime, TotalTraffic, [其他欄位], gf_gt
+    '''
+    sums = dc.traveltime_sums(hw5_m04a_df, resolution, by_vehicle_type)
+    return dc.traveltime_from_sums(sums, by_vehicle_type, dispersion)
+
+def traveltime_aggregation_chunked(chunks, resolution=5, by_vehicle_type=False, dispersion=False):
+    '''
+    與 traveltime_aggregation 結果相同，但逐段處理 M04A (例如 dc.iter_tdcs_dataset 或 dc.iter_csv_chunks 的輸出)
+    每段只留下分組加總，最後再合併一次，記憶體用量取決於每段的大小與彙總後的筆數，而不是原始資料量
+    '''
+    partials = [dc.traveltime_sums(chunk, resolution, by_vehicle_type) for chunk in chunks]
+    if not partials:
+        return pd.DataFrame(columns=['TimeStamp', 'GantryFrom', 'GantryTo', 'WeightedAvgTravelTime', 'TotalTraffic', 'gf_gt'])
+    sums = pd.concat(partials)
+    sums = sums.groupby(level=list(sums.index.names)).sum()
+    return dc.traveltime_from_sums(sums, by_vehicle_type, dispersion)
 
 def get_gantry_pair_mileage(milelocation_info_df, gantry_start, gantry_end):
     '''
@@ -122,166 +142,388 @@ def merge_gantrypair_with_ds(target_df, downstream_gantry_pair_df):
 
     return current_df
 
-def add_calendar_event(target_df, calendar_event):
+CALENDAR_EPOCH = pd.Timestamp('1970-01-01')
+
+def calendar_date_key(timestamps):
     '''
-    current gantry pair data add on calendar holiday info
+    日曆特徵表的整數 key：1970-01-01 起算的天數
     '''
-    target_gantry_pair_df = target_df.copy()
-    weekday_dict = {0:1,#'Monday',
-                    1:2,#'Tuseday',
-                    2:3,#'Wednesday',
-                    3:4,#'Thursday',
-                    4:5,#'Friday',
-                    5:6,#'Saturday',
-                    6:7#'Sunday'
-                   }
-    target_gantry_pair_df['temp_date'] = target_gantry_pair_df['TimeStamp'].dt.date
-    #target_gantry_pair_df.TimeStamp.dt.date
-    # 使用apply和pd.date_range生成日期范围列 for calendar_event 擴增使用
-    calendar_event['event_date'] = calendar_event.apply(lambda row: pd.date_range(start=row['start_date'],
-                                                                                  end=row['end_date']), 
-                                                        axis=1)
-    # 使用explode展开日期范围列
-    calendar_event_expand = calendar_event.explode('event_date')
-    calendar_event_expand['event_date'] = calendar_event_expand['event_date'].dt.date
-    target_gantry_pair_df = target_gantry_pair_df.merge(calendar_event_expand, 
-                                                        left_on='temp_date',
-                                                        right_on='event_date',
-                                                        how='left')
-    # add day of week
-    target_gantry_pair_df['dayofweek'] = target_gantry_pair_df['TimeStamp'].dt.weekday.apply(lambda x: weekday_dict[x])
+    return ((pd.DatetimeIndex(timestamps).normalize() - CALENDAR_EPOCH) // pd.Timedelta(days=1)).to_numpy(dtype='int64')
 
+def build_calendar_table(calendar_event, start, end):
+    '''
+    日期層級的日曆特徵表，start~end 每天一列，index 為 date_key (見 calendar_date_key)
+    欄位為 holiday_continue, holiday_length, dayofweek (星期一為 1), holiday_name 與各節日的 holiday_name_{節日}
+    同一天有多個節日時 holiday_name, holiday_continue, holiday_length 取 calendar_event 中較前面的一筆，holiday_name_* 都會標記
 
-    
-    # drop meta-data columns
-    target_gantry_pair_df.drop(columns={'temp_date', 'event_date', 'start_date', 'end_date'}, inplace=True)
+    Parameters
+    ----------
+    calendar_event: pd.DataFrame
+        需有 event_name, start_date, end_date, continuous ('T'/'F'), event_length
+    start: str
+        起始日期
+    end: str
+        結束日期 (含)
+    '''
+    dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize(), freq='D')
+    table = pd.DataFrame(index=pd.Index(calendar_date_key(dates), name='date_key'))
 
-    
-    target_gantry_pair_df.fillna({'continuous':'F', 
-                                  'event_length':0,
-                                 }, inplace=True)
-
-    # convert boolean to numeric
-    target_gantry_pair_df['continuous'] = target_gantry_pair_df['continuous'].replace({'T': 1, 'F': 0})
-    # rename and onehot
-    target_gantry_pair_df.rename(columns={'event_name':'holiday_name',
-                                           'continuous':'holiday_continue',
-                                           'event_length':'holiday_length'},
-                                            inplace=True)
-    target_gantry_pair_df['event_name'] = target_gantry_pair_df['holiday_name'] 
-    target_gantry_pair_df = pd.get_dummies(target_gantry_pair_df, columns=['holiday_name'], dtype='int')
-    target_gantry_pair_df.rename(columns={'event_name':'holiday_name'},
-                                          inplace=True)
-    return target_gantry_pair_df
-
-def add_congestion_condition(target_df, congestion_table, milelocation_info_df):
+    # 每個節日展開成涵蓋的每一天
+    events = calendar_event.reset_index(drop=True)
+    event_start = calendar_date_key(pd.to_datetime(events['start_date']))
+    n_days = np.clip(calendar_date_key(pd.to_datetime(events['end_date'])) - event_start + 1, 0, None)
+    expanded = events.loc[events.index.repeat(n_days), ['event_name', 'continuous', 'event_length']]
+    expanded['date_key'] = np.repeat(event_start, n_days) + np.arange(n_days.sum()) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+    first = expanded.drop_duplicates('date_key').set_index('date_key').reindex(table.index)
+
+    table['holiday_continue'] = first['continuous'].fillna('F').map({'T': 1, 'F': 0}).astype('int64')
+    table['holiday_length'] = first['event_length'].fillna(0).astype('float64')
+    table['dayofweek'] = dates.weekday + 1
+    table['holiday_name'] = first['event_name']
+    dummies = pd.crosstab(expanded['date_key'], expanded['event_name']).clip(upper=1)
+    dummies = dummies.reindex(table.index, fill_value=0).astype('int64')
+    dummies.columns = [f'holiday_name_{name}' for name in dummies.columns]
+    return pd.concat([table, dummies], axis=1)
+
+def load_or_build_calendar_table(path, calendar_event, start, end):
     '''
-    current gantry pair data add on congestion info
+    path 的日曆特徵表 (parquet) 由相同的 calendar_event 產生且涵蓋 start~end 時直接讀取，
+    否則重新建立 (日期取聯集) 並存檔；path 為 None 時不存檔
+    '''
+    fingerprint = hashlib.sha1(pd.util.hash_pandas_object(calendar_event, index=False).to_numpy().tobytes()).hexdigest()
+    first_key, last_key = calendar_date_key([start, end])
+    if path is not None and os.path.exists(path):
+        stored = pq.read_table(path)
+        if (stored.schema.metadata or {}).get(b'calendar_fingerprint', b'').decode() == fingerprint:
+            table = stored.to_pandas()
+            # 沒有節日的 holiday_name 讀回為 None，改回 build_calendar_table 的 NaN
+            table['holiday_name'] = table['holiday_name'].where(table['holiday_name'].notna(), np.nan)
+            if table.index.min() <= first_key and table.index.max() >= last_key:
+                return table
+            first_key, last_key = min(first_key, table.index.min()), max(last_key, table.index.max())
+    table = build_calendar_table(calendar_event, CALENDAR_EPOCH + pd.Timedelta(days=int(first_key)), 
+                                 CALENDAR_EPOCH + pd.Timedelta(days=int(last_key)))
+    if path is not None:
+        arrow_table = pa.Table.from_pandas(table)
+        metadata = {**(arrow_table.schema.metadata or {}), b'calendar_fingerprint': fingerprint.encode()}
+        pq.write_table(arrow_table.replace_schema_metadata(metadata), path)
+    return table
+
+def time_of_day_fourier(timestamps, order=2):
+    '''
+    一天為週期的 Fourier 項 tod_sin_k, tod_cos_k (k=1~order)，也可以當作 NeuralForecast 的 futr_exog
+    '''
+    timestamps = pd.DatetimeIndex(timestamps)
+    phase = 2 * np.pi * (timestamps.hour * 60 + timestamps.minute).to_numpy() / 1440
+    terms = {}
+    for k in range(1, order+1):
+        terms[f'tod_sin_{k}'] = np.sin(k * phase)
+        terms[f'tod_cos_{k}'] = np.cos(k * phase)
+    return pd.DataFrame(terms)
+
+def calendar_features(timestamps, calendar_table, fourier_order=0):
+    '''
+    依 date_key 從日曆特徵表取出每個時間點的特徵 (一次 take)，fourier_order > 0 時加上 time_of_day_fourier
+    timestamps 可以是未來的時間點 (calendar_table 需涵蓋)，回傳的 index 為 0~len-1
+    '''
+    positions = calendar_table.index.get_indexer(calendar_date_key(timestamps))
+    if (positions < 0).any():
+        raise KeyError('calendar_table does not cover all timestamps, rebuild it with a wider date range')
+    features = calendar_table.take(positions).reset_index(drop=True)
+    if fourier_order > 0:
+        features = pd.concat([features, time_of_day_fourier(timestamps, fourier_order)], axis=1)
+    return features
+
+def add_calendar_event(target_df, calendar_event, calendar_table=None, table_path=None, fourier_order=0):
+    '''
+    current gantry pair data add on calendar holiday info
+    calendar_table: build_calendar_table 的結果，沒有給時依 table_path 讀取或建立 (見 load_or_build_calendar_table)
+    fourier_order: 大於 0 時加上 time_of_day_fourier 的欄位
     '''
     df = target_df.copy()
-    
+    if calendar_table is None:
+        calendar_table = load_or_build_calendar_table(table_path, calendar_event, 
+                                                      df['TimeStamp'].min(), df['TimeStamp'].max())
+    features = calendar_features(df['TimeStamp'], calendar_table, fourier_order)
+    # onehot 只保留 df 期間內有出現的節日
+    dummy_cols = [col for col in features.columns if col.startswith('holiday_name_')]
+    features = features.drop(columns=[col for col in dummy_cols if not features[col].any()])
+    features.index = df.index
+    return pd.concat([df, features], axis=1)
+
+# 一天 1440 分鐘各自的 HHMM (0, 1, ..., 59, 100, ..., 2359)
+SLOT_HHMM = np.arange(1440) // 60 * 100 + np.arange(1440) % 60
+
+class CongestionIndex():
     # congestion table 地點里程轉換
-    transform_dict = {'南港系統': '南港系統交流道',
-                  '坪林': '坪林交控交流道', 
-                  '頭城': '頭城交流道',
-                  '宜蘭': '宜蘭交流道',
-                  '羅東': '羅東交流道'}
-    weekday_dict = {0:'weekday',
-                    1:'weekday',
-                    2:'weekday',
-                    3:'weekday',
-                    4:'weekday',
-                    5:'Saturday',
-                    6:'Sunday'}
-    
-    congestion_table['LinkStart_rep'] = congestion_table['LinkStart'].apply(lambda x: transform_dict[x])
-    congestion_table['LinkEnd_rep'] = congestion_table['LinkEnd'].apply(lambda x: transform_dict[x])
-    congestion_table = congestion_table.merge(milelocation_info_df[['LocationName', 'LocationMile']], 
-                                              left_on = 'LinkStart_rep',
-                                              right_on = 'LocationName',
-                                              how = 'left').rename(columns={'LocationMile': 'LinkStart_mile'})
-    congestion_table.drop(columns={'LocationName'}, inplace=True)
-    congestion_table = congestion_table.merge(milelocation_info_df[['LocationName', 'LocationMile']], 
-                                              left_on = 'LinkEnd_rep',
-                                              right_on = 'LocationName',
-                                              how = 'left').rename(columns={'LocationMile': 'LinkEnd_mile'})
-    congestion_table.drop(columns={'LocationName'}, inplace=True)
-    
-    # target df year-month
-    df['temp_yearmonth'] = df['TimeStamp'].dt.strftime('%Y%m').astype('int')
-    df['temp_hourminute'] = df['TimeStamp'].dt.hour * 100 + df['TimeStamp'].dt.minute
-    df['temp_dayofweek'] = df['TimeStamp'].dt.weekday.apply(lambda x: weekday_dict[x])
-    df = df.merge(milelocation_info_df[['LocationName', 'LocationMile']], 
-                  left_on='GantryFrom',
-                  right_on='LocationName',
-                  how='left').rename(columns={'LocationMile':'gf_mile'})
-    df.drop(columns={'LocationName'}, inplace=True)
-    
-    df = df.merge(milelocation_info_df[['LocationName', 'LocationMile']], 
-                  left_on='GantryTo',
-                  right_on='LocationName',
-                  how='left').rename(columns={'LocationMile':'gt_mile'})
-    df.drop(columns={'LocationName'}, inplace=True)
+    TRANSFORM_DICT = {'南港系統': '南港系統交流道',
+                      '坪林': '坪林交控交流道', 
+                      '頭城': '頭城交流道',
+                      '宜蘭': '宜蘭交流道',
+                      '羅東': '羅東交流道'}
+    # congestion table 的 dayofweek 對應的 weekday (0 為星期一)
+    DAYOFWEEK_DICT = {'weekday': [0, 1, 2, 3, 4], 'Saturday': [5], 'Sunday': [6]}
 
-    # set direction
-    direction = 'N'
-    # 不同方向要分開寫，因為里程大小判斷會顛倒
-    congest_index_list = []
-    for idx, row in congestion_table[congestion_table.direction == 'N'].iterrows():
-        test_df = df[(df.gf_mile >= row['LinkEnd_mile']) & (row['LinkStart_mile'] >= df.gt_mile)\
-        & (df.temp_yearmonth >= row['StartYearMonth']) & (df.temp_yearmonth <= row['EndYearMonth'])\
-        & (df.temp_dayofweek == row['dayofweek'])\
-        & (df.temp_hourminute >= row['CongestStart']) & (df.temp_hourminute <= row['CongestEnd'])].copy()
-    
-        if test_df.shape[0] != 0:
-            # print(row)
-            # display(test_df)
-            congest_index_list.extend(test_df.index)
-            # print(test_df)
-        if len(congest_index_list) != len(set(congest_index_list)):
-            print('locate same df.index before')
-        #     break
-    
-    # inspection area
-    duplicates = {item: congest_index_list.count(item) for item in set(congest_index_list) if congest_index_list.count(item) > 1}
-    
-    # congest_index_list
+    def __init__(self, mask, pairs, months, fingerprint=''):
+        '''
+        congestion table 編譯後的查詢表，mask[門架對, 年月, 星期, 當天第幾分鐘] 為該時段是否為常態壅塞
+        一般使用 CongestionIndex.compile 或 CongestionIndex.load_or_compile 建立
+
+        mask: np.ndarray
+            bool，shape 為 (len(pairs), len(months), 7, 1440)
+        pairs: list
+            'GantryFrom-GantryTo' 的 list
+        months: np.ndarray
+            年月 (YYYYMM 整數)，由小到大
+        fingerprint: str
+            編譯來源 (congestion table、門架里程、方向) 的 hash，用來判斷存檔是否過期
+        '''
+        self.mask = mask
+        self.pairs = list(pairs)
+        self.months = np.asarray(months, dtype='int64')
+        self.fingerprint = fingerprint
+        self._pair_index = pd.Index(self.pairs)
+
+    @staticmethod
+    def source_fingerprint(congestion_table, milelocation_info_df, direction='N'):
+        '''
+        congestion table 與門架里程內容的 hash
+        '''
+        digest = hashlib.sha1(direction.encode())
+        for df in [congestion_table, milelocation_info_df[['LocationName', 'LocationMile']]]:
+            digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def compile(cls, congestion_table, milelocation_info_df, pairs, direction='N'):
+        '''
+        把 congestion table 的每條規則 (路段、年月區間、星期、時間區間) 展開到查詢表，只需做一次
+
+        congestion_table: pd.DataFrame
+            需有 direction, LinkStart, LinkEnd, StartYearMonth, EndYearMonth, dayofweek, CongestStart, CongestEnd
+        milelocation_info_df: pd.DataFrame
+            highway_mileage 的輸出
+        pairs: list
+            要建立的門架對 'GantryFrom-GantryTo'
+        direction: str
+            只使用這個方向的規則，北向時路段起點里程較大
+        '''
+        pairs = list(dict.fromkeys(pairs))
+        mileage = milelocation_info_df.drop_duplicates('LocationName').set_index('LocationName')['LocationMile']
+        gantry = pd.Series(pairs).str.split('-', expand=True) if pairs else pd.DataFrame(columns=[0, 1])
+        gf_mile = gantry[0].map(mileage).to_numpy(dtype='float64')
+        gt_mile = gantry[1].map(mileage).to_numpy(dtype='float64')
+
+        rules = congestion_table[congestion_table['direction'] == direction]
+        link_start = rules['LinkStart'].apply(lambda x: cls.TRANSFORM_DICT[x]).map(mileage).to_numpy(dtype='float64')
+        link_end = rules['LinkEnd'].apply(lambda x: cls.TRANSFORM_DICT[x]).map(mileage).to_numpy(dtype='float64')
+        if len(rules):
+            months = pd.period_range(pd.Period(str(rules['StartYearMonth'].min()), freq='M'),
+                                     pd.Period(str(rules['EndYearMonth'].max()), freq='M'), freq='M')
+            months = (months.year * 100 + months.month).to_numpy(dtype='int64')
+        else:
+            months = np.array([], dtype='int64')
+
+        mask = np.zeros((len(pairs), len(months), 7, 1440), dtype=bool)
+        for rule, start_mile, end_mile in zip(rules.itertuples(index=False), link_start, link_end):
+            pair_hit = (gf_mile >= end_mile) & (start_mile >= gt_mile)
+            month_hit = (months >= rule.StartYearMonth) & (months <= rule.EndYearMonth)
+            days = cls.DAYOFWEEK_DICT[rule.dayofweek]
+            # CongestStart/CongestEnd 為 HHMM，兩端皆包含
+            slots = (SLOT_HHMM >= rule.CongestStart) & (SLOT_HHMM <= rule.CongestEnd)
+            mask[np.ix_(pair_hit, month_hit, days, slots)] = True
+        return cls(mask, pairs, months, cls.source_fingerprint(congestion_table, milelocation_info_df, direction))
+
+    def save(self, path):
+        '''
+        存成壓縮的 .npz
+        '''
+        np.savez_compressed(path, mask=self.mask, pairs=np.array(self.pairs, dtype=str), 
+                            months=self.months, fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mask'], data['pairs'].tolist(), data['months'], str(data['fingerprint']))
+
+    @classmethod
+    def load_or_compile(cls, path, congestion_table, milelocation_info_df, pairs, direction='N'):
+        '''
+        path 的存檔與來源相同且涵蓋所有 pairs 時直接讀取，否則重新編譯 (門架對取聯集) 並存檔；path 為 None 時不存檔
+        '''
+        fingerprint = cls.source_fingerprint(congestion_table, milelocation_info_df, direction)
+        pairs = list(dict.fromkeys(pairs))
+        if path is not None and os.path.exists(path):
+            index = cls.load(path)
+            if index.fingerprint == fingerprint and set(pairs) <= set(index.pairs):
+                return index
+            if index.fingerprint == fingerprint:
+                pairs = index.pairs + [pair for pair in pairs if pair not in set(index.pairs)]
+        index = cls.compile(congestion_table, milelocation_info_df, pairs, direction)
+        if path is not None:
+            index.save(path)
+        return index
+
+    def lookup(self, target_df):
+        '''
+        target_df 每一列 (gf_gt 或 GantryFrom/GantryTo, TimeStamp) 是否落在常態壅塞時段，回傳 bool array
+        '''
+        pairs = target_df['gf_gt'] if 'gf_gt' in target_df.columns \
+                else target_df['GantryFrom'].astype(str)+'-'+target_df['GantryTo'].astype(str)
+        timestamp = target_df['TimeStamp']
+        pair_pos = self._pair_index.get_indexer(pairs)
+        year_month = (timestamp.dt.year * 100 + timestamp.dt.month).to_numpy(dtype='int64')
+        month_pos = np.searchsorted(self.months, year_month)
+        valid = (pair_pos >= 0) & (month_pos < len(self.months))
+        valid[valid] &= self.months[month_pos[valid]] == year_month[valid]
+        result = np.zeros(len(target_df), dtype=bool)
+        result[valid] = self.mask[pair_pos[valid], 
+                                  month_pos[valid], 
+                                  timestamp.dt.weekday.to_numpy()[valid], 
+                                  (timestamp.dt.hour * 60 + timestamp.dt.minute).to_numpy()[valid]]
+        return result
+
+def add_congestion_condition(target_df, congestion_table, milelocation_info_df, index_path=None):
+    '''
+    current gantry pair data add on congestion info
+    index_path: 編譯後的 CongestionIndex 存檔路徑 (.npz)，來源沒有變動時直接重複使用
+    '''
+    df = target_df.copy()
+    pairs = df['gf_gt'].unique() if 'gf_gt' in df.columns \
+            else (df['GantryFrom'].astype(str)+'-'+df['GantryTo'].astype(str)).unique()
+    index = CongestionIndex.load_or_compile(index_path, congestion_table, milelocation_info_df, pairs)
     # create new columns and assign congestion situation othe new add columns
-    df['congestion_syndrome'] = 0
-    df.loc[df.index.isin(congest_index_list), 'congestion_syndrome'] = 1
-    # remove temp columns
-    df.drop(columns={'temp_yearmonth', 'temp_hourminute', 'temp_dayofweek', 'gf_mile', 'gt_mile'}, inplace=True)
+    df['congestion_syndrome'] = index.lookup(df).astype('int64')
+    return df
+
+def interval_join(target_df, events, time_bounds, mile_bounds, columns, policy='latest',
+                  target_time='TimeStamp', target_miles=('gt_mile', 'gf_mile')):
+    '''
+    把事件依時間區間與里程區間對應到 target_df 的每一列，回傳與 target_df 同 index 的事件欄位 (沒有對應的列為缺值)
+    列的時間落在 [start, end] 且列的里程區間 [gt_mile, gf_mile] 與事件的里程區間 [low, high] 重疊時視為對應
+    target_df 先依時間排序，每個事件以 searchsorted 找出時間區間內的列，再一次比對里程，不逐事件掃描整個 df
+
+    Parameters
+    ----------
+    target_df: pd.DataFrame
+        需有 target_time 與 target_miles 欄位
+    events: pd.DataFrame
+        事件資料
+    time_bounds: tuple
+        事件的 (開始時間, 結束時間) 欄位，兩端皆包含
+    mile_bounds: tuple
+        事件的 (里程下界, 里程上界) 欄位，單點事件兩者為同一欄
+    columns: list
+        要帶到 target_df 的事件欄位
+    policy: str or dict
+        一列同時對應多個事件時的處理方式，可依欄位分別指定 {欄位: policy}
+        'latest' 取開始時間最晚的事件 (同時間以 events 中較後面的為準)，'first' 取最早的，
+        'max', 'min', 'sum' 等 groupby 彙總方式只用於數值欄位，非數值欄位改用 'latest'
+    target_time: str
+        target_df 的時間欄位
+    target_miles: tuple
+        target_df 的 (里程下界, 里程上界) 欄位
+    '''
+    times = target_df[target_time].to_numpy(dtype='datetime64[ns]')
+    order = np.argsort(times, kind='stable')
+    sorted_times = times[order]
+    start = events[time_bounds[0]].to_numpy(dtype='datetime64[ns]')
+    end = events[time_bounds[1]].to_numpy(dtype='datetime64[ns]')
+    lo = np.searchsorted(sorted_times, start, side='left')
+    hi = np.searchsorted(sorted_times, end, side='right')
+    counts = np.where(np.isnat(start) | np.isnat(end), 0, np.clip(hi - lo, 0, None))
+
+    # 展開成 (列, 事件) 的候選組合，再比對里程區間
+    event_pos = np.repeat(np.arange(len(events)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    row_pos = order[np.repeat(lo, counts) + offsets]
+    row_low = target_df[target_miles[0]].to_numpy(dtype='float64')[row_pos]
+    row_high = target_df[target_miles[1]].to_numpy(dtype='float64')[row_pos]
+    event_low = events[mile_bounds[0]].to_numpy(dtype='float64')[event_pos]
+    event_high = events[mile_bounds[1]].to_numpy(dtype='float64')[event_pos]
+    matched = (row_low <= event_high) & (event_low <= row_high)
+    row_pos, event_pos = row_pos[matched], event_pos[matched]
+
+    # 依 policy 處理重疊的事件
+    policies = policy if isinstance(policy, dict) else {col: policy for col in columns}
+    values = events[columns].iloc[event_pos].reset_index(drop=True)
+    values['_row'] = row_pos
+    values['_order'] = np.argsort(np.argsort(start, kind='stable'), kind='stable')[event_pos]
+    values = values.sort_values('_order', kind='stable')
+    result = pd.DataFrame(index=pd.RangeIndex(len(target_df)))
+    for col in columns:
+        col_policy = policies.get(col, 'latest')
+        if col_policy not in ('latest', 'first') and not pd.api.types.is_numeric_dtype(events[col]):
+            col_policy = 'latest'
+        if col_policy in ('latest', 'first'):
+            picked = values.drop_duplicates('_row', keep='last' if col_policy == 'latest' else 'first')
+            result[col] = picked.set_index('_row')[col]
+        else:
+            result[col] = values.groupby('_row')[col].agg(col_policy)
+    result.index = target_df.index
+    return result
 
+# 事件特徵的精簡型態，大部分的列沒有事件，用小整數與 category 可以大幅減少之後每次 copy 的記憶體
+# 都是 parquet 可以直接存的型態，輸出給模型前再用 densify_features 轉回一般數值欄位
+EVENT_FEATURE_DTYPES = {'road_build': 'int8', 'total_block_count': 'int8', 'road_block_count': 'int8',
+                        'accident_mileage': 'float64', 'handling_minutes': 'int32',
+                        'accident_type': pd.CategoricalDtype([0, 1, 2, 3], ordered=True),
+                        'event_occurrence': 'category', 'event_exclusion': 'category',
+                        'death_count': 'int16', 'injuries_count': 'int16', 'accident_vehicle_count': 'int16', 
+                        'light_truck_count': 'int16', 'passenger_car_count': 'int16', 'bus_count': 'int16', 
+                        'heavy_truck_count': 'int16',
+                        'inner_shoulder_flag': 'int8', 'inner_lane_flag': 'int8', 'middle_inner_lane_flag': 'int8', 
+                        'middle_lane_flag': 'int8', 'middle_outer_lane_flag': 'int8', 'outer_lane_flag': 'int8',
+                        'outer_shoulder_flag': 'int8', 'ramp_flag': 'int8', 'overturn_accident_flag': 'int8', 
+                        'construction_accident_flag': 'int8', 'hazardous_material_vehicle_flag': 'int8', 
+                        'on_fire_vehicle_flag': 'int8', 'smoking_vehicle_flag': 'int8', 'mainlane_disruption_flag': 'int8'}
+
+def compact_event_features(df):
+    '''
+    把 df 中的事件特徵欄位轉成 EVENT_FEATURE_DTYPES 的型態 (直接修改並回傳)
+    event_occurrence/event_exclusion 為字串 category，未發生事件的列為 '99999999'
+    '''
+    for col, dtype in EVENT_FEATURE_DTYPES.items():
+        if col not in df.columns:
+            continue
+        if isinstance(dtype, str) and dtype == 'category':
+            df[col] = df[col].astype(str).astype('category')
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def densify_features(df, dtype='float64'):
+    '''
+    輸出給模型前，把 category、小整數、nullable、sparse 欄位轉回一般的 numpy 欄位
+    數值 category (如 accident_type) 轉回數值，其他 category 轉回字串，數值欄位轉成 dtype，缺值為 NaN
+    '''
+    df = df.copy()
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.SparseDtype):
+            values = values.sparse.to_dense()
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            if pd.api.types.is_numeric_dtype(values.cat.categories):
+                values = values.astype(values.cat.categories.dtype if not values.hasnans else 'float64')
+            else:
+                values = values.astype(object)
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.astype(dtype)
+        df[col] = values
     return df
 
-def add_road_build_event(target_df, road_build_event, milelocation_info_df):
+def add_road_build_event(target_df, road_build_event, milelocation_info_df, policy='latest'):
     '''
     add road build event to current pair data
+    policy: 多個施工事件重疊時的取值方式，見 interval_join
     '''
     df = target_df.copy()
 
-    # congestion table 地點里程轉換
-    transform_dict = {'南港系統': '南港系統交流道',
-                  '坪林': '坪林交控交流道', 
-                  '頭城': '頭城交流道',
-                  '宜蘭': '宜蘭交流道',
-                  '羅東': '羅東交流道'}
-    weekday_dict = {0:'weekday',
-                    1:'weekday',
-                    2:'weekday',
-                    3:'weekday',
-                    4:'weekday',
-                    5:'Saturday',
-                    6:'Sunday'}
-
     # load and lock road_build_event_df
     # 鎖定國五、北向
     road_build_event = road_build_event.query('incStepFreewayId==10050 & incStepDirection==2')
 
-    # target df year-month
-    df['temp_yearmonth'] = df['TimeStamp'].dt.strftime('%Y%m').astype('int')
-    df['temp_hourminute'] = df['TimeStamp'].dt.hour * 100 + df['TimeStamp'].dt.minute
-    df['weekofday'] = df['TimeStamp'].dt.weekday.apply(lambda x: weekday_dict[x])
+    # target df mile location
     df = df.merge(milelocation_info_df[['LocationName', 'LocationMile']], 
                   left_on='GantryFrom',
                   right_on='LocationName',
@@ -296,63 +538,30 @@ def add_road_build_event(target_df, road_build_event, milelocation_info_df):
 
 
     # insert value
-    road_build_index_list = []
-    road_build_dict = {}
-    for idx, row in tqdm(road_build_event.iterrows(), total=road_build_event.shape[0]):
-        temp_df = df[(df.TimeStamp>=row['incStepTime']) & (df.TimeStamp<=row['incStepEndTime'])\
-        & (df.gf_mile >= row['incStepEndMileage']) & (row['incStepStartMileage'] >= df.gt_mile)]
-        
-        if temp_df.shape[0] != 0:
-            road_build_index_list.extend(temp_df.index)
-
-            # create extra feature for road build event
-            # further information pls review the original data description
-            block_condition = row['incStepBlockagePattern']
-            total_block_count = block_condition[0:14].count('1')
-            road_block_count = block_condition[1:10].count('1')
-            road_build = 1
-            road_build_dict[row['incStepIncidentId']] = {'df_index': list(temp_df.index),
-                                                         'total_block_count': total_block_count,
-                                                         'road_block_count': road_block_count,
-                                                         'road_build': road_build
-                                                        }
-
-        if len(road_build_index_list) != len(set(road_build_index_list)):
-            pass
-            # 是有可能重複的，變成需要額外多加一些標記進去
-            # print('locate same df.index before')  
-            # display(temp_df)
-            # print(row)
-            # return road_build_index_list
-            # break
-    print('Complete checking & extract road_build_event')
-    # inspection area
-    duplicates = {item: road_build_index_list.count(item) for item in set(road_build_index_list) if road_build_index_list.count(item) > 1}
-    
-    # create new columns and assign congestion situation othe new add columns
-    df['road_build'] = 0
-    df['total_block_count'] = 0
-    df['road_block_count'] = 0
-    # df.loc[df.index.isin(road_build_index_list), 'road_build'] = 1
-    for ikey in tqdm(road_build_dict.keys()):
-        target_index = road_build_dict[ikey]['df_index']
-        total_block_count = road_build_dict[ikey]['total_block_count']
-        road_block_count = road_build_dict[ikey]['road_block_count']
-        road_build = road_build_dict[ikey]['road_build']
-        df.loc[df.index.isin(target_index), 'total_block_count'] = total_block_count
-        df.loc[df.index.isin(target_index), 'road_block_count'] = road_block_count
-        df.loc[df.index.isin(target_index), 'road_build'] = road_build
+    # further information pls review the original data description
+    events = road_build_event.copy()
+    block_condition = events['incStepBlockagePattern'].astype(str)
+    events['total_block_count'] = block_condition.str[0:14].str.count('1')
+    events['road_block_count'] = block_condition.str[1:10].str.count('1')
+    events['road_build'] = 1
+    road_build_cols = ['road_build', 'total_block_count', 'road_block_count']
+    # 同一時段可能有多個施工事件重疊，由 policy 決定取值
+    matched = interval_join(df, events, ('incStepTime', 'incStepEndTime'), ('incStepEndMileage', 'incStepStartMileage'),
+                            road_build_cols, policy=policy)
+    df[road_build_cols] = matched.fillna(0)
+    df = compact_event_features(df)
     print('Complete road_build_event insertion to current df')
     print('will return 2 object: road_build_event, df')
 
     # remove temp columns
-    df.drop(columns=['temp_yearmonth', 'temp_hourminute', 'gf_mile', 'gt_mile', 'weekofday'], inplace=True)
+    df.drop(columns=['gf_mile', 'gt_mile'], inplace=True)
     return road_build_event, df
 
-def add_traffic_event(target_df, traffic_accident_data, milelocation_info_df):
+def add_traffic_event(target_df, traffic_accident_data, milelocation_info_df, policy='latest'):
     '''
     Add traffic event to the target gantry pair df, will return located traffic accident data
     and the annotated gantry pair df
+    policy: 多個事故重疊時的取值方式，見 interval_join
     '''
     df = target_df.copy()
     
@@ -368,21 +577,19 @@ def add_traffic_event(target_df, traffic_accident_data, milelocation_info_df):
     traffic_accident_data = traffic_accident_data[keep_cols].copy()
     traffic_accident_data['里程'] = traffic_accident_data['里程']*1000 # 因為是xk單位
     # print(traffic_accident_data.keys())
-    traffic_accident_data['start_datetime'] = pd.to_datetime(traffic_accident_data[['年', '月', '日']].astype(str).agg('-'.join, axis=1) 
-                                             + ' ' 
-                                             + traffic_accident_data[['時', '分']].astype(str).agg(':'.join, axis=1)
-                                            )
+    traffic_accident_data['start_datetime'] = pd.to_datetime(traffic_accident_data[['年', '月', '日', '時', '分']]
+                                                             .set_axis(['year', 'month', 'day', 'hour', 'minute'], axis=1))
     traffic_accident_data['end_datetime'] = traffic_accident_data['start_datetime'] + pd.to_timedelta(traffic_accident_data['處理分鐘'], unit='m')
     # 這邊要整合並擷取出我要看的事故發生車輛數
     # 擴大到其他國道、方向時需要檢驗原始通報的資料中存在哪些類型，有的地方寫得不是很標準
     car_columns_set = ['車輛1', '車輛2', '車輛3', '車輛4', 
                    '車輛5', '車輛6', '車輛7', '車輛8', 
                    '車輛9', '車輛10', '車輛11', '車輛12']
-    traffic_accident_data['total_car_string'] = traffic_accident_data[car_columns_set].apply(lambda x: ','.join(x.dropna()), axis=1)
-    traffic_accident_data['小貨車'] = traffic_accident_data['total_car_string'].apply(lambda x: x.count('小貨車'))
-    traffic_accident_data['小客車'] = traffic_accident_data['total_car_string'].apply(lambda x: x.count('小客車'))
-    traffic_accident_data['大客車'] = traffic_accident_data['total_car_string'].apply(lambda x: x.count('大客車'))
-    traffic_accident_data['大貨車'] = traffic_accident_data['total_car_string'].apply(lambda x: x.count('大貨車'))
+    # 12 個車輛欄位疊成一欄後一次計數，再依事故加總
+    car_strings = traffic_accident_data[car_columns_set].stack().astype(str)
+    for car_type in ['小貨車', '小客車', '大客車', '大貨車']:
+        traffic_accident_data[car_type] = car_strings.str.count(car_type).groupby(level=0).sum()\
+                                                     .reindex(traffic_accident_data.index, fill_value=0)
     traffic_accident_data.drop(columns=car_columns_set, inplace=True)
     traffic_accident_data.drop(columns='簡訊內容', inplace=True)
 
@@ -400,36 +607,20 @@ def add_traffic_event(target_df, traffic_accident_data, milelocation_info_df):
     df.drop(columns={'LocationName'}, inplace=True)
     
     # insert value
-    TA_list = list()
     info = ['里程', '事件發生', '事件排除', '處理分鐘',
        '事故類型', '死亡', '受傷', '內路肩', '內車道', '中內車道', '中車道', '中外車道', '外車道', '外路肩',
        '匝道', '翻覆事故註記', '施工事故註記', '危險物品車輛註記', '車輛起火註記', '冒煙車事故註記', '主線中斷註記',
-       '肇事車輛', 'total_car_string', '小貨車','小客車', '大客車', '大貨車']
-    for idx, row in tqdm(traffic_accident_data.iterrows(), total=traffic_accident_data.shape[0]):
-        TA_dict = dict() # initialize
-        temp_df = df[(df.TimeStamp>=row['start_datetime']) & (df.TimeStamp<=row['end_datetime'])\
-        & (df.gf_mile >= row['里程']) & (row['里程'] >= df.gt_mile)]
-        
-        if temp_df.shape[0] != 0:
-            for key in info:
-                TA_dict[key] = row[key]
-            TA_dict['df_index'] = list(temp_df.index)
-            TA_list.append(TA_dict)
-    print(f'Complete checking traffic accident data, total event count = {len(TA_list)}')
-
-    df[info] = np.nan
-    # for key in info:
-    #     df[key] = None
-    for item in tqdm(TA_list):
-        target_item = list(item.copy().keys())
-        target_item.pop(target_item.index('df_index'))
-        for key in target_item:
-            df.loc[df.index.isin(item['df_index']), key] = item[key]
+       '肇事車輛', '小貨車','小客車', '大客車', '大貨車']
+    # 事故為單點里程，同一時段多個事故重疊時由 policy 決定取值
+    matched = interval_join(df, traffic_accident_data, ('start_datetime', 'end_datetime'), ('里程', '里程'),
+                            info, policy=policy)
+    print(f'Complete checking traffic accident data, matched rows = {matched["里程"].notna().sum()}')
+    df[info] = matched
     print('Complete traffic accident data insertion')
     print('will return 2 object: target_traffic_accident_data, df')
 
     # drop
-    drop_cols = ['gf_mile', 'gt_mile', 'total_car_string']
+    drop_cols = ['gf_mile', 'gt_mile']
     df.drop(columns=drop_cols, inplace=True)
     # rename
     df.rename(columns={'里程':'accident_mileage', 
@@ -478,77 +669,144 @@ def add_traffic_event(target_df, traffic_accident_data, milelocation_info_df):
                           'A2':2,
                           'A1':3
                          }
-    df['accident_type'] = df['accident_type'].apply(lambda x: acc_type_transform[x])
+    df['accident_type'] = df['accident_type'].map(acc_type_transform)
     df[altermeaning_fill_9] = df[altermeaning_fill_9].fillna(99999999)
     df[processtime_fill_0] = df[processtime_fill_0].fillna(0)
     df[flag_fill_0] = df[flag_fill_0].fillna(0)
     df[count_fill_0] = df[count_fill_0].fillna(0)
+    df = compact_event_features(df)
     return traffic_accident_data, df
     
-def add_ds_5prev_traveltime(target_df):
-    '''注意，使用上因為先天設計不佳，在多個變數組合時，這個函數要優先使用，以後有機會再改'''
-    # initialization
-    hw5_15watt = target_df.copy()
-    final_df = pd.DataFrame()
-    
-    # 利用 gantry to 的端點來找下游
-    for gantry_pair in hw5_15watt['gf_gt'].unique():
-        target_gt = gantry_pair.split('-')[1]
-        # 自己與自己匹配 但有延遲
-        gantry_pair_count, gantry_pair_df_list = get_downstream_gantrypair(hw5_15watt, target_gt)
-    
-        try:
-            for i, df in enumerate(gantry_pair_df_list):
-                gantry_pair_df_list[i] = df.drop(columns='TotalTraffic').copy()
-        except:
-            None
-            
-        if gantry_pair_count==0:
-            # 沒有下游的處理手法 （目前可能先跳過，因為聚焦在國五上） #不行還是要給回去，否則會漏掉資料
-            # print(f'gantry_id {target_gt} has no downstream gantry !')
-            result_df = hw5_15watt[hw5_15watt.gf_gt==gantry_pair].copy()
-        elif gantry_pair_count==2:
-            # 多下游的處理手法...... 目前用加起來除以二
-            # print('2 pair gantry')
-            current_df = hw5_15watt[hw5_15watt['gf_gt']==gantry_pair].copy()
-            result_df = merge_gantrypair_with_ds(current_df, gantry_pair_df_list[0])
-            # current_df = hw5_15watt[hw5_15watt['gf_gt']==gantry_pair].copy()
-            result_df2 = merge_gantrypair_with_ds(current_df, gantry_pair_df_list[1])
-            result_df.drop(columns='ds_gf_gt',inplace=True)
-    
-            ori_col_list = []
-            tar_col_list = []
-            # 因為新增多個序列輔助參考
-            for i in range(5):
-                ori_col = f'ds_prev_{i+1}_WATT'
-                tar_col = f'ds_prev_{i+1}_WATT_2'
-                result_df2.rename(columns={ori_col: tar_col},inplace=True)
-                tar_col_list.append(tar_col)
-                ori_col_list.append(ori_col)
-            # 短暫拼湊
-            result_df = pd.concat([result_df, result_df2[tar_col_list]], axis=1)
-            
-            # 相加除二
-            for col in ori_col_list:
-                result_df[col] = (result_df[col] + result_df[col+'_2'])/2
-            
-            # 移除輔助欄位
-            for col in tar_col_list:
-                result_df.drop(columns=col, inplace=True)
-        else:
-            # print('1 pair gantry')
-            current_df = hw5_15watt[hw5_15watt['gf_gt']==gantry_pair].copy()
-            result_df = merge_gantrypair_with_ds(current_df, gantry_pair_df_list[0])
-            result_df.drop(columns=['ds_gf_gt'], inplace=True)
+class GantryTopology():
+    def __init__(self, pairs, milelocation_info_df=None):
+        '''
+        門架對的上下游關係，建立一次後重複使用，第 k 層的上/下游門架對會快取
+
+        pairs: list
+            'GantryFrom-GantryTo' 的 list，例如 hw5_m04a_agg_df['gf_gt'].unique()
+        milelocation_info_df: pd.DataFrame
+            highway_mileage 的輸出，提供 pair_mileage 使用的門架里程
+        '''
+        self.pairs = list(dict.fromkeys(pairs))
+        self.milelocation_info_df = milelocation_info_df
+        pairs_from, pairs_to = {}, {}
+        for pair in self.pairs:
+            gantry_from, gantry_to = pair.split('-')
+            pairs_from.setdefault(gantry_from, []).append(pair)
+            pairs_to.setdefault(gantry_to, []).append(pair)
+        # 下游：GantryFrom 為自己的 GantryTo 的門架對 (同 get_downstream_gantrypair)，上游則相反
+        self.downstream = {pair: pairs_from.get(pair.split('-')[1], []) for pair in self.pairs}
+        self.upstream = {pair: pairs_to.get(pair.split('-')[0], []) for pair in self.pairs}
+        self._hop_edges = {}
+
+    def neighbors(self, pair, direction='downstream', hop=1):
+        '''
+        第 hop 層的上游或下游門架對
+        '''
+        edges = self.hop_edges(direction, hop)
+        return edges.loc[edges['gf_gt'] == pair, 'neighbor_gf_gt'].tolist()
+
+    def hop_edges(self, direction='downstream', hop=1):
+        '''
+        每個門架對與其第 hop 層上游或下游門架對的對應表，欄位為 gf_gt, neighbor_gf_gt
+        '''
+        if (direction, hop) not in self._hop_edges:
+            adjacency = self.downstream if direction == 'downstream' else self.upstream
+            rows = []
+            for pair in self.pairs:
+                frontier = [pair]
+                for _ in range(hop):
+                    frontier = list(dict.fromkeys(neighbor for current in frontier for neighbor in adjacency[current]))
+                rows.extend((pair, neighbor) for neighbor in frontier if neighbor != pair)
+            self._hop_edges[(direction, hop)] = pd.DataFrame(rows, columns=['gf_gt', 'neighbor_gf_gt'])
+        return self._hop_edges[(direction, hop)]
+
+    def pair_mileage(self):
+        '''
+        各門架對的端點里程，欄位為 gf_gt, GantryFrom, GantryTo, gf_mile, gt_mile
+        '''
+        mileage = self.milelocation_info_df.drop_duplicates('LocationName').set_index('LocationName')['LocationMile']
+        df = pd.DataFrame({'gf_gt': self.pairs})
+        df[['GantryFrom', 'GantryTo']] = df['gf_gt'].str.split('-', expand=True)
+        df['gf_mile'] = df['GantryFrom'].map(mileage)
+        df['gt_mile'] = df['GantryTo'].map(mileage)
+        return df
+
+def add_spatial_lag_features(target_df, topology=None, direction='downstream', hops=1, lags=5,
+                             value_col='WeightedAvgTravelTime', value_name='WATT'):
+    '''
+    一次替所有門架對加上第 1~hops 層上游或下游門架對的前 1~lags 個時段的值
+    欄位為 {ds|us}[層數]_prev_{lag}_{value_name}，第 1 層不標層數，例如 ds_prev_1_WATT, ds2_prev_3_WATT, us_prev_1_WATT
+    同一層有多個門架對時取平均，其中任一個門架對在該時段沒有值時為缺值 (與 add_ds_5prev_traveltime 原本的 (a+b)/2 相同)
+    只以 gf_gt, TimeStamp 對應，不會與其他欄位衝突，可以放在特徵流程中的任何位置
 
-        final_df = pd.concat([final_df, result_df])
-        final_df = final_df.fillna(0)
+    Parameters
+    ----------
+    target_df: pd.DataFrame
+        需有 TimeStamp, gf_gt 與 value_col，依 TimeStamp 排序的各門架對序列
+    topology: GantryTopology
+        預設由 target_df 的門架對建立
+    direction: str
+        'downstream' 或 'upstream'
+    hops: int or list
+        int 時為 1~hops 層，或指定層數的 list
+    lags: int or list
+        int 時為前 1~lags 個時段，或指定 lag 的 list；以各門架對自己的列數 shift (同 merge_gantrypair_with_ds)
+    value_col: str
+        要取 lag 的欄位
+    value_name: str
+        欄位名稱中 value_col 的縮寫
 
-    return final_df
+    Return
+    ------
+    pd.DataFrame: target_df 加上 lag 欄位，列的順序與 index 不變
+    '''
+    topology = topology or GantryTopology(target_df['gf_gt'].unique())
+    hops = range(1, hops+1) if isinstance(hops, int) else hops
+    lags = range(1, lags+1) if isinstance(lags, int) else lags
+    prefix = 'ds' if direction == 'downstream' else 'us'
+
+    # 各門架對自己的序列先 shift，之後各層只要依對應表 join
+    series = target_df[['gf_gt', 'TimeStamp', value_col]].sort_values(['gf_gt', 'TimeStamp'], kind='stable')
+    series['gf_gt'] = series['gf_gt'].astype(str)
+    lag_cols = [f'lag_{lag}' for lag in lags]
+    shifted = series.groupby('gf_gt', sort=False)[value_col]
+    for lag, col in zip(lags, lag_cols):
+        series[col] = shifted.shift(lag)
+    series = series.drop(columns=value_col).rename(columns={'gf_gt': 'neighbor_gf_gt'})
+
+    df = target_df.copy()
+    for hop in hops:
+        edges = topology.hop_edges(direction, hop)
+        hop_prefix = prefix if hop == 1 else f'{prefix}{hop}'
+        new_cols = [f'{hop_prefix}_prev_{lag}_{value_name}' for lag in lags]
+        grouped = edges.merge(series, on='neighbor_gf_gt').groupby(['gf_gt', 'TimeStamp'])[lag_cols]
+        sums, counts = grouped.sum(), grouped.count()
+        n_branches = edges.groupby('gf_gt').size().reindex(sums.index.get_level_values('gf_gt')).to_numpy()
+        means = (sums / counts).where(counts.to_numpy() == n_branches[:, None])
+        means.columns = new_cols
+        df = df.drop(columns=[col for col in new_cols if col in df.columns])
+        df = df.join(means, on=['gf_gt', 'TimeStamp'])
+    return df
+
+def add_ds_5prev_traveltime(target_df, topology=None):
+    '''
+    加上下游門架對前 1~5 個時段的 WeightedAvgTravelTime (ds_prev_1_WATT ~ ds_prev_5_WATT)
+    多個下游時取平均，沒有下游或沒有資料時為 0；以 add_spatial_lag_features 計算，可以與其他特徵以任意順序組合
+    '''
+    df = add_spatial_lag_features(target_df, topology, direction='downstream', hops=1, lags=5)
+    return df.fillna(0)
     
 class hw_df_resource():
-    def __init__(self, data_paths):
+    def __init__(self, data_paths, backend='csv'):
+        '''
+        data_paths: dict
+            各資料的路徑，backend 為 'sqlite' 時需要 'hwdb' (資料庫路徑)，'parquet' 時需要 'store' (store 根目錄)
+        backend: str
+            旅行時間原始資料的來源，'csv' 讀 data_paths['hw5_m04a_df']，'sqlite' 或 'parquet' 直接查詢 M04A
+        '''
         self.data_paths = data_paths
+        self.backend = backend
         self.etag_5n_loc = None
         self.section_info = None
         self.hw5_m04a_df = None
@@ -560,6 +818,8 @@ class hw_df_resource():
         # generated info
         self.milelocation_info_df = None
         self.hw5_m04a_agg_df = None
+        self.gantry_topology = None
+        self.calendar_table = None
         
     def load_raw_environment_info(self):
         # enviroment and gantry info
@@ -567,11 +827,58 @@ class hw_df_resource():
         self.section_info = pd.read_csv(self.data_paths['section_info'])
         print('Complete loading environment and gantry info')
 
-    def load_raw_etag_data(self):
-        self.hw5_m04a_df = pd.read_csv(self.data_paths['hw5_m04a_df'])
-        self.hw5_m04a_df['TimeStamp'] = pd.to_datetime(self.hw5_m04a_df['TimeStamp'])
+    def load_raw_etag_data(self, start=None, end=None, gantry_from=None):
+        '''
+        start, end, gantry_from 只在 backend 為 'sqlite' 或 'parquet' 時使用，條件會直接下到資料來源
+        '''
+        if self.backend == 'sqlite':
+            self.hw5_m04a_df = dc.query_tdcs_dataset(self.data_paths['hwdb'], 'M04A', 
+                                                     start=start, end=end, gantry_from=gantry_from)
+        elif self.backend == 'parquet':
+            store = dc.ParquetStoreManager(self.data_paths['store'], 'M04A', schema='M04A')
+            filters = {'GantryFrom': gantry_from} if gantry_from is not None else None
+            self.hw5_m04a_df = store.read_data(columns=dc.TDCS_COLUMNS['M04A'], start=start, end=end, filters=filters)
+        else:
+            self.hw5_m04a_df = dc.concat_chunks(dc.iter_csv_chunks(self.data_paths['hw5_m04a_df'], 'M04A', 
+                                                                   categorical=False))
         print('Complete loading raw etag data')
 
+    def iter_raw_etag_data(self, chunksize=1_000_000, start=None, end=None, gantry_from=None):
+        '''
+        逐段讀取 M04A，每段最多 chunksize 筆，門架代碼為 category、數值為小整數 (見 dc.compact_dtypes)
+        參數同 load_raw_etag_data，csv backend 不支援 start, end, gantry_from
+        '''
+        filters = {'GantryFrom': gantry_from} if gantry_from is not None else None
+        if self.backend == 'sqlite':
+            return dc.iter_tdcs_dataset(self.data_paths['hwdb'], 'M04A', start=start, end=end, 
+                                        filters=filters, chunksize=chunksize)
+        elif self.backend == 'parquet':
+            store = dc.ParquetStoreManager(self.data_paths['store'], 'M04A', schema='M04A')
+            return store.iter_data(chunksize, columns=dc.TDCS_COLUMNS['M04A'], start=start, end=end, filters=filters)
+        else:
+            return dc.iter_csv_chunks(self.data_paths['hw5_m04a_df'], 'M04A', chunksize)
+
+    def generate_traveltime_aggregation(self, chunksize=1_000_000, start=None, end=None, gantry_from=None, 
+                                        resolution=5, by_vehicle_type=False, dispersion=False):
+        '''
+        不載入整份 hw5_m04a_df，逐段計算 traveltime_aggregation 並存到 self.hw5_m04a_agg_df
+        resolution, by_vehicle_type, dispersion 同 traveltime_aggregation
+        '''
+        chunks = self.iter_raw_etag_data(chunksize, start, end, gantry_from)
+        self.hw5_m04a_agg_df = traveltime_aggregation_chunked(tqdm(chunks, desc='traveltime aggregation'), 
+                                                              resolution, by_vehicle_type, dispersion)
+        print('Complete generating traveltime aggregation')
+
+    def load_traveltime_rollup(self, minutes=5, start=None, end=None, pairs=None):
+        '''
+        從 dc.update_traveltime_rollups 維護的彙總表讀取 self.hw5_m04a_agg_df，backend 需為 'sqlite' 或 'parquet'
+        minutes=5 時結果與 traveltime_aggregation 相同；pairs 為 'GantryFrom-GantryTo' 或 (GantryFrom, GantryTo) 的 list
+        '''
+        location = self.data_paths['hwdb'] if self.backend == 'sqlite' else self.data_paths['store']
+        self.hw5_m04a_agg_df = dc.read_traveltime_rollup(location, minutes, start=start, end=end, 
+                                                         pairs=pairs, backend=self.backend)
+        print(f'Complete loading {minutes}-minute traveltime rollup')
+
     def load_raw_event_info(self):
         self.congestion_table = pd.read_csv(self.data_paths['congestion_table'])
         self.calendar_event = pd.read_csv(self.data_paths['calendar_event'])
@@ -619,3 +926,203 @@ class hw_df_resource():
     def generate_mile_location_info(self):
         self.milelocation_info_df = highway_mileage(self.section_info, self.etag_5n_loc, '000050', 'N')
         print('Complete generating mile location info')
+
+    def generate_gantry_topology(self):
+        '''
+        由 hw5_m04a_agg_df 的門架對與 milelocation_info_df 建立 self.gantry_topology (GantryTopology)
+        '''
+        self.gantry_topology = GantryTopology(self.hw5_m04a_agg_df['gf_gt'].unique(), self.milelocation_info_df)
+        print('Complete generating gantry topology')
+
+    def generate_calendar_table(self, start, end, table_path=None):
+        '''
+        建立 (或從 table_path 讀取) start~end 的日曆特徵表存到 self.calendar_table，add_calendar_event 可重複使用
+        '''
+        self.calendar_table = load_or_build_calendar_table(table_path, self.calendar_event, start, end)
+        print('Complete generating calendar table')
+
+
+# 特徵區塊 (modelling_feature_selection 的 element_dict)：名稱 -> 計算方式、版本與需要的 hw_df_resource 資料表
+# compute(df, rs, cache_paths) 回傳加上特徵後的 df，cache_paths 可以給 'congestion_index' (.npz) 與 'calendar_table' (.parquet)
+# 的存檔路徑，重複使用編譯好的 CongestionIndex 與日曆特徵表；resets_index 代表計算過程會把 index 重設為列位置
+# scope 為一個門架對的結果需要的基礎資料：'pair' 只需該門架對的列，'downstream' 另需第 1 層下游門架對的列
+# 改動計算方式時要一併修改 version，FeatureStore 的舊區塊檔案才會失效
+FEATURE_BLOCKS = {
+    '_p': {'version': '1', 'tables': [], 'resets_index': False, 'scope': 'downstream',
+           'compute': lambda df, rs, cache_paths: add_ds_5prev_traveltime(df, topology=getattr(rs, 'gantry_topology', None))},
+    '_c': {'version': '1', 'tables': ['congestion_table', 'milelocation_info_df'], 'resets_index': False, 'scope': 'pair',
+           'compute': lambda df, rs, cache_paths: add_congestion_condition(df, rs.congestion_table, rs.milelocation_info_df,
+                                                                           index_path=cache_paths.get('congestion_index'))},
+    '_h': {'version': '1', 'tables': ['calendar_event'], 'resets_index': False, 'scope': 'pair',
+           'compute': lambda df, rs, cache_paths: add_calendar_event(df, rs.calendar_event,
+                                                                     table_path=cache_paths.get('calendar_table'))},
+    '_t': {'version': '1', 'tables': ['traffic_accident_data', 'milelocation_info_df'], 'resets_index': True, 'scope': 'pair',
+           'compute': lambda df, rs, cache_paths: add_traffic_event(df, rs.traffic_accident_data, rs.milelocation_info_df)[1]},
+    '_r': {'version': '1', 'tables': ['road_build_event', 'milelocation_info_df'], 'resets_index': True, 'scope': 'pair',
+           'compute': lambda df, rs, cache_paths: add_road_build_event(df, rs.road_build_event, rs.milelocation_info_df)[1]},
+}
+
+def prepare_block_caches(names, base_df, resource, cache_paths):
+    '''
+    names 中 '_h' 與 '_c' 使用的日曆特徵表與 CongestionIndex 先以整個 base_df 的期間與門架對建立一次，
+    之後逐門架對計算時直接讀取 cache_paths，不會每個門架對各自擴充重建
+    '''
+    if '_h' in names:
+        load_or_build_calendar_table(cache_paths['calendar_table'], resource.calendar_event, 
+                                     base_df['TimeStamp'].min(), base_df['TimeStamp'].max())
+    if '_c' in names:
+        CongestionIndex.load_or_compile(cache_paths['congestion_index'], resource.congestion_table, 
+                                        resource.milelocation_info_df, base_df['gf_gt'].unique())
+
+def ordered_blocks(combo):
+    '''
+    特徵區塊的套用順序，'_p' 需要其他門架對的資料所以固定最先套用，其餘依 combo 順序
+    '''
+    combo = list(combo)
+    unknown = [name for name in combo if name not in FEATURE_BLOCKS]
+    if unknown:
+        raise ValueError(f'unknown feature blocks: {unknown}')
+    return (['_p'] if '_p' in combo else []) + [name for name in combo if name != '_p']
+
+def combination_name(gantry_pair, combo):
+    '''
+    組合名稱，同 modelling_feature_selection 的命名，'_p' 固定在最前面，例如 '05F0001N-03F0150N_b_p_c_h_t_r'
+    '''
+    return gantry_pair + '_b' + ''.join(ordered_blocks(combo))
+
+def share_frame(df, path):
+    '''
+    將 df (含 index) 寫成 Arrow IPC 檔案，供其他 process 以 memory map 讀取 (open_shared_frame)
+    有 Arrow 無法轉換的欄位 (例如混合型態的 object) 時改存 pickle，回傳實際的檔案路徑
+    '''
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        path = path + '.pkl'
+        df.to_pickle(path)
+        return path
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return path
+
+def open_shared_frame(path):
+    '''
+    以 memory map 開啟 share_frame 的檔案，Arrow 檔案回傳 pa.Table (資料留在 page cache，不複製)，pickle 回傳 DataFrame
+    '''
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+def shared_rows(table, gantry_pair=None):
+    '''
+    open_shared_frame 的結果轉成 DataFrame，gantry_pair 有給時只轉換該門架對的列
+    '''
+    if isinstance(table, pd.DataFrame):
+        return table[table['gf_gt']==gantry_pair].copy() if gantry_pair is not None else table.copy()
+    if gantry_pair is not None:
+        table = table.filter(pc.is_in(table.column('gf_gt'), value_set=pa.array([gantry_pair])))
+    return table.to_pandas()
+
+def _shared_positions(table, gantry_pair):
+    # gantry_pair 的列在整個基礎資料中的位置
+    if isinstance(table, pd.DataFrame):
+        return np.flatnonzero((table['gf_gt']==gantry_pair).to_numpy())
+    return pc.indices_nonzero(pc.is_in(table.column('gf_gt'), value_set=pa.array([gantry_pair]))).to_numpy().astype('int64')
+
+# worker process 的共用資料，由 _init_combination_worker 設定
+_COMBINATION_WORKER = {}
+
+def _init_combination_worker(manifest):
+    rs = hw_df_resource({})
+    for attr, path in manifest['tables'].items():
+        table = open_shared_frame(path)
+        setattr(rs, attr, table if isinstance(table, pd.DataFrame) else table.to_pandas())
+    _COMBINATION_WORKER['resource'] = rs
+    _COMBINATION_WORKER['base'] = {key: open_shared_frame(path) for key, path in manifest['base'].items()}
+    _COMBINATION_WORKER['cache_paths'] = manifest['cache_paths']
+    _COMBINATION_WORKER['output_dir'] = manifest['output_dir']
+
+def _run_combination(task):
+    gantry_pair, combo = task
+    rs = _COMBINATION_WORKER['resource']
+    base = _COMBINATION_WORKER['base']['_p' if '_p' in combo else '_b']
+    df = shared_rows(base, gantry_pair)
+    for name in ordered_blocks(combo):
+        if name != '_p':
+            df = FEATURE_BLOCKS[name]['compute'](df, rs, _COMBINATION_WORKER['cache_paths'])
+    if any(FEATURE_BLOCKS[name]['resets_index'] for name in combo):
+        # add_traffic_event, add_road_build_event 的 merge 會重設 index，notebook 中為整個基礎資料的列位置
+        df.index = _shared_positions(base, gantry_pair)
+    name = combination_name(gantry_pair, combo)
+    output_dir = _COMBINATION_WORKER['output_dir']
+    if output_dir is None:
+        return name, df
+    # parquet 不支援 object 型別，同 notebook 轉成 string
+    object_columns = df.select_dtypes(include='object').columns
+    df[object_columns] = df[object_columns].astype('string')
+    path = os.path.join(output_dir, f'{name}.parquet')
+    df.to_parquet(path)
+    return name, path
+
+def run_combinations_parallel(base_df, resource, combinations, max_workers=None, output_dir=None, 
+                              shared_dir=None, mp_context=None):
+    '''
+    modelling_feature_selection 特徵組合迴圈的平行版本
+
+    基礎資料 (有組合用到 '_p' 時另加上 add_ds_5prev_traveltime 後的版本) 與 resource 資料表先寫成 Arrow IPC 檔案，
+    每個 worker 以 memory map 唯讀開啟，不需要每個 task pickle 一份資料，且只轉換該門架對的列
+    '_p' 需要其他門架對的資料，在啟動 worker 前統一計算一次；CongestionIndex 與日曆特徵表也只建立一次
+    其餘特徵只以該門架對的列計算，節日 onehot 保留該門架對期間內出現的節日 (notebook 為整個基礎資料期間，各門架對期間相同時一致)
+
+    Parameters
+    ----------
+    base_df: pd.DataFrame
+        基礎旅行時間資料 (例如 hw5_15watt)，含 gf_gt, TimeStamp
+    resource: hw_df_resource
+        已讀取環境/事件資料並產生 milelocation_info_df 的 hw_df_resource
+    combinations: dict
+        {gantry_pair: combo}，例如 {'05F0001N-03F0150N': ['_c', '_h', '_t', '_r', '_p']}
+    max_workers: int
+        process 數，預設為 CPU 數
+    output_dir: str
+        有給時每個組合存成 output_dir/{combination_name}.parquet (object 轉 string)，回傳檔案路徑
+    shared_dir: str
+        共用檔案的目錄，預設使用暫存目錄並在結束後刪除
+    mp_context: multiprocessing context
+        傳給 ProcessPoolExecutor，例如 multiprocessing.get_context('spawn')
+
+    Return
+    ------
+    dict
+        {combination_name: DataFrame (或 output_dir 下的 parquet 路徑)}，順序同 combinations
+    '''
+    used = {name for combo in combinations.values() for name in ordered_blocks(combo)}
+    temp_dir = tempfile.TemporaryDirectory() if shared_dir is None else None
+    shared_dir = temp_dir.name if temp_dir is not None else shared_dir
+    os.makedirs(shared_dir, exist_ok=True)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    try:
+        cache_paths = {'congestion_index': os.path.join(shared_dir, 'congestion_index.npz'),
+                       'calendar_table': os.path.join(shared_dir, 'calendar_table.parquet')}
+        manifest = {'base': {'_b': share_frame(base_df, os.path.join(shared_dir, 'base.arrow'))}, 
+                    'tables': {}, 'cache_paths': cache_paths, 'output_dir': output_dir}
+        if '_p' in used:
+            manifest['base']['_p'] = share_frame(FEATURE_BLOCKS['_p']['compute'](base_df, resource, cache_paths), 
+                                                 os.path.join(shared_dir, 'base_p.arrow'))
+            print('Complete computing _p features')
+        prepare_block_caches(used, base_df, resource, cache_paths)
+        tables = {attr: getattr(resource, attr) for name in used if name != '_p' for attr in FEATURE_BLOCKS[name]['tables']}
+        for attr, df in tables.items():
+            manifest['tables'][attr] = share_frame(df, os.path.join(shared_dir, f'{attr}.arrow'))
+        print('Complete sharing base frame and resource tables')
+
+        results = dict()
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, 
+                                 initializer=_init_combination_worker, initargs=(manifest,)) as executor:
+            for name, result in tqdm(executor.map(_run_combination, combinations.items()), total=len(combinations)):
+                results[name] = result
+        return results
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
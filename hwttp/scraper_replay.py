@@ -0,0 +1,468 @@
+#      offline replay server & benchmark for data_scraper
+import gzip
+import io
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+import pandas as pd
+
+from . import data_scraper as ds
+
+XML_NS = 'http://traffic.transportdata.tw/standard/traffic/schema/'
+# 已提交的 throughput baseline，以 python -m hwttp.scraper_replay --update 重新產生
+DEFAULT_BASELINE_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks', 'scraper_baseline.json'))
+VEHICLE_TYPES = [31, 32, 41, 42, 5]
+
+
+def _xml_document(list_tag: str, header: str, body: str) -> bytes:
+    return (f'<?xml version="1.0" encoding="UTF-8"?><{list_tag} xmlns="{XML_NS}">'
+            f'{header}{body}</{list_tag}>').encode('utf-8')
+
+def _xml_header(update_time: str, interval: int, link_version: bool=True) -> str:
+    header = (f'<UpdateTime>{update_time}</UpdateTime><UpdateInterval>{interval}</UpdateInterval>'
+              f'<AuthorityCode>NFB</AuthorityCode>')
+    if link_version:
+        header += '<LinkVersion>24.01.1</LinkVersion>'
+    return header
+
+def synthetic_vd_static(date: str, n_vd: int) -> bytes:
+    '''
+    產生 VD_0000.xml 格式的假資料，欄位結構與 vd_static_dict_to_df 相容
+    '''
+    ts = f'{date[:4]}-{date[4:6]}-{date[6:]}T00:00:00+08:00'
+    vds = ''.join(f'<VD><VDID>VD-N5-N-{i:04d}</VDID><SubAuthorityCode>NFB-NR</SubAuthorityCode>'
+                  f'<BiDirectional>0</BiDirectional><DetectionLinks><DetectionLink><LinkID>0000500{i:05d}</LinkID>'
+                  f'<Bearing>N</Bearing><RoadDirection>N</RoadDirection><LaneNum>2</LaneNum>'
+                  f'<ActualLaneNum>2</ActualLaneNum></DetectionLink></DetectionLinks><VDType>2</VDType>'
+                  f'<LocationType>1</LocationType><DetectionType>1</DetectionType>'
+                  f'<PositionLon>121.6</PositionLon><PositionLat>24.8</PositionLat><RoadID>000050</RoadID>'
+                  f'<RoadName>國道5號</RoadName><RoadClass>0</RoadClass><RoadSection><Start>頭城</Start>'
+                  f'<End>坪林</End></RoadSection><LocationMile>{i}K+000</LocationMile></VD>'
+                  for i in range(n_vd))
+    return _xml_document('VDList', _xml_header(ts, 86400), f'<VDs>{vds}</VDs>')
+
+def synthetic_vd_live(date: str, hhmm: str, n_vd: int, rng: random.Random) -> bytes:
+    '''
+    產生 VDLive_HHmm.xml 格式的假資料，每個 VD 2 車道 x 3 車種
+    '''
+    ts = f'{date[:4]}-{date[4:6]}-{date[6:]}T{hhmm[:2]}:{hhmm[2:]}:00+08:00'
+    lives = []
+    for i in range(n_vd):
+        lanes = ''
+        for lane in range(2):
+            vehicles = ''.join(f'<Vehicle><VehicleType>{vt}</VehicleType><Volume>{rng.randint(0, 30)}</Volume>'
+                               f'<Speed>{rng.randint(40, 110)}</Speed></Vehicle>' for vt in ('S', 'L', 'T'))
+            lanes += (f'<Lane><LaneID>{lane}</LaneID><LaneType>1</LaneType><Speed>{rng.randint(40, 110)}</Speed>'
+                      f'<Occupancy>{rng.randint(0, 40)}</Occupancy><Vehicles>{vehicles}</Vehicles></Lane>')
+        lives.append(f'<VDLive><VDID>VD-N5-N-{i:04d}</VDID><LinkFlows><LinkFlow><LinkID>0000500{i:05d}</LinkID>'
+                     f'<Lanes>{lanes}</Lanes></LinkFlow></LinkFlows><Status>0</Status>'
+                     f'<DataCollectTime>{ts}</DataCollectTime></VDLive>')
+    return _xml_document('VDLiveList', _xml_header(ts, 60), f'<VDLives>{"".join(lives)}</VDLives>')
+
+def synthetic_etag_static(date: str, n_gantry: int) -> bytes:
+    '''
+    產生 ETag_0000.xml 格式的假資料
+    '''
+    ts = f'{date[:4]}-{date[4:6]}-{date[6:]}T00:00:00+08:00'
+    etags = ''.join(f'<ETag><ETagGantryID>05F{i:04d}N</ETagGantryID><LinkID>0000500{i:05d}</LinkID>'
+                    f'<LocationType>4</LocationType><PositionLon>121.6</PositionLon><PositionLat>24.8</PositionLat>'
+                    f'<RoadID>000050</RoadID><RoadName>國道5號</RoadName><RoadClass>0</RoadClass>'
+                    f'<RoadDirection>N</RoadDirection><RoadSection><Start>頭城</Start><End>坪林</End></RoadSection>'
+                    f'<LocationMile>{i}K+000</LocationMile></ETag>' for i in range(n_gantry))
+    return _xml_document('ETagList', _xml_header(ts, 86400), f'<ETags>{etags}</ETags>')
+
+def synthetic_etag_pair(date: str, n_gantry: int) -> bytes:
+    '''
+    產生 ETagPair_0000.xml 格式的假資料
+    '''
+    ts = f'{date[:4]}-{date[4:6]}-{date[6:]}T00:00:00+08:00'
+    pairs = ''.join(f'<ETagPair><ETagPairID>05F{i+1:04d}N-05F{i:04d}N</ETagPairID>'
+                    f'<StartETagGantryID>05F{i+1:04d}N</StartETagGantryID><EndETagGantryID>05F{i:04d}N</EndETagGantryID>'
+                    f'<Description>pair {i}</Description><Distance>1.000</Distance>'
+                    f'<StartLinkID>0000500{i+1:05d}</StartLinkID><EndLinkID>0000500{i:05d}</EndLinkID>'
+                    f'<Geometry>LINESTRING(121.6 24.8,121.6 24.9)</Geometry></ETagPair>'
+                    for i in range(n_gantry - 1))
+    return _xml_document('ETagPairList', _xml_header(ts, 86400), f'<ETagPairs>{pairs}</ETagPairs>')
+
+def synthetic_etag_pair_live(date: str, hhmm: str, n_gantry: int, rng: random.Random) -> bytes:
+    '''
+    產生 ETagPairLive_HHmm.xml 格式的假資料
+    '''
+    ts = f'{date[:4]}-{date[4:6]}-{date[6:]}T{hhmm[:2]}:{hhmm[2:]}:00+08:00'
+    lives = []
+    for i in range(n_gantry - 1):
+        flows = ''.join(f'<Flow><VehicleType>{vt}</VehicleType><TravelTime>{rng.randint(30, 300)}</TravelTime>'
+                        f'<StandardDeviation>0</StandardDeviation><SpaceMeanSpeed>{rng.randint(40, 110)}</SpaceMeanSpeed>'
+                        f'<VehicleCount>{rng.randint(0, 50)}</VehicleCount></Flow>' for vt in VEHICLE_TYPES)
+        lives.append(f'<ETagPairLive><ETagPairID>05F{i+1:04d}N-05F{i:04d}N</ETagPairID>'
+                     f'<StartETagStatus>0</StartETagStatus><EndETagStatus>0</EndETagStatus><Flows>{flows}</Flows>'
+                     f'<StartTime>{ts}</StartTime><EndTime>{ts}</EndTime><DataCollectTime>{ts}</DataCollectTime>'
+                     f'</ETagPairLive>')
+    return _xml_document('ETagPairLiveList', _xml_header(ts, 300, link_version=False),
+                         f'<ETagPairLives>{"".join(lives)}</ETagPairLives>')
+
+def synthetic_tdcs_tar(dataset: str, date: str, n_gantry: int, rng: random.Random) -> bytes:
+    '''
+    產生 M03A/M04A/M05A_YYYYMMDD.tar.gz 格式的假資料，內含 M0xA/YYYYMMDD/HH/TDCS_M0xA_YYYYMMDD_HHmm00.csv
+    每天 288 個 5 分鐘 csv，無 header，欄位順序與 notebook 中 ingestion 使用的相同
+    '''
+    buffer = io.BytesIO()
+    day = f'{date[:4]}/{date[4:6]}/{date[6:]}' if dataset != 'M03A' else f'{date[:4]}-{date[4:6]}-{date[6:]}'
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for slot in range(288):
+            hh, mm = divmod(slot * 5, 60)
+            lines = []
+            for i in range(n_gantry - 1):
+                for vt in VEHICLE_TYPES:
+                    if dataset == 'M03A':
+                        lines.append(f'{day} {hh:02d}:{mm:02d},05F{i:04d}N,N,{vt},{rng.randint(0, 200)}')
+                    elif dataset == 'M04A':
+                        lines.append(f'{day} {hh:02d}:{mm:02d},05F{i+1:04d}N,05F{i:04d}N,{vt},'
+                                     f'{rng.randint(30, 300)},{rng.randint(0, 200)}')
+                    else:
+                        lines.append(f'{day} {hh:02d}:{mm:02d},05F{i+1:04d}N,05F{i:04d}N,{vt},'
+                                     f'{rng.randint(40, 110)},{rng.randint(0, 200)}')
+            content = ('\n'.join(lines) + '\n').encode()
+            info = tarfile.TarInfo(f'{dataset}/{date}/{hh:02d}/TDCS_{dataset}_{date}_{hh:02d}{mm:02d}00.csv')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+def build_synthetic_tree(root_dir: str,
+                         date_list: list[str],
+                         vd_live_per_day: int=60,
+                         etag_live_per_day: int=24,
+                         n_vd: int=200,
+                         n_gantry: int=40,
+                         seed: int=0) -> str:
+    '''
+    在 root_dir 下建立與 tisvcloud 相同結構的假資料目錄樹，供 ReplayServer 使用
+    history/motc20/VD/<date>/, history/motc20/ETag/<date>/, history/TDCS/M03A|M04A|M05A/
+
+    Parameters
+    ----------
+    root_dir: str
+        目錄樹的根目錄
+    date_list: list[str]
+        要產生的日期，像是['20230101', '20230102']
+    vd_live_per_day: int
+        每天產生的 VDLive_HHmm 檔案數 (真實資料為每分鐘一個，1440)
+    etag_live_per_day: int
+        每天產生的 ETagPairLive_HHmm 檔案數 (真實資料為每 5 分鐘一個，288)
+    n_vd: int
+        每個 VD 檔案中的 VD 數量，影響檔案大小
+    n_gantry: int
+        ETag 門架數量，影響 ETag 與 M0xA 檔案大小
+    seed: int
+        亂數種子
+
+    Return
+    ------
+    str: root_dir
+    '''
+    rng = random.Random(seed)
+    for date in date_list:
+        vd_dir = os.path.join(root_dir, 'history', 'motc20', 'VD', date)
+        etag_dir = os.path.join(root_dir, 'history', 'motc20', 'ETag', date)
+        os.makedirs(vd_dir, exist_ok=True)
+        os.makedirs(etag_dir, exist_ok=True)
+
+        files = {os.path.join(vd_dir, 'VD_0000.xml.gz'): synthetic_vd_static(date, n_vd),
+                 os.path.join(etag_dir, 'ETag_0000.xml.gz'): synthetic_etag_static(date, n_gantry),
+                 os.path.join(etag_dir, 'ETagPair_0000.xml.gz'): synthetic_etag_pair(date, n_gantry)}
+        for minute in range(vd_live_per_day):
+            hhmm = f'{minute // 60:02d}{minute % 60:02d}'
+            files[os.path.join(vd_dir, f'VDLive_{hhmm}.xml.gz')] = synthetic_vd_live(date, hhmm, n_vd, rng)
+        for slot in range(etag_live_per_day):
+            hhmm = f'{slot * 5 // 60:02d}{slot * 5 % 60:02d}'
+            files[os.path.join(etag_dir, f'ETagPairLive_{hhmm}.xml.gz')] = synthetic_etag_pair_live(date, hhmm, n_gantry, rng)
+        for path, content in files.items():
+            with open(path, 'wb') as f:
+                f.write(gzip.compress(content, compresslevel=6))
+
+        for dataset in ['M03A', 'M04A', 'M05A']:
+            tdcs_dir = os.path.join(root_dir, 'history', 'TDCS', dataset)
+            os.makedirs(tdcs_dir, exist_ok=True)
+            with open(os.path.join(tdcs_dir, f'{dataset}_{date}.tar.gz'), 'wb') as f:
+                f.write(synthetic_tdcs_tar(dataset, date, n_gantry, rng))
+    return root_dir
+
+
+class ReplayServer:
+    '''
+    本機的 tisvcloud 替身，提供 root_dir 底下的檔案與自動產生的目錄 index 頁面，支援 HTTP Range
+    可注入延遲、錯誤回應與截斷的回應內容，用來離線量測與測試 data_scraper
+
+    Parameters
+    ----------
+    root_dir: str
+        目錄樹的根目錄，通常由 build_synthetic_tree 建立，或是實際下載的資料鏡像
+    latency: float
+        每個請求額外延遲的秒數
+    error_rate: float
+        檔案請求回傳 error_status 的機率
+    error_status: int
+        注入錯誤時回傳的狀態碼
+    truncate_rate: float
+        檔案請求只送出一半內容就斷線的機率
+    seed: int
+        錯誤注入的亂數種子
+
+    Usage
+    -----
+    with ReplayServer('/tmp/tisv', latency=0.05, error_rate=0.02) as server:
+        ds.scrape_vd_data(date_list, save_dir_upper='/tmp/out/VD/', host_url=server.url)
+    '''
+    def __init__(self,
+                 root_dir: str,
+                 latency: float=0.0,
+                 error_rate: float=0.0,
+                 error_status: int=503,
+                 truncate_rate: float=0.0,
+                 seed: int=0) -> None:
+        self.root_dir = os.path.abspath(root_dir)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.truncate_rate = truncate_rate
+        self.request_count = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def _draw(self) -> float:
+        with self._lock:
+            self.request_count += 1
+            return self._rng.random()
+
+    def start(self):
+        replay = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def _send(self, status: int, body: bytes, headers: dict=None) -> None:
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if replay.latency > 0:
+                    time.sleep(replay.latency)
+                path = os.path.normpath(os.path.join(replay.root_dir, unquote(self.path.split('?')[0]).lstrip('/')))
+                if not path.startswith(replay.root_dir) or not os.path.exists(path):
+                    self._send(404, b'not found')
+                    return
+                if os.path.isdir(path):
+                    links = ''.join(f'<a href="{name}">{name}</a><br>\n' for name in sorted(os.listdir(path)))
+                    self._send(200, f'<html><body>{links}</body></html>'.encode(), {'Content-Type': 'text/html'})
+                    return
+
+                draw = replay._draw()
+                if draw < replay.error_rate:
+                    self._send(replay.error_status, b'injected error')
+                    return
+                with open(path, 'rb') as f:
+                    data = f.read()
+                total = len(data)
+                status, headers = 200, {'Accept-Ranges': 'bytes'}
+                match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+                if match:
+                    start = int(match.group(1))
+                    if start >= total:
+                        self._send(416, b'', {'Content-Range': f'bytes */{total}'})
+                        return
+                    data = data[start:]
+                    status = 206
+                    headers['Content-Range'] = f'bytes {start}-{total - 1}/{total}'
+
+                if draw < replay.error_rate + replay.truncate_rate:
+                    # 宣告完整長度但只送出一半後斷線
+                    self.send_response(status)
+                    for key, value in headers.items():
+                        self.send_header(key, value)
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data[:len(data) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self._send(status, data, headers)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def benchmark_scrapers(date_list: list[str],
+                       root_dir: str=None,
+                       work_dir: str=None,
+                       engine_kwargs: dict=None,
+                       server_kwargs: dict=None,
+                       tree_kwargs: dict=None) -> pd.DataFrame:
+    '''
+    對 ReplayServer 依序執行所有 scrape_* 函數，量測 files/s 與 bytes/s
+
+    Parameters
+    ----------
+    date_list: list[str]
+        要爬取的日期
+    root_dir: str
+        ReplayServer 的目錄樹，不指定時會在暫存資料夾用 build_synthetic_tree 建立
+    work_dir: str
+        下載結果與 manifest 的存放位置，不指定時使用暫存資料夾，結束後刪除
+    engine_kwargs: dict
+        DownloadEngine 的參數，預設不限速 (rate=1000)
+    server_kwargs: dict
+        ReplayServer 的參數，例如 latency, error_rate, truncate_rate
+    tree_kwargs: dict
+        build_synthetic_tree 的參數
+
+    Return
+    ------
+    pd.DataFrame: 每個 scraper 一列，包含 files, bytes, retries, failed, elapsed_sec, files_per_sec, bytes_per_sec
+    '''
+    engine_kwargs = {'rate': 1000.0, 'burst': 1000, **(engine_kwargs or {})}
+    temp_dirs = []
+    if root_dir is None:
+        root_dir = tempfile.mkdtemp(prefix='tisv_replay_')
+        temp_dirs.append(root_dir)
+        build_synthetic_tree(root_dir, date_list, **(tree_kwargs or {}))
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='tisv_bench_')
+        temp_dirs.append(work_dir)
+
+    scrapers = {'scrape_vd_data': lambda **kw: ds.scrape_vd_data(date_list, save_dir_upper=f'{work_dir}/VD/', **kw),
+                'scrape_etag_info': lambda **kw: ds.scrape_etag_info(date_list, save_dir_upper=f'{work_dir}/ETag/', **kw),
+                'scrape_etag_gantry_volume': lambda **kw: ds.scrape_etag_gantry_volume(date_list, f'{work_dir}/M03A', **kw),
+                'scrape_etag_intergantry_traveltime': lambda **kw: ds.scrape_etag_intergantry_traveltime(date_list, f'{work_dir}/M04A', **kw),
+                'scrape_etag_intergantry_speed': lambda **kw: ds.scrape_etag_intergantry_speed(date_list, f'{work_dir}/M05A', **kw)}
+    results = []
+    try:
+        with ReplayServer(root_dir, **(server_kwargs or {})) as server:
+            for name, scraper in scrapers.items():
+                with ds.DownloadEngine(**engine_kwargs) as engine, \
+                     ds.DownloadManifest(os.path.join(work_dir, f'{name}_manifest.db')) as manifest:
+                    start = time.perf_counter()
+                    stats = scraper(engine=engine, manifest=manifest, host_url=server.url)
+                    elapsed = max(time.perf_counter() - start, 1e-9)
+                results.append({'scraper': name,
+                                'files': stats['files'],
+                                'bytes': stats['bytes'],
+                                'retries': stats['retries'],
+                                'failed': stats['failed'],
+                                'elapsed_sec': round(elapsed, 3),
+                                'files_per_sec': round(stats['files'] / elapsed, 3),
+                                'bytes_per_sec': round(stats['bytes'] / elapsed, 1)})
+    finally:
+        for temp_dir in temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    return pd.DataFrame(results)
+
+def check_regression(results: pd.DataFrame,
+                     baseline_path: str,
+                     tolerance: float=0.2,
+                     update: bool=False) -> list[str]:
+    '''
+    比對 benchmark_scrapers 的結果與 baseline，files_per_sec 或 bytes_per_sec 低於 baseline * (1 - tolerance) 視為效能退化
+    只有 update=True 時才會把本次結果寫成新的 baseline，baseline 不存在時拋出 FileNotFoundError
+
+    Return
+    ------
+    list[str]: 退化的項目描述，空 list 代表沒有退化 (update=True 時固定為空)
+    '''
+    current = results.set_index('scraper')[['files_per_sec', 'bytes_per_sec']].to_dict('index')
+    if update:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=4)
+        return []
+    if not os.path.exists(baseline_path):
+        raise FileNotFoundError(f'{baseline_path} does not exist, create it with update=True')
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, metrics in baseline.items():
+        if name not in current:
+            continue
+        for metric, base_value in metrics.items():
+            value = current[name][metric]
+            if value < base_value * (1 - tolerance):
+                regressions.append(f'{name} {metric}: {value} < baseline {base_value}')
+    return regressions
+
+def main(argv: list[str]=None) -> int:
+    '''
+    命令列入口，對合成資料執行 benchmark_scrapers 並與 baseline 比較，有下載失敗或效能退化時回傳 1
+
+    Usage
+    -----
+    python -m hwttp.scraper_replay --dates 20240101 20240102 --error-rate 0.05 --truncate-rate 0.05
+    python -m hwttp.scraper_replay --update    # 重新產生 baseline
+    '''
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the data_scraper scrapers')
+    parser.add_argument('--dates', nargs='+', default=['20240101'], help='dates to scrape, e.g. 20240101 20240102')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='baseline json path')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput drop ratio')
+    parser.add_argument('--latency', type=float, default=0.0, help='injected latency per request (sec)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of an injected 503')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='probability of a truncated response')
+    parser.add_argument('--update', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    results = benchmark_scrapers(args.dates,
+                                 engine_kwargs={'max_retries': 8},
+                                 server_kwargs={'latency': args.latency, 
+                                                'error_rate': args.error_rate, 
+                                                'truncate_rate': args.truncate_rate})
+    print(results.to_string(index=False))
+    regressions = check_regression(results, args.baseline, args.tolerance, update=args.update)
+    if args.update:
+        print(f'baseline saved to {args.baseline}')
+    for item in regressions:
+        print(f'throughput regression: {item}')
+    failed = int(results['failed'].sum())
+    if failed:
+        print(f'{failed} files failed to download')
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from hwttp import hwtoolkit as hw
+
+CALENDAR_EVENT = pd.DataFrame({'event_name': ['農曆新年', '西洋情人節'], 'start_date': ['2023-01-20', '2023-02-14'],
+                               'end_date': ['2023-01-29', '2023-02-14'], 'continuous': ['T', 'F'],
+                               'event_length': [10, 1]})
+
+
+def test_cached_calendar_table_equals_built_table(tmp_path):
+    path = str(tmp_path / 'calendar_table.parquet')
+    start, end = pd.Timestamp('2023-01-10'), pd.Timestamp('2023-02-20')
+    built = hw.load_or_build_calendar_table(path, CALENDAR_EVENT, start, end)
+    pd.testing.assert_frame_equal(built, hw.build_calendar_table(CALENDAR_EVENT, start, end))
+    assert built['holiday_name'].isna().any()
+
+    cached = hw.load_or_build_calendar_table(path, CALENDAR_EVENT, start, end)
+    pd.testing.assert_frame_equal(cached, built, check_exact=True)
+    assert cached.loc[cached['holiday_name'].isna(), 'holiday_name'].map(type).eq(float).all()
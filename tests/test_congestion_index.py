@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hwttp import hwtoolkit as hw
+
+GANTRIES = [f'05F{i:04d}N' for i in range(0, 550, 50)]
+INTERCHANGES = ['南港系統交流道', '坪林交控交流道', '頭城交流道', '宜蘭交流道', '羅東交流道']
+SHORT_NAMES = ['南港系統', '坪林', '頭城', '宜蘭', '羅東']
+WEEKDAY_DICT = {0: 'weekday', 1: 'weekday', 2: 'weekday', 3: 'weekday', 4: 'weekday', 5: 'Saturday', 6: 'Sunday'}
+
+
+@pytest.fixture(scope='module')
+def mileage():
+    return pd.DataFrame({'LocationName': GANTRIES + INTERCHANGES,
+                         'LocationMile': [i * 1000.0 for i in range(0, 550, 50)] + [54000, 40000, 28000, 15000, 0]})
+
+
+@pytest.fixture(scope='module')
+def target_df():
+    rng = np.random.default_rng(1)
+    pairs = [f'{GANTRIES[i + 1]}-{GANTRIES[i]}' for i in range(len(GANTRIES) - 1)]
+    timestamps = pd.date_range('2022-12-20', periods=96 * 50, freq='15min')
+    df = pd.DataFrame([(ts, pair) for pair in pairs for ts in timestamps], columns=['TimeStamp', 'gf_gt'])
+    df[['GantryFrom', 'GantryTo']] = df['gf_gt'].str.split('-', expand=True)
+    df['WeightedAvgTravelTime'] = rng.uniform(50, 300, len(df))
+    return df
+
+
+@pytest.fixture(scope='module')
+def congestion_table():
+    rng = np.random.default_rng(2)
+    n = 40
+    start = rng.integers(0, 24, n) * 100 + rng.choice([0, 15, 30, 45], n)
+    # 北向的 LinkStart 在上游 (里程較大)
+    return pd.DataFrame({'direction': rng.choice(['N', 'S'], n, p=[0.8, 0.2]),
+                         'LinkStart': rng.choice(SHORT_NAMES[2:], n), 'LinkEnd': rng.choice(SHORT_NAMES[:2], n),
+                         'StartYearMonth': rng.choice([202212, 202301], n),
+                         'EndYearMonth': rng.choice([202301, 202302], n),
+                         'dayofweek': rng.choice(['weekday', 'Saturday', 'Sunday'], n),
+                         'CongestStart': start, 'CongestEnd': np.minimum(start + rng.integers(100, 400, n), 2359)})
+
+
+def per_rule_reference(target_df, congestion_table, mileage):
+    # 原本的寫法：每條規則對整個 df 做一次八個條件的 mask
+    miles = mileage.set_index('LocationName')['LocationMile']
+    gf_mile = target_df['GantryFrom'].map(miles)
+    gt_mile = target_df['GantryTo'].map(miles)
+    year_month = target_df['TimeStamp'].dt.strftime('%Y%m').astype('int')
+    hour_minute = target_df['TimeStamp'].dt.hour * 100 + target_df['TimeStamp'].dt.minute
+    dayofweek = target_df['TimeStamp'].dt.weekday.map(WEEKDAY_DICT)
+    congested = pd.Series(False, index=target_df.index)
+    for _, row in congestion_table[congestion_table['direction'] == 'N'].iterrows():
+        link_start = miles[hw.CongestionIndex.TRANSFORM_DICT[row['LinkStart']]]
+        link_end = miles[hw.CongestionIndex.TRANSFORM_DICT[row['LinkEnd']]]
+        congested |= ((gf_mile >= link_end) & (link_start >= gt_mile)
+                      & (year_month >= row['StartYearMonth']) & (year_month <= row['EndYearMonth'])
+                      & (dayofweek == row['dayofweek'])
+                      & (hour_minute >= row['CongestStart']) & (hour_minute <= row['CongestEnd']))
+    return target_df.assign(congestion_syndrome=congested.astype('int64'))
+
+
+def test_add_congestion_condition_matches_per_rule_masks(target_df, congestion_table, mileage):
+    expected = per_rule_reference(target_df, congestion_table, mileage)
+    assert 0 < expected['congestion_syndrome'].sum() < len(expected)
+    pd.testing.assert_frame_equal(hw.add_congestion_condition(target_df, congestion_table, mileage), expected)
+
+    # 只有 GantryFrom/GantryTo 時結果相同
+    no_pair = target_df.drop(columns='gf_gt')
+    pd.testing.assert_frame_equal(hw.add_congestion_condition(no_pair, congestion_table, mileage),
+                                  expected.drop(columns='gf_gt'))
+
+
+def test_index_path_reuses_and_recompiles(target_df, congestion_table, mileage, tmp_path, monkeypatch):
+    index_path = str(tmp_path / 'congestion_index.npz')
+    first_pairs = target_df[target_df['gf_gt'].isin(target_df['gf_gt'].unique()[:4])]
+    hw.add_congestion_condition(first_pairs, congestion_table, mileage, index_path=index_path)
+    assert len(hw.CongestionIndex.load(index_path).pairs) == 4
+
+    compiled = []
+    compile_index = hw.CongestionIndex.compile.__func__
+    monkeypatch.setattr(hw.CongestionIndex, 'compile',
+                        classmethod(lambda cls, *args, **kwargs: compiled.append(args) or compile_index(cls, *args, **kwargs)))
+
+    # 新的門架對：取聯集重新編譯
+    result = hw.add_congestion_condition(target_df, congestion_table, mileage, index_path=index_path)
+    pd.testing.assert_frame_equal(result, per_rule_reference(target_df, congestion_table, mileage))
+    assert len(compiled) == 1
+    assert set(hw.CongestionIndex.load(index_path).pairs) == set(target_df['gf_gt'])
+
+    # 來源沒變：直接讀存檔
+    pd.testing.assert_frame_equal(hw.add_congestion_condition(first_pairs, congestion_table, mileage,
+                                                              index_path=index_path),
+                                  per_rule_reference(first_pairs, congestion_table, mileage))
+    assert len(compiled) == 1
+
+    # congestion table 變動：重新編譯
+    changed = congestion_table.copy()
+    changed.loc[changed['direction'] == 'N', 'CongestEnd'] = 2359
+    result = hw.add_congestion_condition(target_df, changed, mileage, index_path=index_path)
+    pd.testing.assert_frame_equal(result, per_rule_reference(target_df, changed, mileage))
+    assert len(compiled) == 2
@@ -0,0 +1,62 @@
+import sqlite3
+import threading
+
+import pandas as pd
+
+from hwttp import data_cleaning as dc
+
+
+def m04a_frame(n=12):
+    return pd.DataFrame({'TimeStamp': pd.date_range('2024-01-01', periods=n, freq='5min'),
+                         'GantryFrom': '01F0005S', 'GantryTo': '01F0017S', 'VehicleType': 31,
+                         'TravelTime': range(n), 'Traffic': 1})
+
+
+def journal_mode(db_path):
+    con = sqlite3.connect(db_path)
+    try:
+        return con.execute('PRAGMA journal_mode').fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_readers_do_not_change_database_settings(tmp_path):
+    db_path = str(tmp_path / 'hw.db')
+    with dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A') as tb:
+        tb.append_data(m04a_frame())
+    with dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A') as tb:
+        assert len(tb.read_data()) == 12
+        assert tb.connection.execute('PRAGMA mmap_size').fetchone()[0] == 0
+        assert tb.connection.execute('PRAGMA cache_size').fetchone()[0] == dc.DEFAULT_PRAGMAS['cache_size']
+    assert journal_mode(db_path) == 'delete'
+
+
+def test_wal_is_opt_in_and_applied_on_write(tmp_path):
+    db_path = str(tmp_path / 'hw.db')
+    tb = dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A', wal=True)
+    tb.table_exists()
+    assert journal_mode(db_path) == 'delete'
+    with tb, tb.bulk_load() as session:
+        session.add(m04a_frame())
+        assert tb.connection.execute('PRAGMA cache_size').fetchone()[0] == dc.WRITE_PRAGMAS['cache_size']
+    assert journal_mode(db_path) == 'wal'
+    with dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A') as reader:
+        assert len(reader.read_data()) == 12
+
+
+def test_connection_opens_in_the_thread_that_uses_it(tmp_path):
+    db_path = str(tmp_path / 'hw.db')
+    with dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A') as tb:
+        tb.append_data(m04a_frame())
+    results = []
+
+    def read():
+        with dc.DatabaseManager(db_path, 'ETAG_M04A_202401', schema='M04A') as reader:
+            results.append(len(reader.read_data()))
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [12] * 4
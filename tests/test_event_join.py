@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from hwttp import hwtoolkit as hw
+
+GANTRIES = [f'05F{i:04d}N' for i in range(0, 300, 30)]
+
+
+@pytest.fixture(scope='module')
+def mileage():
+    return pd.DataFrame({'LocationName': GANTRIES, 'LocationMile': [i * 1000.0 for i in range(0, 300, 30)]})
+
+
+@pytest.fixture(scope='module')
+def target_df():
+    rng = np.random.default_rng(1)
+    pairs = [f'{GANTRIES[i + 1]}-{GANTRIES[i]}' for i in range(len(GANTRIES) - 1)]
+    timestamps = pd.date_range('2023-01-01', periods=96 * 3, freq='15min')
+    df = pd.DataFrame([(ts, pair) for pair in pairs for ts in timestamps], columns=['TimeStamp', 'gf_gt'])
+    df[['GantryFrom', 'GantryTo']] = df['gf_gt'].str.split('-', expand=True)
+    df['WeightedAvgTravelTime'] = rng.uniform(50, 300, len(df))
+    return df
+
+
+def event_starts(rng, n):
+    timestamps = pd.date_range('2023-01-01', periods=96 * 3, freq='15min')
+    starts = pd.Series(rng.choice(timestamps, n)) + pd.to_timedelta(rng.integers(0, 15, n), unit='m')
+    # 依開始時間排序，逐筆覆寫的參考結果即為 policy='latest'
+    return starts.sort_values(ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def road_build(target_df):
+    rng = np.random.default_rng(2)
+    n = 80
+    starts = event_starts(rng, n)
+    low = rng.uniform(0, 280000, n)
+    return pd.DataFrame({'incStepFreewayId': 10050, 'incStepDirection': rng.choice([1, 2], n, p=[0.1, 0.9]),
+                         'incStepIncidentId': np.arange(n), 'incStepTime': starts,
+                         'incStepEndTime': starts + pd.to_timedelta(rng.integers(30, 600, n), unit='m'),
+                         'incStepStartMileage': low + rng.uniform(0, 5000, n), 'incStepEndMileage': low,
+                         'incStepBlockagePattern': [''.join(rng.choice(['0', '1'], 16)) for _ in range(n)]})
+
+
+@pytest.fixture(scope='module')
+def traffic_accidents():
+    rng = np.random.default_rng(3)
+    n = 60
+    starts = event_starts(rng, n)
+    df = pd.DataFrame({'國道名稱': '國道5號', '方向': rng.choice(['北', '南'], n, p=[0.9, 0.1]),
+                       '年': starts.dt.year, '月': starts.dt.month, '日': starts.dt.day,
+                       '時': starts.dt.hour, '分': starts.dt.minute, '里程': rng.uniform(0, 280, n),
+                       '事件發生': 'x', '交控中心接獲通報': 'y', '事件排除': 'z', '處理分鐘': rng.integers(10, 200, n),
+                       '事故類型': rng.choice(['A1', 'A2', 'A3'], n), '死亡': rng.integers(0, 2, n),
+                       '受傷': rng.integers(0, 3, n), '簡訊內容': 'msg'})
+    for col in ['內路肩', '內車道', '中內車道', '中車道', '中外車道', '外車道', '外路肩', '匝道', '翻覆事故註記',
+                '施工事故註記', '危險物品車輛註記', '車輛起火註記', '冒煙車事故註記', '主線中斷註記', '肇事車輛']:
+        df[col] = rng.integers(0, 2, n)
+    for i in range(1, 13):
+        df[f'車輛{i}'] = pd.Series(rng.choice(['小客車', '大貨車', None], n), dtype='string')
+    return df
+
+
+def with_miles(df, mileage):
+    miles = mileage.set_index('LocationName')['LocationMile']
+    return df.assign(gf_mile=df['GantryFrom'].map(miles), gt_mile=df['GantryTo'].map(miles))
+
+
+def naive_masks(df, events, time_bounds, mile_bounds):
+    # 原本的寫法：每個事件對整個 df 做一次 boolean mask
+    for _, event in events.iterrows():
+        yield event, ((df['TimeStamp'] >= event[time_bounds[0]]) & (df['TimeStamp'] <= event[time_bounds[1]])
+                      & (df['gf_mile'] >= event[mile_bounds[0]]) & (event[mile_bounds[1]] >= df['gt_mile']))
+
+
+@pytest.mark.parametrize('policy', ['latest', 'first', 'max', 'sum'])
+def test_interval_join_matches_per_event_masks(target_df, road_build, mileage, policy):
+    df = with_miles(target_df, mileage)
+    events = road_build.assign(value=np.arange(len(road_build)) % 7 + 1)
+    bounds = (('incStepTime', 'incStepEndTime'), ('incStepEndMileage', 'incStepStartMileage'))
+    result = hw.interval_join(df, events, *bounds, ['value'], policy=policy)['value']
+
+    expected = pd.Series(np.nan, index=df.index)
+    masks = list(naive_masks(df, events, *bounds))
+    for event, mask in (reversed(masks) if policy == 'first' else masks):
+        if policy in ('latest', 'first'):
+            expected[mask] = event['value']
+        elif policy == 'max':
+            expected[mask] = np.fmax(expected[mask], event['value'])
+        else:
+            expected[mask] = expected[mask].fillna(0) + event['value']
+    assert expected.notna().sum() > 0 and (expected.notna() & (expected != result)).sum() == 0
+    pd.testing.assert_series_equal(result, expected, check_names=False, check_dtype=False)
+
+
+def test_add_road_build_event_matches_per_event_loop(target_df, road_build, mileage):
+    _, result = hw.add_road_build_event(target_df, road_build, mileage)
+
+    df = with_miles(target_df, mileage)
+    expected = pd.DataFrame(0, index=df.index, columns=['road_build', 'total_block_count', 'road_block_count'])
+    events = road_build.query('incStepFreewayId==10050 & incStepDirection==2')
+    for event, mask in naive_masks(df, events, ('incStepTime', 'incStepEndTime'),
+                                   ('incStepEndMileage', 'incStepStartMileage')):
+        pattern = event['incStepBlockagePattern']
+        expected.loc[mask] = [1, pattern[0:14].count('1'), pattern[1:10].count('1')]
+    assert expected['road_build'].sum() > 0
+    pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+    pd.testing.assert_frame_equal(result[target_df.columns], target_df)
+
+
+def test_add_traffic_event_matches_per_event_loop(target_df, traffic_accidents, mileage):
+    _, result = hw.add_traffic_event(target_df, traffic_accidents, mileage)
+
+    df = with_miles(target_df, mileage)
+    columns = {'里程': 'accident_mileage', '處理分鐘': 'handling_minutes', '事故類型': 'accident_type',
+               '受傷': 'injuries_count', '內車道': 'inner_lane_flag', '小客車': 'passenger_car_count',
+               '大貨車': 'heavy_truck_count'}
+    expected = pd.DataFrame({'accident_mileage': 99999999.0, 'handling_minutes': 0, 'accident_type': 0,
+                             'injuries_count': 0, 'inner_lane_flag': 0, 'passenger_car_count': 0,
+                             'heavy_truck_count': 0}, index=df.index)
+    events = traffic_accidents.query('國道名稱=="國道5號" & 方向=="北"').copy()
+    events['里程'] *= 1000
+    events['start'] = pd.to_datetime(events[['年', '月', '日', '時', '分']].astype(str).agg(' '.join, axis=1),
+                                     format='%Y %m %d %H %M')
+    events['end'] = events['start'] + pd.to_timedelta(events['處理分鐘'], unit='m')
+    cars = events[[f'車輛{i}' for i in range(1, 13)]].apply(lambda x: ','.join(x.dropna()), axis=1)
+    events['小客車'] = cars.str.count('小客車')
+    events['大貨車'] = cars.str.count('大貨車')
+    events['事故類型'] = events['事故類型'].map({'A3': 1, 'A2': 2, 'A1': 3})
+    for event, mask in naive_masks(df, events, ('start', 'end'), ('里程', '里程')):
+        expected.loc[mask] = [event[col] for col in columns]
+    assert (expected['accident_type'] > 0).sum() > 0
+
+    result = hw.densify_features(result[list(columns.values())])
+    pd.testing.assert_frame_equal(result, expected.astype('float64'))
@@ -0,0 +1,194 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from hwttp import feature_engineering as fe
+from hwttp import hwtoolkit as hw
+
+GANTRIES = [f'05F{i:04d}N' for i in range(0, 300, 30)]
+PAIRS = [f'{GANTRIES[i + 1]}-{GANTRIES[i]}' for i in range(len(GANTRIES) - 1)]
+INTERCHANGES = ['南港系統交流道', '坪林交控交流道', '頭城交流道', '宜蘭交流道', '羅東交流道']
+
+
+def synthetic_base(timestamps):
+    rng = np.random.default_rng(1)
+    df = pd.DataFrame([(ts, pair) for pair in PAIRS for ts in timestamps], columns=['TimeStamp', 'gf_gt'])
+    df[['GantryFrom', 'GantryTo']] = df['gf_gt'].str.split('-', expand=True)
+    df['WeightedAvgTravelTime'] = rng.uniform(50, 300, len(df))
+    df['TotalTraffic'] = 1.0
+    # notebook 的基礎資料不一定是 RangeIndex
+    df.index = df.index * 3 + 7
+    return df
+
+
+@pytest.fixture
+def base_df():
+    return synthetic_base(pd.date_range('2023-01-25', periods=96 * 14, freq='15min'))
+
+
+@pytest.fixture
+def resource():
+    rng = np.random.default_rng(2)
+    timestamps = pd.date_range('2023-01-25', periods=96 * 14, freq='15min')
+    n = 120
+    starts = (pd.Series(rng.choice(timestamps, n)) + pd.to_timedelta(rng.integers(0, 15, n), unit='m')).sort_values(ignore_index=True)
+    miles = rng.uniform(0, 280000, n)
+    rs = hw.hw_df_resource({})
+    rs.milelocation_info_df = pd.DataFrame({'LocationName': GANTRIES + INTERCHANGES,
+                                            'LocationMile': [i * 1000.0 for i in range(0, 300, 30)]
+                                                            + [280000, 200000, 150000, 100000, 0]})
+    congest_start = rng.integers(0, 24, 20) * 100
+    rs.congestion_table = pd.DataFrame({'direction': 'N', 'LinkStart': rng.choice(['頭城', '宜蘭', '羅東'], 20),
+                                        'LinkEnd': rng.choice(['南港系統', '坪林'], 20), 'StartYearMonth': 202301,
+                                        'EndYearMonth': 202302, 'dayofweek': rng.choice(['weekday', 'Saturday', 'Sunday'], 20),
+                                        'CongestStart': congest_start, 'CongestEnd': np.minimum(congest_start + 200, 2359)})
+    rs.calendar_event = pd.DataFrame({'event_name': ['農曆新年', '西洋情人節', '二二八紀念日'],
+                                      'start_date': ['2023-01-20', '2023-02-14', '2023-02-25'],
+                                      'end_date': ['2023-01-29', '2023-02-14', '2023-02-28'],
+                                      'continuous': ['T', 'F', 'T'], 'event_length': [10, 1, 4]})
+    rs.road_build_event = pd.DataFrame({'incStepFreewayId': 10050, 'incStepDirection': 2, 'incStepIncidentId': np.arange(n),
+                                        'incStepTime': starts, 'incStepEndTime': starts + pd.to_timedelta(rng.integers(30, 600, n), unit='m'),
+                                        'incStepStartMileage': miles + rng.uniform(0, 5000, n), 'incStepEndMileage': miles,
+                                        'incStepBlockagePattern': [''.join(rng.choice(['0', '1'], 16)) for _ in range(n)]})
+    accidents = pd.DataFrame({'國道名稱': '國道5號', '方向': '北', '年': starts.dt.year, '月': starts.dt.month,
+                              '日': starts.dt.day, '時': starts.dt.hour, '分': starts.dt.minute, '里程': miles / 1000,
+                              '事件發生': 'x', '事件排除': 'z', '處理分鐘': rng.integers(10, 200, n),
+                              '事故類型': rng.choice(['A1', 'A2', 'A3'], n), '死亡': rng.integers(0, 2, n),
+                              '受傷': rng.integers(0, 3, n), '簡訊內容': 'msg'})
+    for col in ['內路肩', '內車道', '中內車道', '中車道', '中外車道', '外車道', '外路肩', '匝道', '翻覆事故註記',
+                '施工事故註記', '危險物品車輛註記', '車輛起火註記', '冒煙車事故註記', '主線中斷註記', '肇事車輛']:
+        accidents[col] = rng.integers(0, 2, n)
+    for i in range(1, 13):
+        accidents[f'車輛{i}'] = pd.Series(rng.choice(['小客車', '大貨車', None], n), dtype='string')
+    rs.traffic_accident_data = accidents
+    return rs
+
+
+def notebook_chain(base_df, rs, combinations):
+    # modelling_feature_selection 的組合迴圈：整個基礎資料依序套用 add_*，'_p' 先做，最後取出該門架對
+    element_dict = {'_c': lambda df: hw.add_congestion_condition(df, rs.congestion_table, rs.milelocation_info_df),
+                    '_h': lambda df: hw.add_calendar_event(df, rs.calendar_event),
+                    '_t': lambda df: hw.add_traffic_event(df, rs.traffic_accident_data, rs.milelocation_info_df)[1],
+                    '_r': lambda df: hw.add_road_build_event(df, rs.road_build_event, rs.milelocation_info_df)[1]}
+    results = dict()
+    for pair, combo in combinations.items():
+        df = base_df.copy()
+        if '_p' in combo:
+            df = hw.add_ds_5prev_traveltime(df)
+        for name in combo:
+            if name != '_p':
+                df = element_dict[name](df)
+        results[hw.combination_name(pair, combo)] = df[df['gf_gt'] == pair]
+    return results
+
+
+COMBINATIONS = {PAIRS[0]: ['_c', '_h', '_t', '_r', '_p'], PAIRS[3]: ['_h', '_p'], PAIRS[5]: ['_r', '_c'],
+                PAIRS[8]: ['_t']}
+
+
+def count_computes(monkeypatch):
+    calls = []
+    for name, block in hw.FEATURE_BLOCKS.items():
+        compute = block['compute']
+        monkeypatch.setitem(block, 'compute', lambda df, rs, cache_paths, name=name, compute=compute:
+                            calls.append((name, tuple(pd.unique(df['gf_gt'])))) or compute(df, rs, cache_paths))
+    return calls
+
+
+def test_assemble_matches_notebook_chain(base_df, resource, tmp_path, monkeypatch):
+    expected = notebook_chain(base_df, resource, COMBINATIONS)
+    store = fe.FeatureStore(str(tmp_path), resource, base_df)
+    result = store.assemble_all(COMBINATIONS)
+    assert list(result) == list(expected)
+    for name in expected:
+        pd.testing.assert_frame_equal(result[name], expected[name])
+
+    # 已經算過的區塊不再計算，只讀部分期間時等於篩選後的結果
+    calls = count_computes(monkeypatch)
+    result = store.assemble(PAIRS[0], COMBINATIONS[PAIRS[0]], start='2023-02-01', end='2023-02-03')
+    name = hw.combination_name(PAIRS[0], COMBINATIONS[PAIRS[0]])
+    timestamps = expected[name]['TimeStamp']
+    pd.testing.assert_frame_equal(result, expected[name][(timestamps >= '2023-02-01') & (timestamps < '2023-02-03')])
+    assert calls == []
+
+
+def test_blocks_are_keyed_per_gantry_pair(base_df, resource, tmp_path, monkeypatch):
+    store = fe.FeatureStore(str(tmp_path), resource, base_df)
+    for name in hw.FEATURE_BLOCKS:
+        store.compute_block(name)
+    assert store.status()['cached'].all()
+
+    # 其中一個門架對多了一天的資料：只有該門架對與以它為下游的門架對 ('_p') 需要重算
+    extra = synthetic_base(pd.date_range('2023-02-08', periods=96, freq='15min'))
+    extra = extra[extra['gf_gt'] == PAIRS[4]]
+    grown = pd.concat([base_df, extra])
+    grown.index = np.arange(len(grown))
+    store = fe.FeatureStore(str(tmp_path), resource, grown)
+    status = store.status()
+    assert set(status.loc[~status['cached'], 'gf_gt']) == {PAIRS[4], PAIRS[5]}
+    assert set(status.loc[~status['cached'] & (status['gf_gt'] == PAIRS[5]), 'block']) == {'_p'}
+
+    calls = count_computes(monkeypatch)
+    combinations = {pair: ['_c', '_h', '_t', '_r', '_p'] for pair in PAIRS[3:7]}
+    result = store.assemble_all(combinations)
+    # '_p' 一次計算，另外讀入下游門架對的列
+    assert sorted((name, set(pairs)) for name, pairs in calls) \
+           == sorted([(name, {PAIRS[4]}) for name in ['_c', '_h', '_r', '_t']] + [('_p', set(PAIRS[3:6]))])
+    expected = notebook_chain(grown, resource, combinations)
+    for name in expected:
+        pd.testing.assert_frame_equal(result[name], expected[name])
+
+    removed = store.remove_stale()
+    assert sorted(os.path.dirname(path) for path in removed) == ['c', 'h', 'p', 'p', 'r', 't']
+    assert store.status()['cached'].all()
+
+
+def test_table_fingerprints_are_memoized(base_df, resource, tmp_path, monkeypatch):
+    store = fe.FeatureStore(str(tmp_path), resource, base_df)
+    hashed = []
+    frame_fingerprint = fe.frame_fingerprint
+    monkeypatch.setattr(fe, 'frame_fingerprint', lambda df: hashed.append(len(df)) or frame_fingerprint(df))
+    keys = store.block_keys('_h')
+    for pair in PAIRS:
+        assert store.block_key('_h', pair) == keys[pair]
+        store.block_path('_c', pair)
+    assert len(hashed) == 3
+
+    # 各門架對的 key 與只用該門架對的列建立的 store 相同
+    single = fe.FeatureStore(str(tmp_path / 'single'), resource, base_df[base_df['gf_gt'] == PAIRS[2]])
+    assert single.block_key('_h', PAIRS[2]) == keys[PAIRS[2]]
+    assert len(hashed) == 4
+
+    # 換掉 resource 的資料表時只重算用到它的區塊
+    resource.calendar_event = resource.calendar_event.iloc[:-1].copy()
+    c_key = store.block_key('_c', PAIRS[0])
+    assert store.block_keys('_h')[PAIRS[0]] != keys[PAIRS[0]]
+    assert store.block_key('_c', PAIRS[0]) == c_key
+    assert len(hashed) == 5
+
+
+@pytest.mark.parametrize('start_method', [None, 'spawn'])
+def test_run_combinations_parallel_matches_notebook_chain(base_df, resource, start_method):
+    expected = notebook_chain(base_df, resource, COMBINATIONS)
+    mp_context = multiprocessing.get_context(start_method) if start_method else None
+    result = hw.run_combinations_parallel(base_df, resource, COMBINATIONS, max_workers=2, mp_context=mp_context)
+    assert list(result) == list(expected)
+    for name in expected:
+        pd.testing.assert_frame_equal(result[name], expected[name])
+
+
+def test_run_combinations_parallel_writes_parquet(base_df, resource, tmp_path):
+    expected = notebook_chain(base_df, resource, COMBINATIONS)
+    result = hw.run_combinations_parallel(base_df, resource, COMBINATIONS, max_workers=2,
+                                          output_dir=str(tmp_path / 'combinations'))
+    for name, path in result.items():
+        assert path == str(tmp_path / 'combinations' / f'{name}.parquet')
+        # notebook 存檔前把 object 轉成 string 後 to_parquet
+        df = expected[name].copy()
+        object_columns = df.select_dtypes(include='object').columns
+        df[object_columns] = df[object_columns].astype('string')
+        df.to_parquet(tmp_path / 'notebook.parquet')
+        pd.testing.assert_frame_equal(pd.read_parquet(path), pd.read_parquet(tmp_path / 'notebook.parquet'))
@@ -0,0 +1,89 @@
+import random
+
+import pandas as pd
+import pytest
+
+from hwttp import data_cleaning as dc
+from hwttp import scraper_replay as sr
+
+M04A_KEYS = ['TimeStamp', 'GantryFrom', 'GantryTo', 'VehicleType']
+
+
+@pytest.fixture(scope='module')
+def m04a_df():
+    rng = random.Random(0)
+    frames = [df for date in ['20240131', '20240201']
+              for _, df in dc.read_tdcs_tar(sr.synthetic_tdcs_tar('M04A', date, 4, rng))]
+    return pd.concat(frames, ignore_index=True)
+
+
+def location(tmp_path, backend):
+    return str(tmp_path / ('hw.db' if backend == 'sqlite' else 'store'))
+
+
+def write_months(df, loc, backend, how):
+    for year_month, month_df in df.groupby(df['TimeStamp'].dt.strftime('%Y%m')):
+        with dc.open_table(backend, loc, dc.tdcs_table_name(backend, 'M04A', year_month), schema='M04A') as tb:
+            if how == 'bulk_load':
+                with tb.bulk_load() as session:
+                    for _, hour_df in month_df.groupby(month_df['TimeStamp'].dt.hour):
+                        session.add(hour_df)
+            elif how == 'append_data':
+                tb.append_data(month_df)
+            else:
+                tb.initialize_table()
+                tb.update_data(month_df, M04A_KEYS)
+
+
+def assert_rollups_match(df, loc, backend):
+    for minutes in dc.ROLLUP_RESOLUTIONS:
+        result = dc.read_traveltime_rollup(loc, minutes, backend=backend).drop(columns='gf_gt')
+        pd.testing.assert_frame_equal(result, dc.aggregate_m04a(df, minutes), check_dtype=False)
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'parquet'])
+@pytest.mark.parametrize('how', ['bulk_load', 'append_data', 'update_data'])
+def test_rollups_follow_m04a_writes(m04a_df, tmp_path, backend, how):
+    loc = location(tmp_path, backend)
+    write_months(m04a_df, loc, backend, how)
+    assert_rollups_match(m04a_df, loc, backend)
+    assert dc.stale_rollup_ranges(loc, backend).empty
+
+    # 遲到的資料只重算受影響的區間
+    late = m04a_df[(m04a_df['TimeStamp'] >= '2024-02-01 10:00') & (m04a_df['TimeStamp'] < '2024-02-01 10:10')].copy()
+    late['Traffic'] += 7
+    write_months(late, loc, backend, 'update_data')
+    expected = pd.concat([m04a_df, late]).drop_duplicates(M04A_KEYS, keep='last')
+    assert_rollups_match(expected, loc, backend)
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'parquet'])
+def test_reading_stale_rollups_is_refused(m04a_df, tmp_path, backend):
+    loc = location(tmp_path, backend)
+    write_months(m04a_df, loc, backend, 'bulk_load')
+    day = m04a_df[m04a_df['TimeStamp'] >= '2024-02-01 12:00']
+
+    # manager 沒有 close 前，寫入範圍內的彙總表視為過時
+    tb = dc.open_table(backend, loc, dc.tdcs_table_name(backend, 'M04A', '202402'), schema='M04A')
+    tb.update_data(day.assign(Traffic=day['Traffic'] + 1), M04A_KEYS)
+    if backend == 'sqlite':
+        tb.connection.commit()
+    with pytest.raises(RuntimeError, match='stale'):
+        dc.read_traveltime_rollup(loc, 15, backend=backend)
+    assert len(dc.read_traveltime_rollup(loc, 15, start='2024-01-31', end='2024-02-01', backend=backend))
+
+    tb.close()
+    assert dc.stale_rollup_ranges(loc, backend).empty
+    assert_rollups_match(pd.concat([m04a_df, day.assign(Traffic=day['Traffic'] + 1)]).drop_duplicates(M04A_KEYS, keep='last'),
+                         loc, backend)
+
+
+def test_failed_bulk_load_leaves_rollups_fresh(m04a_df, tmp_path):
+    loc = location(tmp_path, 'sqlite')
+    write_months(m04a_df, loc, 'sqlite', 'bulk_load')
+    with pytest.raises(ValueError):
+        with dc.DatabaseManager(loc, 'ETAG_M04A_202402', schema='M04A') as tb, tb.bulk_load() as session:
+            session.add(m04a_df[m04a_df['TimeStamp'] >= '2024-02-01'])
+            raise ValueError('interrupted')
+    assert dc.stale_rollup_ranges(loc).empty
+    assert_rollups_match(m04a_df, loc, 'sqlite')
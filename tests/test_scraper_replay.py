@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import pytest
+
+from hwttp import scraper_replay as sr
+
+DATES = ['20240101', '20240102']
+
+
+def served_files(root_dir):
+    # ReplayServer 目錄樹中的檔案 -> scraper 存放的相對路徑
+    files = {}
+    for dataset in ['VD', 'ETag']:
+        for date in DATES:
+            folder = os.path.join(root_dir, 'history', 'motc20', dataset, date)
+            for name in os.listdir(folder):
+                files[os.path.join(dataset, date, name)] = os.path.join(folder, name)
+    for dataset in ['M03A', 'M04A', 'M05A']:
+        folder = os.path.join(root_dir, 'history', 'TDCS', dataset)
+        for name in os.listdir(folder):
+            files[os.path.join(dataset, name)] = os.path.join(folder, name)
+    return files
+
+
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    root_dir = str(tmp_path_factory.mktemp('tisv'))
+    return sr.build_synthetic_tree(root_dir, DATES, vd_live_per_day=6, etag_live_per_day=4, n_vd=10, n_gantry=8)
+
+
+def test_scrapers_recover_from_errors_and_truncation(tree, tmp_path):
+    results = sr.benchmark_scrapers(DATES, root_dir=tree, work_dir=str(tmp_path),
+                                    engine_kwargs={'max_retries': 10},
+                                    server_kwargs={'error_rate': 0.2, 'truncate_rate': 0.2, 'seed': 3})
+    assert (results['failed'] == 0).all()
+    assert results['retries'].sum() > 0
+
+    files = served_files(tree)
+    assert results['files'].sum() == len(files)
+    for rel_path, served_path in files.items():
+        with open(os.path.join(tmp_path, rel_path), 'rb') as got, open(served_path, 'rb') as expected:
+            assert got.read() == expected.read(), rel_path
+        assert not os.path.exists(os.path.join(tmp_path, rel_path) + '.part')
+
+
+def test_check_regression_requires_explicit_baseline(tmp_path):
+    results = pd.DataFrame({'scraper': ['scrape_vd_data'], 'files_per_sec': [100.0], 'bytes_per_sec': [1000.0]})
+    baseline_path = str(tmp_path / 'baseline.json')
+    with pytest.raises(FileNotFoundError):
+        sr.check_regression(results, baseline_path)
+    assert not os.path.exists(baseline_path)
+
+    assert sr.check_regression(results, baseline_path, update=True) == []
+    assert sr.check_regression(results, baseline_path) == []
+    slower = results.assign(files_per_sec=50.0)
+    assert sr.check_regression(slower, baseline_path) == ['scrape_vd_data files_per_sec: 50.0 < baseline 100.0']
+
+
+def test_committed_baseline_covers_all_scrapers():
+    baseline = pd.read_json(sr.DEFAULT_BASELINE_PATH)
+    assert set(baseline.columns) == {'scrape_vd_data', 'scrape_etag_info', 'scrape_etag_gantry_volume',
+                                     'scrape_etag_intergantry_traveltime', 'scrape_etag_intergantry_speed'}
@@ -0,0 +1,115 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from hwttp import data_cleaning as dc
+from hwttp import data_scraper as ds
+from hwttp import scraper_replay as sr
+
+DATES = ['20240101', '20240102']
+
+
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    root_dir = str(tmp_path_factory.mktemp('tisv'))
+    return sr.build_synthetic_tree(root_dir, DATES, vd_live_per_day=3, etag_live_per_day=2, n_vd=4, n_gantry=4)
+
+
+@pytest.fixture
+def server(tree):
+    with sr.ReplayServer(tree) as server:
+        yield server
+
+
+@pytest.fixture
+def engine():
+    with ds.DownloadEngine(max_workers=16, rate=5000, burst=5000, max_retries=0) as engine:
+        yield engine
+
+
+def sync(server, engine, tmp_path, datasets, **kwargs):
+    return dc.sync_raw_datasets(DATES[0], DATES[-1], datasets, raw_root=str(tmp_path / 'raw'),
+                                decompress=False, engine=engine, host_url=server.url, **kwargs)
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'parquet'])
+def test_sync_ingests_files_downloaded_earlier(server, engine, tmp_path, backend):
+    db_path = str(tmp_path / ('hw.db' if backend == 'sqlite' else 'store'))
+    # 第一次只下載不寫入，之後指定 db_path 時要補寫之前下載的檔案
+    summary = sync(server, engine, tmp_path, ['VD', 'ETag'])
+    assert summary['VD']['downloaded'] == (1 + 3) * len(DATES)
+
+    summary = sync(server, engine, tmp_path, ['VD', 'ETag'], db_path=db_path, backend=backend)
+    assert summary['VD']['downloaded'] == 0
+    assert summary['VD']['ingested_rows'] > 0 and summary['ETag']['ingested_rows'] > 0
+    with dc.open_table(backend, db_path, dc.INGEST_LOG_TABLE, schema='INGEST_LOG') as log_tb:
+        log_df = log_tb.read_data()
+    assert len(log_df) == (1 + 3) * len(DATES) + (2 + 2) * len(DATES)
+    assert set(log_df['TableName']) == set(dc.XML_TABLE_NAMES.values())
+
+    with dc.open_table(backend, db_path, 'VD_DYNAMIC', schema='VD_DYNAMIC') as tb:
+        n_rows = len(tb.read_data(columns=['VDID']))
+    summary = sync(server, engine, tmp_path, ['VD', 'ETag'], db_path=db_path, backend=backend)
+    assert summary['VD']['ingested_rows'] == 0 and summary['ETag']['ingested_rows'] == 0
+    with dc.open_table(backend, db_path, 'VD_DYNAMIC', schema='VD_DYNAMIC') as tb:
+        assert len(tb.read_data(columns=['VDID'])) == n_rows
+
+
+def test_find_missing_xml_files_trusts_tables_without_log(server, engine, tmp_path):
+    db_path = str(tmp_path / 'hw.db')
+    sync(server, engine, tmp_path, ['VD'])
+    # INGEST_LOG 之前的寫入方式：直接 append，沒有紀錄
+    with dc.DatabaseManager(db_path, 'VD_DYNAMIC', schema='VD_DYNAMIC') as tb:
+        path = str(tmp_path / 'raw' / 'VD' / DATES[0] / 'VDLive_0000.xml.gz')
+        tb.append_data(dc.xml_gz_to_df(path, 'VDLive'))
+
+    missing = dc.find_missing_xml_files(db_path, 'VD', DATES, str(tmp_path / 'raw'))
+    assert {date for date, _, _ in missing['VD_DYNAMIC']} == {DATES[1]}
+    assert {date for date, _, _ in missing['VD_STATIC']} == set(DATES)
+
+
+def test_sync_does_not_reread_archive_holes(tree, tmp_path, monkeypatch):
+    # 遠端的 tar.gz 少了 0005 這個時段
+    tar_path = os.path.join(tree, 'history', 'TDCS', 'M04A', f'M04A_{DATES[0]}.tar.gz')
+    with tarfile.open(tar_path, 'r:gz') as tar:
+        members = [(member, tar.extractfile(member).read()) for member in tar.getmembers()]
+    holed_root = str(tmp_path / 'tisv')
+    holed_dir = os.path.join(holed_root, 'history', 'TDCS', 'M04A')
+    os.makedirs(holed_dir)
+    with tarfile.open(os.path.join(holed_dir, f'M04A_{DATES[0]}.tar.gz'), 'w:gz') as tar:
+        for member, content in members:
+            if not member.name.endswith('_000500.csv'):
+                tar.addfile(member, io.BytesIO(content))
+
+    calls = []
+    read_tdcs_tar = dc.read_tdcs_tar
+    monkeypatch.setattr(dc, 'read_tdcs_tar', lambda *args, **kwargs: calls.append(args) or read_tdcs_tar(*args, **kwargs))
+    db_path = str(tmp_path / 'hw.db')
+    with sr.ReplayServer(holed_root) as server, \
+         ds.DownloadEngine(max_workers=4, rate=5000, burst=5000, max_retries=0) as engine:
+        kwargs = dict(raw_root=str(tmp_path / 'raw'), db_path=db_path, engine=engine, host_url=server.url)
+        summary = dc.sync_raw_datasets(DATES[0], DATES[0], ['M04A'], **kwargs)
+        assert summary['M04A']['ingested_rows'] > 0
+        assert len(calls) == 1
+        assert dc.find_missing_tdcs_slots(db_path, 'M04A', [DATES[0]]) == {DATES[0]: ['0005']}
+
+        summary = dc.sync_raw_datasets(DATES[0], DATES[0], ['M04A'], **kwargs)
+        assert summary['M04A']['ingested_rows'] == 0
+        assert len(calls) == 1
+
+
+def test_default_manifest_follows_raw_root(server, engine, tmp_path):
+    raw_root = tmp_path / 'mirror' / 'raw'
+    ds.scrape_etag_intergantry_traveltime(DATES, save_dir=str(raw_root / 'ETag_intergantry_traveltime'),
+                                          engine=engine, host_url=server.url)
+    manifest_path = raw_root / ds.MANIFEST_FILE_NAME
+    assert manifest_path.exists()
+
+    dc.sync_raw_datasets(DATES[0], DATES[-1], ['M04A'], raw_root=str(raw_root), decompress=False,
+                         engine=engine, host_url=server.url)
+    with ds.DownloadManifest(str(manifest_path)) as manifest:
+        assert manifest.done_files('M04A', DATES[0], str(raw_root / 'ETag_intergantry_traveltime')) \
+               == {f'M04A_{DATES[0]}.tar.gz'}
+    assert os.listdir(tmp_path / 'mirror') == ['raw']
@@ -0,0 +1,74 @@
+import os
+import random
+
+import pandas as pd
+import pytest
+
+from hwttp import data_cleaning as dc
+from hwttp import scraper_replay as sr
+
+DATES = ['20240131', '20240201']
+
+
+@pytest.fixture(scope='module')
+def raw_dir(tmp_path_factory):
+    raw_dir = tmp_path_factory.mktemp('raw')
+    rng = random.Random(0)
+    for dataset in ['M03A', 'M04A']:
+        for date in DATES:
+            (raw_dir / f'{dataset}_{date}.tar.gz').write_bytes(sr.synthetic_tdcs_tar(dataset, date, 4, rng))
+    return str(raw_dir)
+
+
+def extracted_reference(raw_dir, dataset, tmp_path):
+    # 舊流程：解壓後逐一 read_csv
+    output_dir = str(tmp_path / 'unzip')
+    dc.decompress_procedure_direct(DATES, raw_dir, output_dir)
+    frames = []
+    for folder, _, file_names in sorted(os.walk(output_dir)):
+        for file_name in sorted(file_names):
+            if file_name.startswith(f'TDCS_{dataset}_'):
+                frames.append(pd.read_csv(os.path.join(folder, file_name), names=dc.TDCS_COLUMNS[dataset],
+                                          dtype=dc.TDCS_DTYPES[dataset]))
+    df = pd.concat(frames, ignore_index=True)
+    df['TimeStamp'] = pd.to_datetime(df['TimeStamp'], format=dc.TDCS_TIME_FORMAT[dataset])
+    return df
+
+
+def read_back(db_path, backend, dataset):
+    if backend == 'sqlite':
+        return dc.query_tdcs_dataset(db_path, dataset)
+    with dc.ParquetStoreManager(db_path, dataset, schema=dataset) as store:
+        return store.read_data()
+
+
+def sort_rows(df):
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'parquet'])
+def test_ingest_tdcs_archives_matches_extracted_csv(raw_dir, tmp_path, backend):
+    db_path = str(tmp_path / ('hw.db' if backend == 'sqlite' else 'store'))
+    written = dc.ingest_tdcs_archives(DATES, raw_dir, db_path, backend=backend)
+    assert set(written) == {'M03A', 'M04A'}
+
+    for dataset in ['M03A', 'M04A']:
+        expected = extracted_reference(raw_dir, dataset, tmp_path)
+        result = read_back(db_path, backend, dataset)[dc.TDCS_COLUMNS[dataset]]
+        assert written[dataset] == len(expected)
+        pd.testing.assert_frame_equal(sort_rows(result), sort_rows(expected), check_dtype=False)
+        assert dc.find_missing_tdcs_slots(db_path, dataset, DATES, backend=backend) == {}
+
+    # 重複執行只寫入缺少的時段
+    assert dc.ingest_tdcs_archives(DATES, raw_dir, db_path, backend=backend) == {'M03A': 0, 'M04A': 0}
+
+    rollup = dc.read_traveltime_rollup(db_path, 15, backend=backend)
+    assert rollup['TimeStamp'].min() == pd.Timestamp(DATES[0])
+    assert rollup['TimeStamp'].max() == pd.Timestamp(DATES[-1]) + pd.Timedelta(hours=23, minutes=45)
+
+
+def test_ingest_tdcs_archives_only_reads_listed_dates(raw_dir, tmp_path):
+    db_path = str(tmp_path / 'hw.db')
+    written = dc.ingest_tdcs_archives(DATES[:1], raw_dir, db_path)
+    assert written['M04A'] > 0
+    assert dc.find_missing_tdcs_slots(db_path, 'M04A', DATES) == {DATES[1]: dc.day_slots(5)}
@@ -0,0 +1,45 @@
+import gzip
+import random
+import warnings
+
+import pandas as pd
+import pytest
+
+from hwttp import data_cleaning as dc
+from hwttp import scraper_replay as sr
+
+
+def synthetic_documents():
+    rng = random.Random(0)
+    return {'VD': sr.synthetic_vd_static('20240101', 30),
+            'VDLive': sr.synthetic_vd_live('20240101', '0000', 30, rng),
+            'ETag': sr.synthetic_etag_static('20240101', 8),
+            'ETagPair': sr.synthetic_etag_pair('20240101', 8),
+            'ETagPairLive': sr.synthetic_etag_pair_live('20240101', '0000', 8, rng)}
+
+
+@pytest.mark.parametrize('file_type', ['VD', 'VDLive', 'ETag', 'ETagPair', 'ETagPairLive'])
+def test_iterparse_matches_dict_converter(file_type):
+    document = synthetic_documents()[file_type]
+    source = gzip.compress(document)
+    with warnings.catch_warnings():
+        # dict 版本的轉換函數保留原本的寫法，會有 pandas 的 FutureWarning
+        warnings.simplefilter('ignore')
+        expected = dc.xml_gz_to_df(source, file_type, method='dict').reset_index(drop=True)
+    result = dc.xml_gz_to_df(source, file_type)
+    assert len(result) > 0
+    pd.testing.assert_frame_equal(result, expected)
+
+    # 沒有 namespace 的文件結果相同
+    no_namespace = document.replace(f' xmlns="{sr.XML_NS}"'.encode(), b'')
+    pd.testing.assert_frame_equal(dc.XML_ITERPARSE_TO_DF[file_type](no_namespace), result)
+
+
+def test_xml_gz_to_df_reads_path_and_writes_debug_xml(tmp_path):
+    document = synthetic_documents()['ETagPairLive']
+    path = tmp_path / 'ETagPairLive_0000.xml.gz'
+    path.write_bytes(gzip.compress(document))
+    debug_path = tmp_path / 'debug' / 'ETagPairLive_0000.xml'
+    result = dc.xml_gz_to_df(str(path), 'ETagPairLive', debug_xml_path=str(debug_path))
+    pd.testing.assert_frame_equal(result, dc.xml_gz_to_df(gzip.compress(document), 'ETagPairLive'))
+    assert debug_path.read_bytes() == document